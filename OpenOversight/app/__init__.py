@@ -9,6 +9,9 @@ from flask_login import LoginManager
 from flask_mail import Mail
 
 from config import config
+from .cache import SearchCache
+from .storage import s3_clients
+from .uploads import StreamingRequest, UploadedHashes
 
 
 bootstrap = Bootstrap()
@@ -21,18 +24,29 @@ login_manager.login_view = 'auth.login'
 limiter = Limiter(key_func=get_remote_address,
                   default_limits=["100 per minute", "5 per second"])
 
+search_cache = SearchCache()
+uploaded_hashes = UploadedHashes()
+
 
 def create_app(config_name='default'):
     app = Flask(__name__)
+    app.request_class = StreamingRequest
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
     from .models import db  # noqa
+    from .snapshot import officer_snapshot  # noqa
+    from .upload_queue import upload_queue  # noqa
 
     bootstrap.init_app(app)
     mail.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
     limiter.init_app(app)
+    search_cache.init_app(app)
+    uploaded_hashes.init_app(app)
+    s3_clients.init_app(app)
+    officer_snapshot.init_app(app)
+    upload_queue.init_app(app)
 
     from .main import main as main_blueprint  # noqa
     app.register_blueprint(main_blueprint)
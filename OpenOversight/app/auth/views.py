@@ -9,6 +9,7 @@ from .forms import LoginForm, RegistrationForm, ChangePasswordForm,\
     PasswordResetRequestForm, PasswordResetForm, ChangeEmailForm, ChangeDefaultDepartmentForm, \
     EditUserForm
 from .utils import admin_required
+from ..utils import fetch_ahead_paginate, estimate_count
 
 
 @auth.before_app_request
@@ -193,8 +194,9 @@ class UserAPI(MethodView):
             else:
                 page = 1
             USERS_PER_PAGE = int(current_app.config['USERS_PER_PAGE'])
-            users = User.query.order_by(User.email) \
-                .paginate(page, USERS_PER_PAGE, False)
+            query = User.query.order_by(User.email)
+            users = fetch_ahead_paginate(query, page, USERS_PER_PAGE,
+                                         lambda: estimate_count(query))
 
             return render_template('auth/users.html', objects=users)
         else:
@@ -0,0 +1,198 @@
+"""Cache of ordered officer ID lists for gallery searches"""
+from array import array
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+SESSION_KEY = 'search_cache_departments'
+
+
+class LRUCache(object):
+    """Thread-safe least recently used mapping with per-entry expiry"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoryBackend(object):
+    """Keeps results and generation counters in this process only"""
+
+    def __init__(self, max_size, ttl):
+        self.results = LRUCache(max_size, ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generations(self, names):
+        return [self._generations.get(name, 0) for name in names]
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def get_ids(self, key):
+        return self.results.get(key)
+
+    def set_ids(self, key, officer_ids):
+        self.results.set(key, officer_ids)
+
+
+class RedisBackend(MemoryBackend):
+    """Shares results and generation counters between workers via Redis"""
+
+    def __init__(self, max_size, ttl, url):
+        import redis
+        super(RedisBackend, self).__init__(max_size, ttl)
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def generations(self, names):
+        values = self.client.mget(['oo:generation:' + name for name in names])
+        return [int(value or 0) for value in values]
+
+    def bump(self, names):
+        pipeline = self.client.pipeline()
+        for name in names:
+            pipeline.incr('oo:generation:' + name)
+        pipeline.execute()
+
+    def get_ids(self, key):
+        officer_ids = self.results.get(key)
+        if officer_ids is None:
+            cached = self.client.get('oo:search:' + key)
+            if cached is not None:
+                officer_ids = array('l', json.loads(cached))
+                self.results.set(key, officer_ids)
+        return officer_ids
+
+    def set_ids(self, key, officer_ids):
+        self.results.set(key, officer_ids)
+        self.client.setex('oo:search:' + key, self.ttl,
+                          json.dumps(officer_ids.tolist()))
+
+
+def _department_generation(department_id):
+    if department_id is None:
+        return 'department:all'
+    return 'department:{}'.format(department_id)
+
+
+class SearchCache(object):
+    """Flask extension caching the officer IDs each search returns"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = None
+        size = int(app.config.get('SEARCH_CACHE_SIZE', 0))
+        ttl = int(app.config.get('SEARCH_CACHE_TTL', 300))
+        if size > 0:
+            url = app.config.get('SEARCH_CACHE_REDIS_URL')
+            if url:
+                try:
+                    backend = RedisBackend(size, ttl, url)
+                except ImportError:
+                    app.logger.warning('redis is not installed, caching '
+                                       'searches in process instead')
+            if backend is None:
+                backend = MemoryBackend(size, ttl)
+        app.extensions['search_cache'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('search_cache')
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def officer_ids(self, kind, department_id, search_key, compute):
+        """Return the ordered officer IDs for a search"""
+        return self._lookup(kind, department_id, search_key, compute)
+
+    def count(self, kind, department_id, compute):
+        """Return a count over a department, from ``compute`` on a miss"""
+        return self._lookup(kind, department_id, (),
+                            lambda: [compute()])[0]
+
+    def _lookup(self, kind, department_id, search_key, compute):
+        backend = self.backend
+        if backend is None:
+            return compute()
+        generations = backend.generations(
+            ['epoch', _department_generation(department_id)])
+        key = json.dumps([kind, department_id, generations,
+                          list(search_key)])
+        values = backend.get_ids(key)
+        if values is None:
+            values = array('l', compute())
+            backend.set_ids(key, values)
+        return values
+
+    def invalidate(self, department_ids):
+        """Drop cached results for searches of the given departments"""
+        backend = self.backend
+        if backend is None:
+            return
+        names = set(_department_generation(department_id)
+                    for department_id in department_ids)
+        # Searches across all departments depend on every department
+        names.add(_department_generation(None))
+        backend.bump(sorted(names))
+
+    def invalidate_all(self):
+        backend = self.backend
+        if backend is not None:
+            backend.bump(['epoch'])
+
+
+def mark_department_changed(session, department_id):
+    """Invalidate a department's cached searches once ``session`` commits"""
+    session.info.setdefault(SESSION_KEY, set()).add(department_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    department_ids = session.info.pop(SESSION_KEY, None)
+    if department_ids and has_app_context():
+        SearchCache().invalidate(department_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop(SESSION_KEY, None)
@@ -14,6 +14,50 @@ class BaseConfig(object):
     # pagination
     OFFICERS_PER_PAGE = os.environ.get('OFFICERS_PER_PAGE', 20)
     USERS_PER_PAGE = os.environ.get('USERS_PER_PAGE', 20)
+    # 'offset' for numbered gallery pages, 'keyset' for cursor links whose
+    # cost does not grow with the page number
+    GALLERY_PAGINATION = os.environ.get('GALLERY_PAGINATION', 'offset')
+
+    # Cache of the officer IDs each offset-paginated search returns, in
+    # entries per process; 0 disables it. Set SEARCH_CACHE_REDIS_URL to
+    # share results and invalidations between workers.
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 256))
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 300))
+    SEARCH_CACHE_REDIS_URL = os.environ.get('SEARCH_CACHE_REDIS_URL')
+
+    # 'sql' runs gallery searches in the database; 'snapshot' filters an
+    # in-memory NumPy copy of officer_search instead (needs numpy). The
+    # copy fetches changed rows every SNAPSHOT_REFRESH_INTERVAL seconds
+    # and is rebuilt in full every SNAPSHOT_REBUILD_INTERVAL seconds.
+    SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE', 'sql')
+    SNAPSHOT_REFRESH_INTERVAL = int(
+        os.environ.get('SNAPSHOT_REFRESH_INTERVAL', 5))
+    SNAPSHOT_REBUILD_INTERVAL = int(
+        os.environ.get('SNAPSHOT_REBUILD_INTERVAL', 3600))
+
+    # Most officers one request to the streaming search API may return
+    SEARCH_STREAM_LIMIT = int(os.environ.get('SEARCH_STREAM_LIMIT', 10000))
+
+    # How long a volunteer keeps an image to sort or tag before it goes
+    # back into the queue for someone else
+    IMAGE_LEASE_SECONDS = int(os.environ.get('IMAGE_LEASE_SECONDS', 600))
+    # Images leased ahead to each volunteer, so pages can preload the next
+    # one and most page loads don't have to pick new images
+    WORK_BUFFER_SIZE = int(os.environ.get('WORK_BUFFER_SIZE', 3))
+    # 'random' hands out waiting images in random order, 'priority' highest
+    # priority first. An image's priority adds PRIORITY_CAMPAIGN_WEIGHT
+    # times the log of its department's campaign weight and
+    # PRIORITY_FACE_WEIGHT times its face score, and loses
+    # PRIORITY_AGE_WEIGHT for every day it was uploaded after others.
+    WORK_SCHEDULER = os.environ.get('WORK_SCHEDULER', 'random')
+    PRIORITY_CAMPAIGN_WEIGHT = float(
+        os.environ.get('PRIORITY_CAMPAIGN_WEIGHT', 30))
+    PRIORITY_FACE_WEIGHT = float(os.environ.get('PRIORITY_FACE_WEIGHT', 5))
+    PRIORITY_AGE_WEIGHT = float(os.environ.get('PRIORITY_AGE_WEIGHT', 1))
+    # Most images one request to the batch sorting API may lease or classify
+    SORT_BATCH_LIMIT = int(os.environ.get('SORT_BATCH_LIMIT', 50))
+    # Most faces one request may tag in an image
+    FACE_BATCH_LIMIT = int(os.environ.get('FACE_BATCH_LIMIT', 50))
 
     # Form Settings
     WTF_CSRF_ENABLED = True
@@ -34,9 +78,50 @@ class BaseConfig(object):
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
     AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
     S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
+    # Each process shares one S3 client with a pool of this many
+    # connections, which should cover S3_MAX_CONCURRENCY parts for every
+    # upload that may run at once
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS',
+                                                 32))
+    # Images over S3_MULTIPART_THRESHOLD bytes are sent in parts of
+    # S3_MULTIPART_CHUNKSIZE bytes, S3_MAX_CONCURRENCY of them at a time
+    S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD',
+                                                8 * 1024 * 1024))
+    S3_MULTIPART_CHUNKSIZE = int(os.environ.get('S3_MULTIPART_CHUNKSIZE',
+                                                8 * 1024 * 1024))
+    S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', 4))
+
+    # 's3' stores uploaded images in S3_BUCKET_NAME, 'local' in
+    # IMAGE_STORAGE_PATH, served by the app (or a web server in front)
+    # under /images/
+    IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 's3')
+    IMAGE_STORAGE_PATH = os.environ.get(
+        'IMAGE_STORAGE_PATH', os.path.join(os.path.dirname(basedir),
+                                           'image_store'))
+
+    # Threads per process pushing uploads to IMAGE_STORAGE in the
+    # background; 0, the default, stores each upload before answering its
+    # request. Uploads wait in UPLOAD_STAGING_PATH, which must be set along
+    # with UPLOAD_WORKERS, until pushed. Any worker may push any staged
+    # upload, so enable them only where every process sees the same
+    # UPLOAD_STAGING_PATH, i.e. on a single host or a shared volume. A
+    # failed push is retried after UPLOAD_RETRY_SECONDS, twice as long
+    # after every further failure, until UPLOAD_MAX_ATTEMPTS pushes have
+    # failed. Idle workers look for retries every UPLOAD_POLL_SECONDS.
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 0))
+    UPLOAD_STAGING_PATH = os.environ.get('UPLOAD_STAGING_PATH')
+    UPLOAD_RETRY_SECONDS = int(os.environ.get('UPLOAD_RETRY_SECONDS', 5))
+    UPLOAD_MAX_ATTEMPTS = int(os.environ.get('UPLOAD_MAX_ATTEMPTS', 10))
+    UPLOAD_POLL_SECONDS = int(os.environ.get('UPLOAD_POLL_SECONDS', 30))
 
     # Upload Settings
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+    # Bytes of each uploaded file kept in memory before spilling to disk
+    UPLOAD_SPOOL_SIZE = int(os.environ.get('UPLOAD_SPOOL_SIZE', 512 * 1024))
+    # Image hashes each process's Bloom filter is sized for, so most new
+    # uploads skip the duplicate lookup; 0 disables it
+    UPLOAD_BLOOM_CAPACITY = int(os.environ.get('UPLOAD_BLOOM_CAPACITY',
+                                               1000000))
     ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 
     SEED = 666
@@ -57,6 +142,7 @@ class TestingConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
     NUM_OFFICERS = 120
+    SEARCH_CACHE_SIZE = 0
 
 
 class ProductionConfig(BaseConfig):
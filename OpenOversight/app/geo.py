@@ -0,0 +1,113 @@
+"""Geometry helpers for unit boundaries"""
+import json
+import math
+
+
+def parse_geometry(geometry):
+    """Parse a GeoJSON (Multi)Polygon into a list of polygons"""
+    if isinstance(geometry, basestring):
+        geometry = json.loads(geometry)
+    if not isinstance(geometry, dict):
+        raise ValueError('GeoJSON geometry must be an object')
+    if geometry.get('type') == 'Feature':
+        geometry = geometry.get('geometry') or {}
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry.get('coordinates')]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry.get('coordinates')
+    else:
+        raise ValueError('Boundary must be a Polygon or MultiPolygon')
+    try:
+        parsed = [[[(float(position[0]), float(position[1]))
+                    for position in ring] for ring in polygon]
+                  for polygon in polygons]
+    except (TypeError, IndexError, ValueError):
+        raise ValueError('Malformed GeoJSON coordinates')
+    for polygon in parsed:
+        if not polygon or any(len(ring) < 4 for ring in polygon):
+            raise ValueError('Polygon rings need at least four positions')
+    return parsed
+
+
+def bounding_box(polygons):
+    """``(min_lat, min_lng, max_lat, max_lng)`` of parsed polygons"""
+    positions = [position for polygon in polygons for position in polygon[0]]
+    longitudes = [lng for lng, _ in positions]
+    latitudes = [lat for _, lat in positions]
+    return (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+
+
+def _in_ring(ring, lat, lng):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > lat) != (y2 > lat):
+            if lng < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+
+def contains(polygons, lat, lng):
+    """Whether the point is inside any of the parsed polygons"""
+    for polygon in polygons:
+        if _in_ring(polygon[0], lat, lng) and \
+                not any(_in_ring(hole, lat, lng) for hole in polygon[1:]):
+            return True
+    return False
+
+
+def _box_contains(box, lat, lng):
+    return box[0] <= lat <= box[2] and box[1] <= lng <= box[3]
+
+
+def _union(boxes):
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+class RTree(object):
+    """Static R-tree of bounding boxes for point lookups"""
+
+    def __init__(self, entries, node_size=16):
+        self.node_size = node_size
+        # Nodes are (box, key, children) with children None for leaves
+        nodes = [(box, key, None) for key, box in entries]
+        while len(nodes) > node_size:
+            nodes = self._pack(nodes)
+        self.root = (_union([node[0] for node in nodes]), None, nodes) \
+            if nodes else None
+
+    def _pack(self, nodes):
+        size = self.node_size
+        parent_count = int(math.ceil(len(nodes) / float(size)))
+        slice_count = int(math.ceil(math.sqrt(parent_count)))
+        slice_length = slice_count * size
+
+        def center(index):
+            return lambda node: node[0][index] + node[0][index + 2]
+
+        nodes = sorted(nodes, key=center(0))
+        parents = []
+        for start in range(0, len(nodes), slice_length):
+            column = sorted(nodes[start:start + slice_length],
+                            key=center(1))
+            for group_start in range(0, len(column), size):
+                group = column[group_start:group_start + size]
+                parents.append((_union([node[0] for node in group]), None,
+                                group))
+        return parents
+
+    def search(self, lat, lng):
+        """Keys of the boxes containing the point"""
+        if self.root is None:
+            return []
+        keys = []
+        stack = [self.root]
+        while stack:
+            box, key, children = stack.pop()
+            if not _box_contains(box, lat, lng):
+                continue
+            if children is None:
+                keys.append(key)
+            else:
+                stack.extend(children)
+        return keys
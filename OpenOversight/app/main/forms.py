@@ -1,13 +1,15 @@
 from flask_wtf import FlaskForm as Form
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
-from wtforms import (StringField, DecimalField,
-                     SelectField, IntegerField, SubmitField)
+from wtforms import (StringField, DecimalField, BooleanField,
+                     SelectField, IntegerField, SubmitField, TextAreaField,
+                     ValidationError)
 from wtforms.fields.html5 import DateField
 
 from wtforms.validators import (DataRequired, AnyOf, NumberRange, Regexp,
                                 Length, Optional)
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 
+from ..geo import parse_geometry
 from ..utils import unit_choices, dept_choices
 from .choices import GENDER_CHOICES, RACE_CHOICES, RANK_CHOICES
 
@@ -30,6 +32,7 @@ class FindOfficerForm(Form):
         'name', default='', validators=[Regexp('\w*'), Length(max=50),
                                         Optional()]
     )
+    fuzzy = BooleanField('fuzzy', default=False)
     badge = StringField('badge', default='', validators=[Regexp('\w*'),
                                                          Length(max=10)])
     dept = QuerySelectField('dept', validators=[DataRequired()],
@@ -46,11 +49,11 @@ class FindOfficerForm(Form):
     max_age = IntegerField('max_age', default=85, validators=[
         NumberRange(min=16, max=100)
     ])
-    latitude = DecimalField('latitude', default=False, validators=[
-        NumberRange(min=-90, max=90)
+    latitude = DecimalField('latitude', places=None, validators=[
+        Optional(), NumberRange(min=-90, max=90)
     ])
-    longitude = DecimalField('longitude', default=False, validators=[
-        NumberRange(min=-180, max=180)
+    longitude = DecimalField('longitude', places=None, validators=[
+        Optional(), NumberRange(min=-180, max=180)
     ])
 
 
@@ -60,6 +63,7 @@ class FindOfficerIDForm(Form):
             Regexp('\w*'), Length(max=50), Optional()
         ]
     )
+    fuzzy = BooleanField('fuzzy', default=False)
     badge = StringField(
         'badge', default='', validators=[Regexp('\w*'), Length(max=10)]
     )
@@ -151,4 +155,12 @@ class AddUnitForm(Form):
     descrip = StringField('Unit name or description', default='', validators=[
         Regexp('\w*'), Length(max=120), DataRequired()])
     department = QuerySelectField('Department', validators=[Optional()], get_label='name')
+    boundary = TextAreaField('Area covered, as a GeoJSON polygon (optional)',
+                             validators=[Optional()])
     submit = SubmitField(label='Add')
+
+    def validate_boundary(self, field):
+        try:
+            parse_geometry(field.data)
+        except ValueError as e:
+            raise ValidationError(str(e))
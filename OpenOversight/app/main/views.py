@@ -1,41 +1,96 @@
 import datetime
-import os
+from itsdangerous import BadData
+import json
 import re
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 import sys
-import tempfile
 from traceback import format_exc
 from werkzeug import secure_filename
 
 from flask import (abort, render_template, request, redirect, url_for,
-                   flash, current_app, jsonify, Markup)
+                   flash, current_app, jsonify, Markup, Response,
+                   send_from_directory, stream_with_context)
 from flask_login import current_user, login_required, login_user
 
 from . import main
-from .. import limiter
-from ..utils import (grab_officers, roster_lookup, upload_file, compute_hash,
-                     serve_image, compute_leaderboard_stats, get_random_image,
+from .. import limiter, search_cache, uploaded_hashes
+from ..utils import (grab_officers, roster_lookup, upload_fileobj,
+                     serve_image, compute_leaderboard_stats,
                      allowed_file, add_new_assignment, edit_existing_assignment,
                      add_officer_profile, edit_officer_profile,
-                     ac_can_edit_officer, add_department_query, add_unit_query)
+                     ac_can_edit_officer, add_department_query, add_unit_query,
+                     keyset_paginate, officer_has_face,
+                     preload_officer_details, update_officer_search,
+                     search_cache_key, ordered_officer_ids,
+                     paginate_officer_ids, fuzzy_officer_ids,
+                     fetch_ahead_paginate, estimate_count,
+                     department_officer_count, officer_stream_query,
+                     encode_stream_cursor, decode_stream_cursor,
+                     facet_counts, add_face_tags,
+                     Stopwatch)
+from .choices import GENDER_CHOICES, RACE_CHOICES, RANK_CHOICES
 from .forms import (FindOfficerForm, FindOfficerIDForm, AddUnitForm,
                     FaceTag, AssignmentForm, DepartmentForm, AddOfficerForm,
                     EditOfficerForm)
+from ..snapshot import officer_snapshot
+from ..upload_queue import (AVAILABLE, PENDING, PUSH_LEASE_SECONDS,
+                            release_abandoned, stage_upload, unstage_upload,
+                            upload_queue)
+from ..uploads import file_hash
+from ..work_queue import (SORT, TAG, buffered_images, claim_images,
+                          classify_images, queue_metrics, release_image,
+                          release_leases)
 from ..models import (db, Image, User, Face, Officer, Assignment, Department,
-                      Unit)
+                      Unit, OfficerSearch, badge_digits)
 
 from ..auth.forms import LoginForm
 from ..auth.utils import admin_required, ac_or_admin_required
 
-# Ensure the file is read/write by the creator only
-SAVED_UMASK = os.umask(0o077)
-
 
 def redirect_url(default='index'):
     return request.args.get('next') or request.referrer or url_for(default)
 
 
+def paginate_officers(lookup, form_data, page, has_face):
+    """Paginate a gallery search in the configured GALLERY_PAGINATION mode"""
+    OFFICERS_PER_PAGE = int(current_app.config['OFFICERS_PER_PAGE'])
+    if lookup is grab_officers and officer_snapshot.supports(form_data):
+        return paginate_officer_ids(officer_snapshot.officer_ids(form_data),
+                                    page, OFFICERS_PER_PAGE)
+    if form_data.get('fuzzy') and form_data.get('name'):
+        # Fuzzy matches are ranked by spelling, so page through their IDs
+        def compute():
+            return fuzzy_officer_ids(lookup(form_data, sort=False),
+                                     form_data['name'])
+    # Badge searches rank their results, which keyset pages can't follow
+    elif current_app.config['GALLERY_PAGINATION'] == 'keyset' and \
+            not badge_digits(form_data.get('badge')):
+        try:
+            return keyset_paginate(lookup(form_data, sort=False),
+                                   has_face, Officer.id,
+                                   OFFICERS_PER_PAGE,
+                                   request.args.get('cursor'))
+        except BadData:
+            abort(400)
+    elif search_cache.enabled:
+        def compute():
+            return ordered_officer_ids(lookup(form_data))
+    else:
+        query = lookup(form_data)
+        dept = form_data['dept']
+
+        def estimate():
+            return estimate_count(query) or \
+                (department_officer_count(dept.id) if dept else None)
+        return fetch_ahead_paginate(query, page, OFFICERS_PER_PAGE, estimate)
+    dept = form_data['dept']
+    officer_ids = search_cache.officer_ids(
+        lookup.__name__, dept.id if dept else None,
+        search_cache_key(form_data), compute)
+    return paginate_officer_ids(officer_ids, page, OFFICERS_PER_PAGE)
+
+
 @main.route('/')
 @main.route('/index')
 def index():
@@ -80,16 +135,22 @@ def get_started_labeling():
 @main.route('/sort/department/<int:department_id>', methods=['GET', 'POST'])
 @login_required
 def sort_images(department_id):
-    # Select a random unsorted image from the database
-    image_query = Image.query.filter_by(contains_cops=None) \
-                             .filter_by(department_id=department_id)
-    image = get_random_image(image_query)
+    # Hand a skipped image back before leasing the next one
+    skipped = request.args.get('skip', type=int)
+    if skipped:
+        release_leases([skipped], current_user.id)
+    # Take the next of the unsorted images leased to the user, and the one
+    # after it for the page to preload
+    image, next_image = (buffered_images(SORT, current_user.id,
+                                         department_id) + [None, None])[:2]
 
     if image:
         proper_path = serve_image(image.filepath)
     else:
         proper_path = None
+    next_path = serve_image(next_image.filepath) if next_image else None
     return render_template('sort.html', image=image, path=proper_path,
+                           next_image=next_image, next_path=next_path,
                            department_id=department_id)
 
 
@@ -237,6 +298,7 @@ def classify_submission(image_id, contains_cops):
             image.contains_cops = True
         elif contains_cops == 0:
             image.contains_cops = False
+        release_image(image)
         db.session.commit()
         flash('Updated image classification')
     except:  # noqa
@@ -250,6 +312,53 @@ def classify_submission(image_id, contains_cops):
     # return redirect(url_for('main.display_submission', image_id=image_id))
 
 
+@main.route('/sort/department/<int:department_id>/images', methods=['GET'])
+@login_required
+def sort_batch(department_id):
+    """Lease a batch of images to sort, as JSON"""
+    if current_user.is_disabled:
+        abort(403)
+    try:
+        count = int(request.args.get('count', 10))
+    except ValueError:
+        abort(400)
+    if count < 1:
+        abort(400)
+    count = min(count, current_app.config['SORT_BATCH_LIMIT'])
+    images = claim_images(SORT, current_user.id, department_id, count)
+    return jsonify(images=[{'id': image.id,
+                            'url': serve_image(image.filepath)}
+                           for image in images])
+
+
+@main.route('/sort/classify', methods=['POST'])
+@login_required
+def classify_batch():
+    """Classify many images in one request"""
+    if current_user.is_disabled:
+        abort(403)
+    body = request.get_json(silent=True) or {}
+    classifications = body.get('classifications', {})
+    skipped = body.get('skipped', [])
+    limit = current_app.config['SORT_BATCH_LIMIT']
+    if not isinstance(classifications, dict) or \
+            not isinstance(skipped, list) or \
+            len(classifications) + len(skipped) > limit or \
+            not all(isinstance(value, bool)
+                    for value in classifications.values()):
+        abort(400)
+    try:
+        classifications = dict((int(image_id), value)
+                               for image_id, value in classifications.items())
+        skipped = [int(image_id) for image_id in skipped]
+    except (TypeError, ValueError):
+        abort(400)
+    release_leases(skipped, current_user.id)
+    classified = classify_images(classifications, current_user.id)
+    db.session.commit()
+    return jsonify(classified=classified)
+
+
 @main.route('/department/new', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -287,9 +396,12 @@ def list_officer(department_id, page=1, from_search=False):
     if not department:
         abort(404)
 
-    officers = Officer.query.filter(Officer.department_id == department_id) \
-        .order_by(Officer.last_name) \
-        .paginate(page, OFFICERS_PER_PAGE, False)
+    officers = fetch_ahead_paginate(
+        Officer.query.filter(Officer.department_id == department_id)
+        .order_by(Officer.last_name),
+        page, OFFICERS_PER_PAGE,
+        lambda: department_officer_count(department_id))
+    preload_officer_details(officers.items)
     return render_template(
         'list_officer.html',
         department=department,
@@ -342,7 +454,8 @@ def add_unit():
     add_department_query(form, current_user)
     if form.validate_on_submit():
         unit = Unit(descrip=form.descrip.data,
-                    department_id=form.department.data.id)
+                    department_id=form.department.data.id,
+                    boundary=form.boundary.data)
         db.session.add(unit)
         db.session.commit()
         flash('New unit {} added to OpenOversight'.format(unit.descrip))
@@ -366,7 +479,9 @@ def delete_tag(tag_id):
             abort(403)
 
     try:
+        officer = tag.officer
         db.session.delete(tag)
+        update_officer_search(officer)
         db.session.commit()
         flash('Deleted this tag')
     except:  # noqa
@@ -387,6 +502,17 @@ def leaderboard():
                            top_taggers=top_taggers)
 
 
+@main.route('/queue/metrics')
+@login_required
+@admin_required
+def work_queue_metrics():
+    """Sorting and tagging queue depth and lease churn per department"""
+    metrics = queue_metrics()
+    return jsonify(departments=[dict(department_id=department_id, **counts)
+                                for department_id, counts
+                                in sorted(metrics.items())])
+
+
 @main.route('/cop_face/department/<int:department_id>/image/<int:image_id>',
             methods=['GET', 'POST'])
 @main.route('/cop_face/image/<int:image_id>', methods=['GET', 'POST'])
@@ -394,47 +520,41 @@ def leaderboard():
 @main.route('/cop_face/', methods=['GET', 'POST'])
 @login_required
 def label_data(department_id=None, image_id=None):
+    next_image = None
     if department_id:
         department = Department.query.filter_by(id=department_id).one()
         if image_id:
             image = Image.query.filter_by(id=image_id) \
                                .filter_by(department_id=department_id).one()
-        else:  # Get a random image from that department
-            image_query = Image.query.filter_by(contains_cops=True) \
-                               .filter_by(department_id=department_id) \
-                               .filter_by(is_tagged=False)
-            image = get_random_image(image_query)
+        else:  # Take the next untagged image leased from that department
+            image, next_image = (buffered_images(
+                TAG, current_user.id, department_id) + [None, None])[:2]
     else:
         department = None
         if image_id:
             image = Image.query.filter_by(id=image_id).one()
-        else:  # Select a random untagged image from the entire database
-            image_query = Image.query.filter_by(contains_cops=True) \
-                               .filter_by(is_tagged=False)
-            image = get_random_image(image_query)
+        else:  # Take the next untagged image leased from any department
+            image, next_image = (buffered_images(
+                TAG, current_user.id) + [None, None])[:2]
 
     if image:
         proper_path = serve_image(image.filepath)
     else:
         proper_path = None
+    next_path = serve_image(next_image.filepath) if next_image else None
 
     form = FaceTag()
     if form.validate_on_submit():
-        officer_exists = Officer.query.filter_by(id=form.officer_id.data).first()
-        existing_tag = db.session.query(Face) \
-                         .filter(Face.officer_id == form.officer_id.data) \
-                         .filter(Face.img_id == form.image_id.data).first()
-        if not officer_exists:
+        result, = add_face_tags(form.image_id.data,
+                                [{'officer_id': form.officer_id.data,
+                                  'x': form.dataX.data,
+                                  'y': form.dataY.data,
+                                  'width': form.dataWidth.data,
+                                  'height': form.dataHeight.data}],
+                                current_user.id)
+        if result['status'] == 'invalid_officer':
             flash('Invalid officer ID. Please select a valid OpenOversight ID!')
-        elif not existing_tag:
-            new_tag = Face(officer_id=form.officer_id.data,
-                           img_id=form.image_id.data,
-                           face_position_x=form.dataX.data,
-                           face_position_y=form.dataY.data,
-                           face_width=form.dataWidth.data,
-                           face_height=form.dataHeight.data,
-                           user_id=current_user.id)
-            db.session.add(new_tag)
+        elif result['status'] == 'created':
             db.session.commit()
             flash('Tag added to database')
         else:
@@ -442,7 +562,31 @@ def label_data(department_id=None, image_id=None):
 
     return render_template('cop_face.html', form=form,
                            image=image, path=proper_path,
-                           department=department)
+                           next_path=next_path, department=department)
+
+
+@main.route('/cop_face/image/<int:image_id>/faces', methods=['POST'])
+@login_required
+def tag_faces(image_id):
+    """Tag several officers in an image in one request"""
+    if current_user.is_disabled:
+        abort(403)
+    image = Image.query.filter_by(id=image_id).first()
+    if not image:
+        abort(404)
+    faces = (request.get_json(silent=True) or {}).get('faces')
+    if not isinstance(faces, list) or not faces or \
+            len(faces) > current_app.config['FACE_BATCH_LIMIT']:
+        abort(400)
+    try:
+        tags = [dict((field, int(face[field]))
+                     for field in ('officer_id', 'x', 'y', 'width', 'height'))
+                for face in faces]
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    results = add_face_tags(image.id, tags, current_user.id)
+    db.session.commit()
+    return jsonify(faces=results)
 
 
 @main.route('/image/tagged/<int:image_id>')
@@ -453,6 +597,7 @@ def complete_tagging(image_id):
     if not image:
         abort(404)
     image.is_tagged = True
+    release_image(image)
     db.session.commit()
     flash('Marked image as completed.')
     return redirect(url_for('main.label_data', department_id=request.args.get('department_id')))
@@ -463,9 +608,10 @@ def complete_tagging(image_id):
 def get_tagger_gallery(page=1):
     form = FindOfficerIDForm()
     if form.validate_on_submit():
-        OFFICERS_PER_PAGE = int(current_app.config['OFFICERS_PER_PAGE'])
         form_data = form.data
-        officers = roster_lookup(form_data).paginate(page, OFFICERS_PER_PAGE, False)
+        officers = paginate_officers(roster_lookup, form_data, page,
+                                     officer_has_face())
+        preload_officer_details(officers.items)
         return render_template('tagger_gallery.html',
                                officers=officers,
                                form=form,
@@ -479,9 +625,10 @@ def get_tagger_gallery(page=1):
 def get_gallery(page=1):
     form = FindOfficerForm()
     if form.validate_on_submit():
-        OFFICERS_PER_PAGE = int(current_app.config['OFFICERS_PER_PAGE'])
         form_data = form.data
-        officers = grab_officers(form_data).paginate(page, OFFICERS_PER_PAGE, False)
+        officers = paginate_officers(grab_officers, form_data, page,
+                                     OfficerSearch.has_face)
+        preload_officer_details(officers.items)
         # If no officers are found, go to a list of all department officers
         if not officers.items:
             return redirect(url_for(
@@ -498,6 +645,60 @@ def get_gallery(page=1):
         return redirect(url_for('main.get_officer'))
 
 
+def search_args_form():
+    """FindOfficerForm read from query parameters, filtering nothing unset"""
+    return FindOfficerForm(request.args, meta={'csrf': False},
+                           rank='Not Sure', race='Not Sure',
+                           gender='Not Sure')
+
+
+@main.route('/search/facets', methods=['GET'])
+def search_facets():
+    """Result counts for every race, gender and rank option"""
+    form = search_args_form()
+    if not form.validate():
+        return jsonify(errors=form.errors), 400
+    options = {'race': [value for value, _ in RACE_CHOICES],
+               'gender': [value for value, _ in GENDER_CHOICES],
+               'rank': [value for value, _ in RANK_CHOICES]}
+    return jsonify(**facet_counts(form.data, options))
+
+
+@main.route('/search/officers.ndjson', methods=['GET'])
+@limiter.limit('30/minute')
+def stream_officers():
+    """Stream officer search results as newline-delimited JSON"""
+    form = search_args_form()
+    if not form.validate():
+        return jsonify(errors=form.errors), 400
+    max_limit = current_app.config['SEARCH_STREAM_LIMIT']
+    try:
+        limit = min(int(request.args.get('limit', max_limit)), max_limit)
+        after_id = None
+        if request.args.get('cursor'):
+            after_id = decode_stream_cursor(request.args['cursor'])
+    except (ValueError, BadData):
+        abort(400)
+    if limit < 1:
+        abort(400)
+    query = officer_stream_query(form.data, after_id).limit(limit + 1)
+
+    def generate():
+        count = 0
+        last_id = None
+        for row in query.yield_per(500):
+            if count == limit:
+                yield json.dumps(
+                    {'next_cursor': encode_stream_cursor(last_id)}) + '\n'
+                break
+            count += 1
+            last_id = row.id
+            yield json.dumps(row._asdict()) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
 @main.route('/complaint', methods=['GET', 'POST'])
 def submit_complaint():
     return render_template('complaint.html',
@@ -540,47 +741,114 @@ def upload(department_id):
     if not allowed_file(file_to_upload.filename):
         return jsonify(error="File type not allowed!"), 415
     original_filename = secure_filename(file_to_upload.filename)
-    image_data = file_to_upload.read()
 
-    # See if there is a matching photo already in the db
-    hash_img = compute_hash(image_data)
-    hash_found = Image.query.filter_by(hash_img=hash_img).first()
-    if hash_found:
+    def already_uploaded():
         return jsonify(error="Image already uploaded to OpenOversight!"), 400
 
-    # Generate new filename
-    file_extension = original_filename.split('.')[-1]
-    new_filename = '{}.{}'.format(hash_img, file_extension)
-
-    # Save temporarily on local filesystem
-    tmpdir = tempfile.mkdtemp()
-    safe_local_path = os.path.join(tmpdir, new_filename)
-    with open(safe_local_path, 'w') as tmp:
-        tmp.write(image_data)
-    os.umask(SAVED_UMASK)
-
-    # Upload file from local filesystem to S3 bucket and delete locally
-    try:
-        url = upload_file(safe_local_path, original_filename,
-                          new_filename)
-        # Update the database to add the image
-        new_image = Image(filepath=url, hash_img=hash_img, is_tagged=False,
-                          date_image_inserted=datetime.datetime.now(),
-                          department_id=department_id,
-                          # TODO: Get the following field from exif data
-                          date_image_taken=datetime.datetime.now())
-        db.session.add(new_image)
-        db.session.commit()
-        return jsonify(success="Success!"), 200
-    except:  # noqa
+    def server_error():
         exception_type, value, full_tback = sys.exc_info()
-        current_app.logger.error('Error uploading to S3: {}'.format(
+        current_app.logger.error('Error uploading image: {}'.format(
             ' '.join([str(exception_type), str(value),
                       format_exc(full_tback)])
         ))
         return jsonify(error="Server error encountered. Try again later."), 500
-    os.remove(safe_local_path)
-    os.rmdir(tmpdir)
+
+    stopwatch = Stopwatch()
+    try:
+        # See if there is a matching photo already in the db, unless the
+        # Bloom filter knows it's new
+        hash_img = file_hash(file_to_upload.stream)
+        if uploaded_hashes.might_contain(hash_img):
+            existing = Image.query.filter_by(hash_img=hash_img).first()
+            # An upload that died before storing its file leaves its claim
+            # behind, which is given up once the lease runs out. A filter
+            # that missed it learns the hash from the unique index below,
+            # in time for the next try
+            if existing and not release_abandoned(existing.id):
+                return already_uploaded()
+        stopwatch.lap('dedup')
+
+        # Generate new filename
+        file_extension = original_filename.split('.')[-1]
+        new_filename = '{}.{}'.format(hash_img, file_extension)
+
+        # Claim the hash before storing anything, so that the unique index
+        # on hash_img turns away a duplicate the Bloom filter missed
+        # before the file is pushed. The lease keeps upload workers off the
+        # image until it is stored.
+        lease_until = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=PUSH_LEASE_SECONDS)
+        new_image = Image(hash_img=hash_img, is_tagged=False,
+                          date_image_inserted=datetime.datetime.now(),
+                          department_id=department_id,
+                          # TODO: Get the following field from exif data
+                          date_image_taken=datetime.datetime.now(),
+                          upload_state=PENDING, upload_retry_at=lease_until)
+        try:
+            db.session.add(new_image)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            # The unique index on hash_img stopped a concurrent duplicate
+            if 'hash_img' in str(e.orig):
+                uploaded_hashes.add(hash_img)
+                return already_uploaded()
+            return server_error()
+        except:  # noqa
+            return server_error()
+        image_id = new_image.id
+        uploaded_hashes.add(hash_img)
+        stopwatch.lap('db')
+
+        # Store the file straight from the spooled upload, or leave that
+        # to the upload workers
+        background = current_app.config['UPLOAD_WORKERS'] > 0
+        staged_path = None
+        try:
+            if background:
+                staged_path = stage_upload(file_to_upload.stream,
+                                           new_filename)
+                new_image.filepath = staged_path
+            else:
+                new_image.filepath = upload_fileobj(file_to_upload.stream,
+                                                    original_filename,
+                                                    new_filename)
+                new_image.upload_state = AVAILABLE
+            stopwatch.lap('stage' if background else 'store')
+            new_image.upload_retry_at = None
+            db.session.commit()
+        except:  # noqa
+            response = server_error()
+            # Give the hash back so the image can be uploaded again
+            try:
+                if not db.session.is_active:
+                    db.session.rollback()
+                Image.query.filter_by(id=image_id) \
+                           .delete(synchronize_session=False)
+                db.session.commit()
+            except:  # noqa
+                current_app.logger.exception(
+                    'Could not give back the hash of image {}'.format(
+                        image_id))
+            if staged_path:
+                unstage_upload(staged_path)
+            return response
+        if background:
+            upload_queue.notify()
+        response = jsonify(success="Success!")
+        response.headers['Server-Timing'] = stopwatch.server_timing()
+        return response, 200
+    finally:
+        # Deletes the spooled upload if it went to disk
+        file_to_upload.close()
+
+
+@main.route('/images/<path:path>')
+@limiter.exempt
+def stored_image(path):
+    # Stored by content, so an image at a path never changes
+    return send_from_directory(current_app.config['IMAGE_STORAGE_PATH'],
+                               path, cache_timeout=365 * 24 * 60 * 60)
 
 
 @main.route('/about')
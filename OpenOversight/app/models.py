@@ -1,20 +1,46 @@
+import random
+import re
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import DDL, Index, UniqueConstraint, event
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import BadSignature, BadData
 from flask_login import UserMixin
 from flask import current_app
 from . import login_manager
+from .geo import bounding_box, parse_geometry
+from .storage import image_url
 
 db = SQLAlchemy()
 
+# The trigram indexes on officer names need pg_trgm, so make sure it exists
+# whenever the schema is created directly with db.create_all()
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+             .execute_if(dialect='postgresql'))
+# Fuzzy name searches rank by levenshtein() from fuzzystrmatch
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS fuzzystrmatch')
+             .execute_if(dialect='postgresql'))
+
+
+def badge_digits(star_no):
+    """Digits of a badge number, e.g. ``'#04-17'`` becomes ``'0417'``"""
+    if star_no is None:
+        return None
+    return re.sub(r'\D', '', u'{}'.format(star_no)) or None
+
 
 class Department(db.Model):
     __tablename__ = 'departments'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), index=True, unique=True, nullable=False)
     short_name = db.Column(db.String(100), unique=False, nullable=False)
+    # How strongly to favor the department's images in the sorting and
+    # tagging queues, e.g. 2.0 during a labeling drive (see work_queue.py)
+    campaign_weight = db.Column(db.Float, default=1.0, server_default='1',
+                                nullable=False)
 
     def __repr__(self):
         return '<Department ID {}: {}>'.format(self.id, self.name)
@@ -36,6 +62,14 @@ class Officer(db.Model):
     department_id = db.Column(db.Integer, db.ForeignKey('departments.id'))
     department = db.relationship('Department', backref='officers')
 
+    # A GIN trigram index serves substring name searches (ILIKE '%...%')
+    # on Postgres, see name_filter() in utils.py
+    __table_args__ = (
+        Index('ix_officers_last_name_trgm', 'last_name',
+              postgresql_using='gin',
+              postgresql_ops={'last_name': 'gin_trgm_ops'}),
+    )
+
     def __repr__(self):
         return '<Officer ID {}: {} {} {}>'.format(self.id,
                                                   self.first_name,
@@ -43,6 +77,70 @@ class Officer(db.Model):
                                                   self.last_name)
 
 
+class OfficerSearch(db.Model):
+    """Flattened, searchable copy of each officer"""
+    __tablename__ = 'officer_search'
+
+    officer_id = db.Column(db.Integer, db.ForeignKey('officers.id'),
+                           primary_key=True)
+    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'))
+    # Names are stored upper-cased with punctuation removed
+    last_name = db.Column(db.String(120), unique=False)
+    first_name = db.Column(db.String(120), unique=False)
+    # Double Metaphone keys of the last name, for fuzzy name searches
+    last_name_metaphone = db.Column(db.String(16), unique=False,
+                                    nullable=True)
+    last_name_metaphone_alt = db.Column(db.String(16), unique=False,
+                                        nullable=True)
+    race = db.Column(db.String(120), unique=False)
+    gender = db.Column(db.String(120), unique=False)
+    birth_year = db.Column(db.Integer, unique=False, nullable=True)
+    # Rank, unit and badge of the officer's current assignment
+    rank_code = db.Column(db.String(120), unique=False, nullable=True)
+    unit_id = db.Column(db.Integer, db.ForeignKey('unit_types.id'),
+                        nullable=True)
+    star_no = db.Column(db.String(120), unique=False, nullable=True)
+    star_no_digits = db.Column(db.String(120), unique=False, nullable=True)
+    has_face = db.Column(db.Boolean, default=False, nullable=False)
+    # When the row last changed, in microseconds since the epoch, so that
+    # in-memory copies (see snapshot.py) can fetch just the changed rows
+    change_seq = db.Column(db.BigInteger, nullable=True)
+
+    officer = db.relationship('Officer',
+                              backref=db.backref('search', uselist=False))
+
+    __table_args__ = (
+        Index('ix_officer_search_department_order',
+              'department_id', 'has_face', 'officer_id'),
+        Index('ix_officer_search_department_demographics',
+              'department_id', 'race', 'gender', 'rank_code'),
+        Index('ix_officer_search_birth_year', 'birth_year'),
+        Index('ix_officer_search_change_seq', 'change_seq'),
+        Index('ix_officer_search_department_unit', 'department_id',
+              'unit_id'),
+        Index('ix_officer_search_star_no', 'star_no'),
+        # Exact and prefix badge lookups within a department; the pattern
+        # ops let Postgres use the index for LIKE 'prefix%' in any locale
+        Index('ix_officer_search_department_star_no_digits',
+              'department_id', 'star_no_digits',
+              postgresql_ops={'star_no_digits': 'varchar_pattern_ops'}),
+        Index('ix_officer_search_star_no_digits_trgm', 'star_no_digits',
+              postgresql_using='gin',
+              postgresql_ops={'star_no_digits': 'gin_trgm_ops'}),
+        Index('ix_officer_search_last_name_trgm', 'last_name',
+              postgresql_using='gin',
+              postgresql_ops={'last_name': 'gin_trgm_ops'}),
+        Index('ix_officer_search_department_metaphone',
+              'department_id', 'last_name_metaphone'),
+        Index('ix_officer_search_department_metaphone_alt',
+              'department_id', 'last_name_metaphone_alt'),
+    )
+
+    def __repr__(self):
+        return '<OfficerSearch ID {}: {}>'.format(self.officer_id,
+                                                  self.last_name)
+
+
 class Assignment(db.Model):
     __tablename__ = 'assignments'
 
@@ -50,16 +148,62 @@ class Assignment(db.Model):
     officer_id = db.Column(db.Integer, db.ForeignKey('officers.id'))
     baseofficer = db.relationship('Officer')
     star_no = db.Column(db.String(120), index=True, unique=False)
+    # Kept in step with star_no by _set_star_no_digits below
+    star_no_digits = db.Column(db.String(120), unique=False, nullable=True)
     rank = db.Column(db.String(120), index=True, unique=False)
+    # Code from choices.RANK_CHOICES that rank normalizes to
+    rank_code = db.Column(db.String(120), index=True, unique=False,
+                          nullable=True)
     unit = db.Column(db.Integer, db.ForeignKey('unit_types.id'), nullable=True)
     star_date = db.Column(db.DateTime, index=True, unique=False, nullable=True)
     resign_date = db.Column(db.DateTime, index=True, unique=False, nullable=True)
 
+    __table_args__ = (
+        Index('ix_assignments_star_no_digits', 'star_no_digits',
+              postgresql_ops={'star_no_digits': 'varchar_pattern_ops'}),
+        Index('ix_assignments_star_no_digits_trgm', 'star_no_digits',
+              postgresql_using='gin',
+              postgresql_ops={'star_no_digits': 'gin_trgm_ops'}),
+    )
+
+    @validates('star_no')
+    def _set_star_no_digits(self, key, star_no):
+        self.star_no_digits = badge_digits(star_no)
+        return star_no
+
     def __repr__(self):
         return '<Assignment: ID {} : {}>'.format(self.officer_id,
                                                  self.star_no)
 
 
+class RankNormalization(db.Model):
+    """Maps a raw rank string onto a code from choices.RANK_CHOICES"""
+    __tablename__ = 'rank_normalizations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'),
+                              nullable=True)
+    department = db.relationship('Department',
+                                 backref='rank_normalizations')
+    # Stored stripped and upper-cased
+    raw_rank = db.Column(db.String(120), unique=False, nullable=False)
+    rank_code = db.Column(db.String(120), unique=False, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('department_id', 'raw_rank',
+                         name='unique_rank_normalizations'),
+        # NULLs never collide in the constraint above, so default mappings
+        # need an index of their own
+        Index('unique_rank_normalizations_default', 'raw_rank', unique=True,
+              postgresql_where=db.text('department_id IS NULL'),
+              sqlite_where=db.text('department_id IS NULL')),
+    )
+
+    def __repr__(self):
+        return '<RankNormalization {} => {}>'.format(
+            self.raw_rank, self.rank_code)
+
+
 class Unit(db.Model):
     __tablename__ = 'unit_types'
 
@@ -67,6 +211,27 @@ class Unit(db.Model):
     descrip = db.Column(db.String(120), index=True, unique=False)
     department_id = db.Column(db.Integer, db.ForeignKey('departments.id'))
     department = db.relationship('Department', backref='unit_types')
+    # GeoJSON (Multi)Polygon of the area the unit covers, if known, and its
+    # bounding box, kept in step by _set_bounding_box below
+    boundary = db.Column(db.Text, nullable=True)
+    min_latitude = db.Column(db.Float, nullable=True)
+    min_longitude = db.Column(db.Float, nullable=True)
+    max_latitude = db.Column(db.Float, nullable=True)
+    max_longitude = db.Column(db.Float, nullable=True)
+
+    __table_args__ = (
+        Index('ix_unit_types_bounding_box', 'min_latitude', 'max_latitude',
+              'min_longitude', 'max_longitude'),
+    )
+
+    @validates('boundary')
+    def _set_bounding_box(self, key, boundary):
+        box = (None, None, None, None)
+        if boundary:
+            box = bounding_box(parse_geometry(boundary))
+        (self.min_latitude, self.min_longitude,
+         self.max_latitude, self.max_longitude) = box
+        return boundary or None
 
     def __repr__(self):
         return 'Unit: {}'.format(self.descrip)
@@ -98,7 +263,8 @@ class Image(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     filepath = db.Column(db.String(255), unique=False)
-    hash_img = db.Column(db.String(120), unique=False, nullable=True)
+    hash_img = db.Column(db.String(120), index=True, unique=True,
+                         nullable=True)
 
     # Track when the image was put into our database
     date_image_inserted = db.Column(db.DateTime, index=True, unique=False, nullable=True)
@@ -108,12 +274,68 @@ class Image(db.Model):
     contains_cops = db.Column(db.Boolean, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
 
-    user = db.relationship('User', backref='raw_images')
+    user = db.relationship('User', backref='raw_images',
+                           foreign_keys=[user_id])
     is_tagged = db.Column(db.Boolean, default=False, unique=False, nullable=True)
 
     department_id = db.Column(db.Integer, db.ForeignKey('departments.id'))
     department = db.relationship('Department', backref='raw_images')
 
+    # Uniformly distributed in [0, 1), so a random image is the first one
+    # at or after a random point (see get_random_image in utils.py)
+    random_key = db.Column(db.Float, default=random.random, nullable=True)
+
+    # The volunteer currently sorting or tagging the image, until the lease
+    # expires (see work_queue.py), and how many leases it has been through
+    leased_by = db.Column(db.Integer, db.ForeignKey('users.id'), index=True,
+                          nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    lease_count = db.Column(db.Integer, default=0, server_default='0',
+                            nullable=False)
+
+    # Expected number of faces, if an image has been scored beforehand, and
+    # the image's place in the queues, highest first (see work_queue.py).
+    # Images inserted without a priority go last
+    face_score = db.Column(db.Float, nullable=True)
+    priority = db.Column(db.Float, server_default='-1e300', nullable=False)
+
+    # 'pending' while the upload waits in staging to be pushed to storage
+    # and 'available' once it has been, or 'failed' after running out of
+    # retries (see upload_queue.py)
+    upload_state = db.Column(db.String(16), default='available',
+                             server_default='available', nullable=False)
+    upload_attempts = db.Column(db.Integer, default=0, server_default='0',
+                                nullable=False)
+    upload_retry_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Images waiting to be sorted, per department
+        Index('ix_raw_images_unsorted_random_key', 'department_id',
+              'random_key', postgresql_where=db.text('contains_cops IS NULL')),
+        # Images of officers waiting to be tagged, per department or overall
+        Index('ix_raw_images_department_untagged_random_key',
+              'department_id', 'contains_cops', 'is_tagged', 'random_key'),
+        Index('ix_raw_images_untagged_random_key', 'random_key',
+              postgresql_where=db.text('contains_cops AND NOT is_tagged')),
+        # The same queues in next_images() order
+        Index('ix_raw_images_unsorted_priority', 'department_id',
+              priority.desc(), 'id',
+              postgresql_where=db.text('contains_cops IS NULL')),
+        Index('ix_raw_images_department_untagged_priority',
+              'department_id', 'contains_cops', 'is_tagged',
+              priority.desc(), 'id'),
+        Index('ix_raw_images_untagged_priority', priority.desc(), 'id',
+              postgresql_where=db.text('contains_cops AND NOT is_tagged')),
+        # Uploads waiting to be pushed to storage
+        Index('ix_raw_images_pending_upload_retry_at', 'upload_retry_at',
+              postgresql_where=db.text("upload_state = 'pending'")),
+    )
+
+    @property
+    def url(self):
+        """URL the image is viewed at, whichever storage holds it"""
+        return image_url(self.filepath)
+
     def __repr__(self):
         return '<Image ID {}: {}>'.format(self.id, self.filepath)
 
@@ -132,7 +354,8 @@ class User(UserMixin, db.Model):
     is_disabled = db.Column(db.Boolean, default=False)
     dept_pref = db.Column(db.Integer, db.ForeignKey('departments.id'))
     dept_pref_rel = db.relationship('Department', foreign_keys=[dept_pref])
-    classifications = db.relationship('Image', backref='users')
+    classifications = db.relationship('Image', backref='users',
+                                      foreign_keys='Image.user_id')
     tags = db.relationship('Face', backref='users')
 
     @property
@@ -0,0 +1,277 @@
+"""In-memory columnar copy of officer_search for gallery searches"""
+import datetime
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from flask import current_app
+
+from .models import OfficerSearch, badge_digits, db
+from .utils import (RANK_CODES, SEARCHABLE_RACES, form_location,
+                    normalize_name, units_covering)
+
+# Rows are fetched again if they changed up to this long (in microseconds)
+# before the newest change seen, so that a transaction committing after a
+# later one is not missed
+CHANGE_OVERLAP = 60 * 1000000
+
+COLUMNS = (OfficerSearch.officer_id, OfficerSearch.department_id,
+           OfficerSearch.last_name, OfficerSearch.race, OfficerSearch.gender,
+           OfficerSearch.birth_year, OfficerSearch.rank_code,
+           OfficerSearch.unit_id, OfficerSearch.star_no,
+           OfficerSearch.star_no_digits, OfficerSearch.has_face,
+           OfficerSearch.change_seq)
+
+
+# Column name and dtype of each array of DepartmentColumns
+ARRAYS = (('ids', 'int64'), ('last_name', numpy.unicode_ if numpy else None),
+          ('race', 'int32'), ('gender', 'int32'), ('rank', 'int32'),
+          ('birth_year', 'int32'), ('unit_id', 'int64'),
+          ('star_no', numpy.unicode_ if numpy else None),
+          ('star_no_digits', numpy.unicode_ if numpy else None),
+          ('has_face', bool))
+
+
+def _row_values(row, codes):
+    """Values of an officer_search row as they are kept in the arrays"""
+    def encode(value):
+        if value is None:
+            return -1
+        return codes.setdefault(value, len(codes))
+
+    def number(value):
+        return -1 if value is None else value
+
+    return {'ids': row.officer_id, 'last_name': row.last_name or u'',
+            'race': encode(row.race), 'gender': encode(row.gender),
+            'rank': encode(row.rank_code),
+            'birth_year': number(row.birth_year),
+            'unit_id': number(row.unit_id), 'star_no': row.star_no or u'',
+            'star_no_digits': row.star_no_digits or u'',
+            'has_face': bool(row.has_face)}
+
+
+def _column_arrays(rows, codes):
+    values = [_row_values(row, codes) for row in rows]
+    return dict((name, numpy.array([value[name] for value in values],
+                                   dtype=dtype))
+                for name, dtype in ARRAYS)
+
+
+class DepartmentColumns(object):
+    """officer_search rows of one department, one array per column"""
+
+    def __init__(self, arrays):
+        for name, _ in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.position = dict((officer_id, i) for i, officer_id
+                             in enumerate(self.ids.tolist()))
+
+    @classmethod
+    def from_rows(cls, rows, codes):
+        return cls(_column_arrays(rows, codes))
+
+    def patch(self, rows, removed_ids, codes):
+        """A copy with ``rows`` added or updated and ``removed_ids`` gone"""
+        arrays = dict((name, getattr(self, name).copy())
+                      for name, _ in ARRAYS)
+        added = []
+        for row in rows:
+            i = self.position.get(row.officer_id)
+            if i is None:
+                added.append(row)
+                continue
+            for name, value in _row_values(row, codes).items():
+                array = arrays[name]
+                # Fixed-width strings have to grow to fit a longer value
+                if array.dtype.kind == 'U' and \
+                        len(value) > array.dtype.itemsize // 4:
+                    array = arrays[name] = array.astype(
+                        (numpy.unicode_, len(value)))
+                array[i] = value
+        dropped = [self.position[officer_id] for officer_id in removed_ids
+                   if officer_id in self.position]
+        if dropped:
+            arrays = dict((name, numpy.delete(array, dropped))
+                          for name, array in arrays.items())
+        if added:
+            extra = _column_arrays(added, codes)
+            arrays = dict((name, numpy.concatenate([array, extra[name]]))
+                          for name, array in arrays.items())
+        return DepartmentColumns(arrays)
+
+
+class SnapshotState(object):
+    """What searches read, swapped in whole so they never mix versions"""
+
+    def __init__(self, departments, codes):
+        self.departments = departments
+        self.codes = codes
+
+
+class Snapshot(object):
+    """All departments' columns plus the bookkeeping to keep them fresh"""
+
+    def __init__(self):
+        self.state = SnapshotState({}, {})
+        self.department_of = {}
+        self.last_seq = 0
+        self.refreshed_at = 0
+        self.rebuilt_at = 0
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        grouped = {}
+        department_of = {}
+        last_seq = 0
+        for row in db.session.query(*COLUMNS).yield_per(1000):
+            grouped.setdefault(row.department_id, []).append(row)
+            department_of[row.officer_id] = row.department_id
+            last_seq = max(last_seq, row.change_seq or 0)
+        codes = {}
+        departments = dict(
+            (department_id, DepartmentColumns.from_rows(rows, codes))
+            for department_id, rows in grouped.items())
+        self.state = SnapshotState(departments, codes)
+        self.department_of = department_of
+        self.last_seq = last_seq
+        self.refreshed_at = self.rebuilt_at = time.time()
+
+    def refresh(self):
+        changed = db.session.query(*COLUMNS).filter(
+            OfficerSearch.change_seq > self.last_seq - CHANGE_OVERLAP).all()
+        updated = {}
+        removed = {}
+        for row in changed:
+            previous = self.department_of.get(row.officer_id)
+            if previous is not None and previous != row.department_id:
+                removed.setdefault(previous, []).append(row.officer_id)
+            updated.setdefault(row.department_id, []).append(row)
+            self.department_of[row.officer_id] = row.department_id
+            self.last_seq = max(self.last_seq, row.change_seq or 0)
+        if changed:
+            # Only the changed rows are written, into copies of the arrays
+            # of the departments they touch
+            state = self.state
+            codes = dict(state.codes)
+            departments = dict(state.departments)
+            for department_id in set(updated) | set(removed):
+                rows = updated.get(department_id, [])
+                removed_ids = removed.get(department_id, [])
+                columns = departments.get(department_id)
+                if columns is None:
+                    departments[department_id] = \
+                        DepartmentColumns.from_rows(rows, codes)
+                else:
+                    departments[department_id] = columns.patch(
+                        rows, removed_ids, codes)
+            self.state = SnapshotState(departments, codes)
+        self.refreshed_at = time.time()
+
+    def ensure_fresh(self, refresh_interval, rebuild_interval):
+        now = time.time()
+        if now - self.refreshed_at < refresh_interval:
+            return
+        with self._lock:
+            if now - self.rebuilt_at >= rebuild_interval:
+                self.rebuild()
+            elif now - self.refreshed_at >= refresh_interval:
+                self.refresh()
+
+    def search(self, form):
+        """Officer IDs matching a FindOfficerForm, in gallery order"""
+        state = self.state
+        columns = state.departments.get(form['dept'].id)
+        if columns is None:
+            return []
+        mask = numpy.ones(len(columns.ids), dtype=bool)
+
+        name = normalize_name(form['name'])
+        if not name and (form['name'] or '').strip():
+            return []
+        if name:
+            mask &= numpy.char.find(columns.last_name, name) >= 0
+
+        current_year = datetime.datetime.now().year
+        min_birth_year = current_year - int(form['min_age'])
+        max_birth_year = current_year - int(form['max_age'])
+        in_age_range = columns.birth_year <= min_birth_year
+        in_age_range &= columns.birth_year >= max_birth_year
+        mask &= in_age_range | (columns.birth_year == -1)
+
+        digits = badge_digits(form['badge'])
+        if digits:
+            mask &= numpy.char.find(columns.star_no_digits, digits) >= 0
+        elif form['badge']:
+            mask &= numpy.char.find(columns.star_no, form['badge'].strip()) >= 0
+
+        # Same as search_base: officers in a unit covering the searched
+        # location, unless none of them match
+        location = form_location(form)
+        covering_units = units_covering(*location) if location else []
+        if covering_units:
+            nearby = mask & numpy.in1d(columns.unit_id, covering_units)
+            if nearby.any():
+                mask = nearby
+
+        if form['race'] in SEARCHABLE_RACES:
+            mask &= columns.race == state.codes.get(form['race'], -2)
+        if form['gender'] in ('M', 'F'):
+            mask &= columns.gender == state.codes.get(form['gender'], -2)
+        if form['rank'] == 'PO' or form['rank'] in RANK_CODES:
+            mask &= (columns.rank == state.codes.get(form['rank'], -2)) | \
+                (columns.rank == -1)
+
+        # Same order as filter_by_form: exact then prefix badge matches,
+        # then officers with tagged faces, newest first
+        matches = numpy.nonzero(mask)[0]
+        officer_ids = columns.ids[matches]
+        badge_rank = numpy.zeros(len(matches), dtype=numpy.int8)
+        if digits:
+            badge_rank[:] = 2
+            badge_rank[numpy.char.startswith(
+                columns.star_no_digits[matches], digits)] = 1
+            badge_rank[columns.star_no_digits[matches] == digits] = 0
+        order = numpy.lexsort((-officer_ids, ~columns.has_face[matches],
+                               badge_rank))
+        return officer_ids[order].tolist()
+
+
+class OfficerSnapshot(object):
+    """Flask extension serving gallery searches from a Snapshot"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        snapshot = None
+        if app.config.get('SEARCH_ENGINE') == 'snapshot':
+            if numpy is None:
+                app.logger.warning('numpy is not installed, running '
+                                   'searches in the database instead')
+            else:
+                snapshot = Snapshot()
+        app.extensions['officer_snapshot'] = snapshot
+
+    @property
+    def snapshot(self):
+        return current_app.extensions.get('officer_snapshot')
+
+    def supports(self, form):
+        """Whether the snapshot can answer a FindOfficerForm search"""
+        return self.snapshot is not None and bool(form.get('dept')) and \
+            not (form.get('fuzzy') and form.get('name'))
+
+    def officer_ids(self, form):
+        snapshot = self.snapshot
+        snapshot.ensure_fresh(current_app.config['SNAPSHOT_REFRESH_INTERVAL'],
+                              current_app.config['SNAPSHOT_REBUILD_INTERVAL'])
+        return snapshot.search(form)
+
+
+officer_snapshot = OfficerSnapshot()
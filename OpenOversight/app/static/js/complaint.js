@@ -52,4 +52,37 @@ $(document).ready(function() {
        $("#hidden_img").hide();
        $("#show_img_div").show();
     });
+
+    // Fill in the incident location from the browser
+    $("#use_location").on("click", function(){
+        navigator.geolocation.getCurrentPosition(function(position) {
+            $("#latitude").val(position.coords.latitude.toFixed(6));
+            $("#longitude").val(position.coords.longitude.toFixed(6)).trigger("change");
+        });
+    });
+
+    // Show how many officers each rank, race and gender option would find
+    var searchForm = $('form[data-facets-url]');
+
+    function updateFacetCounts() {
+        var params = searchForm.find(':input').not('[name=csrf_token]').serialize();
+        $.getJSON(searchForm.data('facets-url'), params, function(counts) {
+            $.each(['rank', 'race', 'gender'], function(i, facet) {
+                searchForm.find('select[name=' + facet + '] option').each(function() {
+                    var option = $(this);
+                    if (option.data('label') === undefined) {
+                        option.data('label', option.text());
+                    }
+                    var count = counts[facet][option.val()];
+                    option.text(option.data('label') +
+                                (count === undefined ? '' : ' (' + count + ')'));
+                });
+            });
+        });
+    }
+
+    if (searchForm.length) {
+        searchForm.on('change', ':input', updateFacetCounts);
+        updateFacetCounts();
+    }
 });
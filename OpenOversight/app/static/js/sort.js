@@ -0,0 +1,130 @@
+// Sort images without a page load per answer: lease images in batches
+// and send the answers back a few at a time
+$(document).ready(function() {
+    var sorter = $('#sorter');
+    if (!sorter.length) {
+        return;
+    }
+    var BATCH_SIZE = 20;
+    var REFILL_BELOW = 5;
+    var SEND_EVERY = 10;
+
+    var queue = [{id: sorter.data('image-id'), url: $('#sort-image').attr('src')}];
+    if (sorter.data('next-image-id')) {
+        queue.push({id: sorter.data('next-image-id'), url: sorter.data('next-url')});
+    }
+    var seen = {};
+    $.each(queue, function(i, image) {
+        seen[image.id] = true;
+    });
+    var answers = {};
+    var skipped = [];
+    var unsent = 0;
+    var loading = false;
+
+    function answersBody() {
+        var body = JSON.stringify({classifications: answers, skipped: skipped});
+        answers = {};
+        skipped = [];
+        unsent = 0;
+        return body;
+    }
+
+    function send(callback) {
+        if (!unsent) {
+            if (callback) {
+                callback();
+            }
+            return;
+        }
+        $.ajax({
+            url: sorter.data('classify-url'),
+            type: 'POST',
+            contentType: 'application/json',
+            data: answersBody()
+        }).always(function() {
+            if (callback) {
+                callback();
+            }
+        });
+    }
+
+    function show() {
+        if (queue.length) {
+            $('#sort-image').attr('src', queue[0].url);
+        } else if (!loading) {
+            // Nothing left to lease here, let the server say what's next
+            send(function() {
+                window.location.reload();
+            });
+        }
+    }
+
+    function refill() {
+        if (loading) {
+            return;
+        }
+        loading = true;
+        $.getJSON(sorter.data('batch-url'), {count: BATCH_SIZE}, function(data) {
+            $.each(data.images, function(i, image) {
+                if (!seen[image.id]) {
+                    seen[image.id] = true;
+                    queue.push(image);
+                    // Preload so the next answer shows the image at once
+                    new Image().src = image.url;
+                }
+            });
+        }).always(function() {
+            loading = false;
+            show();
+        });
+    }
+
+    function answer(containsCops) {
+        var image = queue.shift();
+        if (!image) {
+            return;
+        }
+        if (containsCops === null) {
+            skipped.push(image.id);
+        } else {
+            answers[image.id] = containsCops;
+        }
+        unsent += 1;
+        if (unsent >= SEND_EVERY) {
+            send();
+        }
+        if (queue.length < REFILL_BELOW) {
+            refill();
+        }
+        show();
+    }
+
+    $('#answer-yes').on('click', function(event) {
+        event.preventDefault();
+        answer(true);
+    });
+    $('#answer-no').on('click', function(event) {
+        event.preventDefault();
+        answer(false);
+    });
+    $('#answer-skip').on('click', function(event) {
+        event.preventDefault();
+        answer(null);
+    });
+
+    // Don't lose the last answers when the volunteer leaves the page
+    $(window).on('pagehide', function() {
+        if (unsent && window.fetch) {
+            fetch(sorter.data('classify-url'), {
+                method: 'POST',
+                keepalive: true,
+                credentials: 'same-origin',
+                headers: {'Content-Type': 'application/json'},
+                body: answersBody()
+            });
+        }
+    });
+
+    refill();
+});
@@ -0,0 +1,188 @@
+"""Where uploaded images are kept"""
+import errno
+import os
+import shutil
+import tempfile
+import threading
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from flask import current_app, url_for
+
+CHUNK_SIZE = 64 * 1024
+
+# Shown for images that can't be viewed yet
+PLACEHOLDER = 'images/placeholder.png'
+
+
+def sharded_path(filename):
+    """``'ab/cdef.png'`` for ``'abcdef.png'``"""
+    return '{}/{}'.format(filename[0:2], filename[2:])
+
+
+class S3Clients(object):
+    """Flask extension sharing one S3 client per process"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['s3_client'] = None
+        app.extensions['s3_transfer_config'] = TransferConfig(
+            multipart_threshold=app.config['S3_MULTIPART_THRESHOLD'],
+            multipart_chunksize=app.config['S3_MULTIPART_CHUNKSIZE'],
+            max_concurrency=app.config['S3_MAX_CONCURRENCY'])
+
+    @property
+    def client(self):
+        extensions = current_app.extensions
+        if extensions['s3_client'] is None:
+            pool_size = current_app.config['S3_MAX_POOL_CONNECTIONS']
+            with self._lock:
+                if extensions['s3_client'] is None:
+                    extensions['s3_client'] = boto3.client(
+                        's3',
+                        config=BotoConfig(max_pool_connections=pool_size))
+        return extensions['s3_client']
+
+    @property
+    def transfer_config(self):
+        return current_app.extensions['s3_transfer_config']
+
+    def reset(self):
+        """Create a new client the next time one is needed"""
+        current_app.extensions['s3_client'] = None
+
+
+s3_clients = S3Clients()
+
+
+class S3Storage(object):
+    """Images in an S3 bucket, kept as public URLs"""
+
+    def __init__(self, bucket, region):
+        self.bucket = bucket
+        self.region = region
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['S3_BUCKET_NAME'], config['AWS_DEFAULT_REGION'])
+
+    @staticmethod
+    def stores(filepath):
+        return filepath.startswith(('http://', 'https://'))
+
+    def save(self, fileobj, filename, content_type):
+        s3_path = sharded_path(filename)
+        s3_clients.client.upload_fileobj(
+            fileobj, self.bucket, s3_path,
+            ExtraArgs={'ContentType': content_type, 'ACL': 'public-read'},
+            Config=s3_clients.transfer_config)
+        return "https://s3-{}.amazonaws.com/{}/{}".format(
+            self.region, self.bucket, s3_path)
+
+    def url(self, filepath):
+        return filepath
+
+
+class LocalStorage(object):
+    """Images in a directory, kept as ``'local:ab/cdef.png'``"""
+
+    PREFIX = 'local:'
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['IMAGE_STORAGE_PATH'])
+
+    @classmethod
+    def stores(cls, filepath):
+        return filepath.startswith(cls.PREFIX)
+
+    def path(self, filename):
+        return os.path.join(self.root, *sharded_path(filename).split('/'))
+
+    def save(self, fileobj, filename, content_type=None):
+        path = self.path(filename)
+        # Same name, same content: nothing to do if it's there already
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Written aside and renamed into place, so readers never see
+            # half an image
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+                os.rename(temp_path, path)
+            except:  # noqa
+                os.remove(temp_path)
+                raise
+        return self.PREFIX + sharded_path(filename)
+
+    def filename(self, filepath):
+        """``'abcdef.png'`` for ``'local:ab/cdef.png'``"""
+        return filepath[len(self.PREFIX):].replace('/', '', 1)
+
+    def remove(self, filepath):
+        try:
+            os.remove(self.path(self.filename(filepath)))
+        except OSError as e:
+            # Already gone, e.g. removed by whoever pushed it first
+            if e.errno != errno.ENOENT:
+                raise
+
+    def url(self, filepath):
+        return url_for('main.stored_image',
+                       path=filepath[len(self.PREFIX):])
+
+
+class StagingArea(LocalStorage):
+    """Uploads waiting to be pushed, kept as ``'staged:ab/cdef.png'``"""
+
+    PREFIX = 'staged:'
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['UPLOAD_STAGING_PATH'])
+
+
+class StaticFiles(object):
+    """Images shipped in the static folder, e.g. the test data's"""
+
+    @staticmethod
+    def stores(filepath):
+        return 'static' in filepath
+
+    def url(self, filepath):
+        return url_for('static', filename=filepath.replace('static/', ''))
+
+
+BACKENDS = {'s3': S3Storage, 'local': LocalStorage}
+
+
+def storage_backend():
+    """The backend new uploads go to"""
+    config = current_app.config
+    return BACKENDS[config['IMAGE_STORAGE']].from_config(config)
+
+
+def image_url(filepath):
+    """URL an image is viewed at, whichever backend holds it"""
+    if filepath:
+        for backend in (LocalStorage, S3Storage):
+            if backend.stores(filepath):
+                return backend.from_config(current_app.config).url(filepath)
+        if StaticFiles.stores(filepath):
+            return StaticFiles().url(filepath)
+    # Not in storage yet, e.g. still staged for the upload workers
+    return url_for('static', filename=PLACEHOLDER)
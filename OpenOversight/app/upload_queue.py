@@ -0,0 +1,201 @@
+"""Background pushes of uploaded images to storage"""
+import datetime
+import threading
+import time
+
+from flask import current_app
+
+from .models import Image, db
+from .storage import StagingArea
+from .utils import upload_fileobj
+
+PENDING = 'pending'
+AVAILABLE = 'available'
+FAILED = 'failed'
+
+# How long a worker has to push an image it claimed before another one
+# may take it over
+PUSH_LEASE_SECONDS = 600
+
+CLAIM_ATTEMPTS = 5
+
+
+def stage_upload(fileobj, filename):
+    """Keep an uploaded file until it is pushed, returns its filepath"""
+    fileobj.seek(0)
+    return StagingArea.from_config(current_app.config).save(fileobj,
+                                                            filename)
+
+
+def unstage_upload(filepath):
+    """Drop a staged file whose upload was abandoned"""
+    StagingArea.from_config(current_app.config).remove(filepath)
+
+
+def retry_due(now):
+    return db.or_(Image.upload_retry_at == None,  # noqa
+                  Image.upload_retry_at <= now)
+
+
+def upload_due(now):
+    return db.and_(Image.upload_state == PENDING,
+                   Image.filepath != None,  # noqa
+                   retry_due(now))
+
+
+def abandoned_upload(now):
+    """Criterion for images claimed by an upload that never stored a file"""
+    return db.and_(Image.upload_state == PENDING,
+                   Image.filepath == None,  # noqa
+                   retry_due(now))
+
+
+def release_abandoned(image_id=None):
+    """Delete abandoned images to free their hashes; commits the session"""
+    abandoned = Image.query.filter(
+        abandoned_upload(datetime.datetime.utcnow()))
+    if image_id is not None:
+        abandoned = abandoned.filter(Image.id == image_id)
+    released = abandoned.delete(synchronize_session=False)
+    db.session.commit()
+    return released
+
+
+def claim_upload():
+    """Lease the oldest pending image due to be pushed; commits the session"""
+    now = datetime.datetime.utcnow()
+    lease_until = now + datetime.timedelta(seconds=PUSH_LEASE_SECONDS)
+    for _ in range(CLAIM_ATTEMPTS):
+        due = db.session.query(Image.id).filter(upload_due(now))
+        image_id = due.order_by(Image.id).limit(1).scalar()
+        if image_id is None:
+            return None
+        claimed = Image.query.filter(Image.id == image_id, upload_due(now)) \
+                             .update({'upload_retry_at': lease_until},
+                                     synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Image.query.get(image_id)
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the ``attempts``-th failed push"""
+    return current_app.config['UPLOAD_RETRY_SECONDS'] * 2 ** (attempts - 1)
+
+
+def push_upload(image):
+    """Push a staged image to storage and make it available"""
+    staging = StagingArea.from_config(current_app.config)
+    staged_path = image.filepath
+    started = time.time()
+    try:
+        filename = staging.filename(staged_path)
+        with open(staging.path(filename), 'rb') as fileobj:
+            filepath = upload_fileobj(fileobj, filename, filename)
+    except Exception as e:
+        image.upload_attempts += 1
+        current_app.logger.warning('Push of image {} failed ({}): {}'.format(
+            image.id, image.upload_attempts, e))
+        if image.upload_attempts >= current_app.config['UPLOAD_MAX_ATTEMPTS']:
+            image.upload_state = FAILED
+            image.upload_retry_at = None
+        else:
+            image.upload_retry_at = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=retry_delay(image.upload_attempts))
+        db.session.commit()
+        return False
+    current_app.logger.info('Pushed image {} in {:.1f} ms'.format(
+        image.id, (time.time() - started) * 1000))
+    image.filepath = filepath
+    image.upload_state = AVAILABLE
+    image.upload_retry_at = None
+    db.session.commit()
+    staging.remove(staged_path)
+    return True
+
+
+def drain_uploads(retry_failed=False):
+    """Push every pending image that is due now, as the workers would"""
+    if retry_failed:
+        Image.query.filter(Image.upload_state == FAILED) \
+                   .update({'upload_state': PENDING, 'upload_attempts': 0,
+                            'upload_retry_at': None},
+                           synchronize_session=False)
+        db.session.commit()
+    release_abandoned()
+    pushed = failed = 0
+    # Claimed like the workers do, so that neither pushes an image the
+    # other is still pushing
+    image = claim_upload()
+    while image is not None:
+        if push_upload(image):
+            pushed += 1
+        else:
+            failed += 1
+        image = claim_upload()
+    return pushed, failed
+
+
+def upload_queue_status():
+    """Image counts per upload state, plus the pending ones ``due`` now"""
+    counts = dict((state, 0) for state in (PENDING, AVAILABLE, FAILED))
+    counts.update(db.session.query(Image.upload_state,
+                                   db.func.count(Image.id))
+                            .group_by(Image.upload_state))
+    counts['due'] = Image.query.filter(
+        upload_due(datetime.datetime.utcnow())).count()
+    return counts
+
+
+class UploadQueue(object):
+    """Flask extension running the pool of upload workers"""
+
+    def __init__(self, app=None):
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._workers = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('UPLOAD_WORKERS', 0) > 0:
+            if not app.config.get('UPLOAD_STAGING_PATH'):
+                raise RuntimeError(
+                    'UPLOAD_WORKERS needs an UPLOAD_STAGING_PATH')
+            app.before_first_request(self.notify)
+
+    def notify(self):
+        """Wake the workers to push new uploads, starting them if need be"""
+        app = current_app._get_current_object()
+        with self._lock:
+            if not self._workers:
+                for number in range(app.config['UPLOAD_WORKERS']):
+                    worker = threading.Thread(
+                        target=self._work, args=(app,),
+                        name='upload-worker-{}'.format(number))
+                    worker.daemon = True
+                    worker.start()
+                    self._workers.append(worker)
+        self._wake.set()
+
+    def _work(self, app):
+        while True:
+            self._wake.clear()
+            pushed = False
+            with app.app_context():
+                try:
+                    image = claim_upload()
+                    if image is not None:
+                        push_upload(image)
+                        pushed = True
+                    else:
+                        release_abandoned()
+                except Exception:
+                    app.logger.exception('Upload worker failed')
+                finally:
+                    db.session.remove()
+            if not pushed:
+                self._wake.wait(app.config['UPLOAD_POLL_SECONDS'])
+
+
+upload_queue = UploadQueue()
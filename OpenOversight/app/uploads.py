@@ -0,0 +1,107 @@
+"""Streaming handling of uploaded files"""
+import hashlib
+import math
+import struct
+import tempfile
+
+from flask import Request, current_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingSpooledFile(object):
+    """Spooled temporary file that hashes everything written to it"""
+
+    def __init__(self, max_size):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def file_hash(stream, chunk_size=CHUNK_SIZE):
+    """Hex SHA-256 of an uploaded file's stream"""
+    if isinstance(stream, HashingSpooledFile):
+        stream.seek(0)
+        return stream.hexdigest()
+    sha256 = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        sha256.update(chunk)
+    stream.seek(0)
+    return sha256.hexdigest()
+
+
+class StreamingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingSpooledFile(current_app.config['UPLOAD_SPOOL_SIZE'])
+
+
+class BloomFilter(object):
+    """Set of strings with false positives but no false negatives"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        bits_per_member = -math.log(error_rate) / math.log(2) ** 2
+        self.size = max(8, int(capacity * bits_per_member))
+        hash_count = math.log(2) * self.size / capacity
+        self.hash_count = max(1, int(round(hash_count)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two halves of one digest
+        first, second = struct.unpack('>QQ',
+                                      hashlib.sha256(key).digest()[:16])
+        return [(first + i * second) % self.size
+                for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(key))
+
+
+class UploadedHashes(object):
+    """Per-process Bloom filter of the hashes of uploaded images"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['uploaded_hashes'] = None
+        if app.config.get('UPLOAD_BLOOM_CAPACITY', 0) > 0:
+            app.before_first_request(self.warm)
+
+    def warm(self):
+        from .models import Image, db
+        bloom = BloomFilter(current_app.config['UPLOAD_BLOOM_CAPACITY'])
+        hashes = db.session.query(Image.hash_img) \
+                           .filter(Image.hash_img != None)  # noqa
+        for hash_img, in hashes.yield_per(10000):
+            bloom.add(hash_img)
+        current_app.extensions['uploaded_hashes'] = bloom
+
+    def might_contain(self, hash_img):
+        """False only if no image with this hash was ever seen"""
+        bloom = current_app.extensions.get('uploaded_hashes')
+        return bloom is None or hash_img in bloom
+
+    def add(self, hash_img):
+        bloom = current_app.extensions.get('uploaded_hashes')
+        if bloom is not None:
+            bloom.add(hash_img)
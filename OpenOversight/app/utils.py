@@ -1,13 +1,39 @@
-import boto3
 import datetime
 import hashlib
+import json
+import math
 import random
-from sqlalchemy import func
-from sqlalchemy.sql.expression import cast
+import re
+import time
+from sqlalchemy import event, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import joinedload, object_session
 import imghdr as imghdr
-from flask import current_app, url_for
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from itsdangerous import BadData, URLSafeSerializer
+from metaphone import doublemetaphone
 
-from .models import db, Officer, Assignment, Image, Face, User, Unit, Department
+from .models import (db, Officer, Assignment, Image, Face, User, Unit,
+                     Department, OfficerSearch, RankNormalization,
+                     badge_digits)
+from .cache import SearchCache, mark_department_changed
+from .geo import RTree, bounding_box, contains, parse_geometry
+from .storage import image_url, storage_backend
+
+# Rank codes from choices.RANK_CHOICES, most specific first so that e.g.
+# 'DEP CHIEF' is not filed under 'CHIEF'
+RANK_CODES = ('SUPT OF POLICE', 'DEPUTY SUPT', 'DEP CHIEF', 'CHIEF',
+              'COMMANDER', 'CAPTAIN', 'LIEUTENANT', 'SERGEANT', 'FIELD')
+SEARCHABLE_RACES = ('BLACK', 'WHITE', 'ASIAN', 'HISPANIC', 'PACIFIC ISLANDER')
+
+# Most phonetic matches a fuzzy search ranks by spelling where the
+# database can't (anything but Postgres); the rest keep the gallery order
+FUZZY_CANDIDATE_LIMIT = 1000
+
+# How long each process may use its R-tree of unit boundaries before
+# rebuilding it, to pick up units changed by other processes
+UNIT_INDEX_TTL = 300
 
 
 def unit_choices():
@@ -25,18 +51,24 @@ def add_new_assignment(officer_id, form):
     else:
         unit = None
 
+    officer = Officer.query.get(officer_id)
     new_assignment = Assignment(officer_id=officer_id,
                                 star_no=form.star_no.data,
                                 rank=form.rank.data,
+                                rank_code=rank_code_for(
+                                    form.rank.data, officer.department_id),
                                 unit=unit,
                                 star_date=form.star_date.data)
     db.session.add(new_assignment)
+    update_officer_search(officer)
     db.session.commit()
 
 
 def edit_existing_assignment(assignment, form):
     assignment.star_no = form.star_no.data
     assignment.rank = form.rank.data
+    assignment.rank_code = rank_code_for(form.rank.data,
+                                         assignment.officer.department_id)
 
     if form.unit.data:
         officer_unit = form.unit.data.id
@@ -46,6 +78,7 @@ def edit_existing_assignment(assignment, form):
     assignment.unit = officer_unit
     assignment.star_date = form.star_date.data
     db.session.add(assignment)
+    update_officer_search(assignment.officer)
     db.session.commit()
     return assignment
 
@@ -69,9 +102,13 @@ def add_officer_profile(form):
     assignment = Assignment(baseofficer=officer,
                             star_no=form.star_no.data,
                             rank=form.rank.data,
+                            rank_code=rank_code_for(form.rank.data,
+                                                    officer.department_id),
                             unit=officer_unit,
                             star_date=form.employment_date.data)
     db.session.add(assignment)
+    db.session.flush()
+    update_officer_search(officer)
     db.session.commit()
     return officer
 
@@ -81,28 +118,292 @@ def edit_officer_profile(officer, form):
         setattr(officer, field, data)
 
     db.session.add(officer)
+    update_officer_search(officer)
     db.session.commit()
     return officer
 
 
+def normalize_name(name):
+    """Upper-case a name and strip punctuation for officer_search"""
+    if not name:
+        return name
+    return re.sub(r'[^\w ]', u'', name.upper(), flags=re.UNICODE).strip()
+
+
+def normalize_rank(rank):
+    """Map a raw rank string onto a rank code from choices.RANK_CHOICES"""
+    if not rank:
+        return None
+    rank = rank.strip().upper()
+    for code in RANK_CODES:
+        if code in rank:
+            return code
+    if 'PO' in rank:
+        return 'PO'
+    return rank
+
+
+def resolve_rank_code(mappings, rank, department_id):
+    """Rank code of ``rank`` given ``mappings`` from load_rank_mappings()"""
+    if not rank:
+        return None
+    raw_rank = rank.strip().upper()
+    return mappings.get((department_id, raw_rank)) or \
+        mappings.get((None, raw_rank)) or normalize_rank(rank)
+
+
+def load_rank_mappings(raw_rank=None):
+    """Rank normalizations keyed by (department_id, raw_rank)"""
+    query = RankNormalization.query
+    if raw_rank is not None:
+        query = query.filter_by(raw_rank=raw_rank)
+    return dict(((mapping.department_id, mapping.raw_rank), mapping.rank_code)
+                for mapping in query)
+
+
+def rank_code_for(rank, department_id):
+    """Rank code of a raw rank string in a department"""
+    if not rank:
+        return None
+    return resolve_rank_code(load_rank_mappings(rank.strip().upper()),
+                             rank, department_id)
+
+
+def backfill_rank_codes(batch_size=1000):
+    """Recompute rank_code for every assignment"""
+    mappings = load_rank_mappings()
+    ranks = db.session.query(Assignment.id, Assignment.rank,
+                             Officer.department_id) \
+                      .join(Officer, Officer.id == Assignment.officer_id) \
+                      .order_by(Assignment.id)
+    rows = []
+    count = 0
+    for assignment_id, rank, department_id in ranks.yield_per(batch_size):
+        rows.append({'id': assignment_id,
+                     'rank_code': resolve_rank_code(mappings, rank,
+                                                    department_id)})
+        if len(rows) == batch_size:
+            db.session.bulk_update_mappings(Assignment, rows)
+            count += len(rows)
+            rows = []
+    db.session.bulk_update_mappings(Assignment, rows)
+    count += len(rows)
+    db.session.commit()
+    rebuild_officer_search(batch_size)
+    return count
+
+
+def phonetic_keys(name):
+    """Double Metaphone primary and alternate keys of a name"""
+    name = normalize_name(name)
+    if not name:
+        return None, None
+    primary, alternate = doublemetaphone(name)
+    return primary or None, alternate or None
+
+
+def edit_distance(first, second):
+    """Levenshtein distance between two strings"""
+    if len(first) < len(second):
+        first, second = second, first
+    previous = range(len(second) + 1)
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+def next_change_seq():
+    """Value for officer_search.change_seq marking a row as changed now"""
+    return int(time.time() * 1000000)
+
+
+def officer_search_values(officer, assignment, has_face):
+    """Column values of the officer_search row describing ``officer``"""
+    metaphone, metaphone_alt = phonetic_keys(officer.last_name)
+    return {
+        'officer_id': officer.id,
+        'department_id': officer.department_id,
+        'last_name': normalize_name(officer.last_name),
+        'first_name': normalize_name(officer.first_name),
+        'last_name_metaphone': metaphone,
+        'last_name_metaphone_alt': metaphone_alt,
+        'race': officer.race,
+        'gender': officer.gender,
+        'birth_year': officer.birth_year,
+        'rank_code': (assignment.rank_code or normalize_rank(assignment.rank))
+        if assignment else None,
+        'unit_id': assignment.unit if assignment else None,
+        'star_no': assignment.star_no if assignment else None,
+        'star_no_digits': badge_digits(assignment.star_no)
+        if assignment else None,
+        'has_face': has_face,
+        'change_seq': next_change_seq(),
+    }
+
+
+def update_officer_search(officer):
+    """Refresh the officer_search row of one officer"""
+    assignment = current_assignment(officer.assignments.all())
+    has_face = db.session.query(
+        db.exists().where(Face.officer_id == officer.id)).scalar()
+    entry = OfficerSearch.query.get(officer.id)
+    if entry is None:
+        entry = OfficerSearch()
+    else:
+        mark_department_changed(db.session, entry.department_id)
+    mark_department_changed(db.session, officer.department_id)
+    for field, value in officer_search_values(officer, assignment,
+                                              has_face).items():
+        setattr(entry, field, value)
+    db.session.add(entry)
+    return entry
+
+
+def add_face_tags(image_id, tags, user_id):
+    """Tag several officers in one image"""
+    requested = set(tag['officer_id'] for tag in tags)
+    departments = dict(db.session.query(Officer.id, Officer.department_id)
+                                 .filter(Officer.id.in_(requested)))
+    rows = []
+    for tag in tags:
+        officer_id = tag['officer_id']
+        if officer_id in departments and officer_id in requested:
+            requested.remove(officer_id)
+            rows.append({'officer_id': officer_id, 'img_id': image_id,
+                         'face_position_x': tag['x'],
+                         'face_position_y': tag['y'],
+                         'face_width': tag['width'],
+                         'face_height': tag['height'],
+                         'user_id': user_id})
+
+    faces = Face.__table__
+    created = set()
+    if rows and db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(faces).values(rows) \
+            .on_conflict_do_nothing(constraint='unique_faces') \
+            .returning(faces.c.officer_id)
+        created = set(officer_id for officer_id,
+                      in db.session.execute(statement))
+    elif rows:
+        # No RETURNING here, so look up the existing tags first
+        existing = set(officer_id for officer_id, in db.session.query(
+            Face.officer_id).filter(Face.img_id == image_id,
+                                    Face.officer_id.in_(departments)))
+        rows = [row for row in rows if row['officer_id'] not in existing]
+        if rows:
+            db.session.execute(
+                faces.insert().prefix_with('OR IGNORE', dialect='sqlite'),
+                rows)
+        created = set(row['officer_id'] for row in rows)
+
+    if created:
+        OfficerSearch.query.filter(OfficerSearch.officer_id.in_(created)) \
+                           .update({'has_face': True,
+                                    'change_seq': next_change_seq()},
+                                   synchronize_session=False)
+        for department_id in set(departments[officer_id]
+                                 for officer_id in created):
+            mark_department_changed(db.session, department_id)
+
+    results = []
+    reported = set()
+    for tag in tags:
+        officer_id = tag['officer_id']
+        if officer_id not in departments:
+            status = 'invalid_officer'
+        elif officer_id in created and officer_id not in reported:
+            status = 'created'
+        else:
+            status = 'exists'
+        reported.add(officer_id)
+        results.append({'officer_id': officer_id, 'status': status})
+    return results
+
+
+def rebuild_officer_search(batch_size=1000):
+    """Repopulate the whole officer_search table, returns the row count"""
+    assignments = {}
+    assignment_rows = db.session.query(
+        Assignment.id, Assignment.officer_id, Assignment.star_no,
+        Assignment.rank, Assignment.rank_code, Assignment.unit,
+        Assignment.star_date, Assignment.resign_date)
+    for assignment in assignment_rows.yield_per(batch_size):
+        assignments.setdefault(assignment.officer_id, []).append(assignment)
+    tagged = set(officer_id for officer_id, in
+                 db.session.query(Face.officer_id).distinct())
+
+    OfficerSearch.query.delete()
+    rows = []
+    count = 0
+    for officer in Officer.query.order_by(Officer.id).yield_per(batch_size):
+        rows.append(officer_search_values(
+            officer, current_assignment(assignments.get(officer.id)),
+            officer.id in tagged))
+        if len(rows) == batch_size:
+            db.session.bulk_insert_mappings(OfficerSearch, rows)
+            count += len(rows)
+            rows = []
+    db.session.bulk_insert_mappings(OfficerSearch, rows)
+    count += len(rows)
+    db.session.commit()
+    SearchCache().invalidate_all()
+    return count
+
+
+def backfill_phonetic_keys(batch_size=1000):
+    """Recompute the phonetic name keys in officer_search"""
+    names = db.session.query(OfficerSearch.officer_id, Officer.last_name) \
+                      .join(Officer, Officer.id == OfficerSearch.officer_id) \
+                      .order_by(OfficerSearch.officer_id)
+    rows = []
+    count = 0
+    for officer_id, last_name in names.yield_per(batch_size):
+        metaphone, metaphone_alt = phonetic_keys(last_name)
+        rows.append({'officer_id': officer_id,
+                     'last_name_metaphone': metaphone,
+                     'last_name_metaphone_alt': metaphone_alt})
+        if len(rows) == batch_size:
+            db.session.bulk_update_mappings(OfficerSearch, rows)
+            count += len(rows)
+            rows = []
+    db.session.bulk_update_mappings(OfficerSearch, rows)
+    count += len(rows)
+    db.session.commit()
+    SearchCache().invalidate_all()
+    return count
+
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 
+def get_random_images(image_query, count):
+    """Pick up to ``count`` random images from ``image_query``"""
+    ordered = image_query.order_by(Image.random_key)
+    images = ordered.filter(Image.random_key >= random.random()) \
+                    .limit(count).all()
+    if len(images) < count:
+        if images:
+            ordered = ordered.filter(~Image.id.in_([image.id
+                                                    for image in images]))
+        images += ordered.limit(count - len(images)).all()
+    return images
+
+
 def get_random_image(image_query):
-    if image_query.count() > 0:
-        rand = random.randrange(0, image_query.count())
-        return image_query[rand]
-    else:
-        return None
+    """Pick a random image from ``image_query`` without counting it"""
+    images = get_random_images(image_query, 1)
+    return images[0] if images else None
 
 
 def serve_image(filepath):
-    if 'http' in filepath:
-        return filepath
-    if 'static' in filepath:
-        return url_for('static', filename=filepath.replace('static/', ''))
+    return image_url(filepath)
 
 
 def compute_hash(data_to_hash):
@@ -110,109 +411,600 @@ def compute_hash(data_to_hash):
 
 
 def upload_file(safe_local_path, src_filename, dest_filename):
-    s3_client = boto3.client('s3')
+    with open(safe_local_path, 'rb') as fileobj:
+        return upload_fileobj(fileobj, src_filename, dest_filename)
 
-    # Folder to store files in on S3 is first two chars of dest_filename
-    s3_folder = dest_filename[0:2]
-    s3_filename = dest_filename[2:]
-    s3_content_type = "image/%s" % imghdr.what(safe_local_path)
-    s3_path = '{}/{}'.format(s3_folder, s3_filename)
-    s3_client.upload_file(safe_local_path,
-                          current_app.config['S3_BUCKET_NAME'],
-                          s3_path,
-                          ExtraArgs={'ContentType': s3_content_type, 'ACL': 'public-read'})
 
-    url = "https://s3-{}.amazonaws.com/{}/{}".format(
-        current_app.config['AWS_DEFAULT_REGION'],
-        current_app.config['S3_BUCKET_NAME'], s3_path
-    )
+def upload_fileobj(fileobj, src_filename, dest_filename):
+    """Store an image with the IMAGE_STORAGE backend, returns its filepath"""
+    fileobj.seek(0)
+    content_type = "image/%s" % imghdr.what(None, h=fileobj.read(32))
+    fileobj.seek(0)
+    return storage_backend().save(fileobj, dest_filename, content_type)
 
-    return url
 
+class Stopwatch(object):
+    """Durations of the steps of a request, for a Server-Timing header"""
 
-def filter_by_form(form, officer_query):
-    if form['name']:
-        officer_query = officer_query.filter(
-            Officer.last_name.ilike('%%{}%%'.format(form['name']))
-        )
-    if form['race'] in ('BLACK', 'WHITE', 'ASIAN', 'HISPANIC',
-                        'PACIFIC ISLANDER'):
+    def __init__(self):
+        self.timings = []
+        self._lap_start = time.time()
+
+    def lap(self, name):
+        """Record the time since the last lap as step ``name``"""
+        now = time.time()
+        self.timings.append((name, now - self._lap_start))
+        self._lap_start = now
+
+    def server_timing(self):
+        return ', '.join('{};dur={:.1f}'.format(name, seconds * 1000)
+                         for name, seconds in self.timings)
+
+
+def escape_like(term, escape_char='\\'):
+    """Escape LIKE wildcards so user input is matched literally"""
+    return term.replace(escape_char, escape_char * 2) \
+               .replace('%', escape_char + '%') \
+               .replace('_', escape_char + '_')
+
+
+def name_filter(column, name):
+    """Build a case-insensitive partial match on a name column"""
+    pattern = u'%{}%'.format(escape_like(name.strip()))
+    return column.ilike(pattern, escape='\\')
+
+
+def phonetic_filter(name):
+    """Officers whose last name sounds like ``name``"""
+    keys = [key for key in phonetic_keys(name) if key]
+    if not keys:
+        return name_filter(OfficerSearch.last_name, normalize_name(name))
+    return db.or_(OfficerSearch.last_name_metaphone.in_(keys),
+                  OfficerSearch.last_name_metaphone_alt.in_(keys))
+
+
+def fuzzy_officer_ids(officer_query, name):
+    """IDs from a fuzzy name search, closest spelling first"""
+    name = normalize_name(name)
+    if db.session.get_bind().dialect.name == 'postgresql':
+        distance = db.func.levenshtein(
+            db.func.coalesce(OfficerSearch.last_name, u''), name)
+        ranked = officer_query.with_entities(
+            OfficerSearch.officer_id, distance.label('distance'),
+            OfficerSearch.has_face).distinct().order_by(
+            'distance', OfficerSearch.has_face.desc(),
+            OfficerSearch.officer_id.desc())
+        return [row[0] for row in ranked]
+    candidates = officer_query.with_entities(
+        OfficerSearch.officer_id, OfficerSearch.last_name,
+        OfficerSearch.has_face).distinct().order_by(
+        OfficerSearch.has_face.desc(), OfficerSearch.officer_id.desc())
+    candidates = candidates.limit(FUZZY_CANDIDATE_LIMIT).all()
+    # Stable, so ties keep the gallery order
+    candidates.sort(key=lambda row: edit_distance(name, row[1] or u''))
+    return [row[0] for row in candidates]
+
+
+def badge_filter(officer_query, column, digits_column, badge, match=None):
+    """Narrow ``officer_query`` to officers whose badge contains ``badge``"""
+    if match is None:
+        def match(condition):
+            return condition
+    digits = badge_digits(badge)
+    if not digits:
+        return officer_query.filter(match(
+            column.like(u'%{}%'.format(escape_like(badge.strip())),
+                        escape='\\')
+        ))
+    return officer_query.filter(
+        match(digits_column.like(u'%{}%'.format(digits))))
+
+
+def badge_rank(digits_column, badge):
+    """0 for exact badge matches, 1 for prefix matches and 2 for the rest"""
+    digits = badge_digits(badge)
+    if not digits:
+        return None
+    return db.case([(digits_column == digits, 0),
+                    (digits_column.like(u'{}%'.format(digits)), 1)],
+                   else_=2)
+
+
+_unit_index = {}
+_postgis = {}
+
+
+def unit_index():
+    """This process's R-tree of unit bounding boxes and parsed boundaries"""
+    index = _unit_index.get('units')
+    if index is None or index[0] < time.time():
+        boundaries = dict(
+            (unit_id, parse_geometry(boundary)) for unit_id, boundary in
+            db.session.query(Unit.id, Unit.boundary)
+                      .filter(Unit.boundary != None))  # noqa
+        tree = RTree((unit_id, bounding_box(polygons))
+                     for unit_id, polygons in boundaries.items())
+        index = (time.time() + UNIT_INDEX_TTL, tree, boundaries)
+        _unit_index['units'] = index
+    return index[1], index[2]
+
+
+@event.listens_for(Unit, 'after_insert')
+@event.listens_for(Unit, 'after_update')
+@event.listens_for(Unit, 'after_delete')
+def _unit_changed(mapper, connection, unit):
+    _unit_index.pop('units', None)
+    session = object_session(unit)
+    if session is not None:
+        mark_department_changed(session, unit.department_id)
+
+
+def has_postgis():
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return False
+    key = str(bind.url)
+    if key not in _postgis:
+        _postgis[key] = db.session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'postgis'"
+        ).scalar() is not None
+    return _postgis[key]
+
+
+def units_covering(latitude, longitude):
+    """IDs of the units whose boundary contains the point"""
+    if has_postgis():
+        point = func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), 4326)
+        area = func.ST_SetSRID(func.ST_GeomFromGeoJSON(Unit.boundary), 4326)
+        return [unit_id for unit_id, in db.session.query(Unit.id).filter(
+            Unit.boundary != None,  # noqa
+            func.ST_Contains(area, point))]
+    tree, boundaries = unit_index()
+    return [unit_id for unit_id in tree.search(latitude, longitude)
+            if contains(boundaries[unit_id], latitude, longitude)]
+
+
+def form_location(form):
+    """``(latitude, longitude)`` searched for, or None"""
+    latitude, longitude = form.get('latitude'), form.get('longitude')
+    if latitude is None or longitude is None:
+        return None
+    return float(latitude), float(longitude)
+
+
+def search_base(form, officer_query):
+    """``officer_query`` narrowed by every search field but the facets"""
+    # All filters run against the flattened officer_search table
+    officer_query = officer_query.join(
+        OfficerSearch, OfficerSearch.officer_id == Officer.id)
+    name = normalize_name(form['name'])
+    if not name and (form['name'] or '').strip():
+        # Nothing but punctuation, which officer_search names never hold
+        officer_query = officer_query.filter(db.false())
+    elif name and form.get('fuzzy'):
+        officer_query = officer_query.filter(phonetic_filter(name))
+    elif name:
         officer_query = officer_query.filter(
-            Officer.race.like('%%{}%%'.format(form['race']))
+            name_filter(OfficerSearch.last_name, name)
         )
-    if form['gender'] in ('M', 'F'):
-        officer_query = officer_query.filter(Officer.gender == form['gender'])
     if form['dept']:
         officer_query = officer_query.filter(
-            Officer.department_id == form['dept'].id
+            OfficerSearch.department_id == form['dept'].id
         )
 
     current_year = datetime.datetime.now().year
     min_birth_year = current_year - int(form['min_age'])
     max_birth_year = current_year - int(form['max_age'])
-    officer_query = officer_query.filter(db.or_(db.and_(Officer.birth_year <= min_birth_year,
-                                                        Officer.birth_year >= max_birth_year),
-                                                Officer.birth_year == None))  # noqa
+    officer_query = officer_query.filter(db.or_(db.and_(OfficerSearch.birth_year <= min_birth_year,
+                                                        OfficerSearch.birth_year >= max_birth_year),
+                                                OfficerSearch.birth_year == None))  # noqa
 
-    officer_query = officer_query.join(Assignment)
     if form['badge']:
+        officer_query = badge_filter(officer_query, OfficerSearch.star_no,
+                                     OfficerSearch.star_no_digits,
+                                     form['badge'])
+
+    # Only officers assigned to a unit covering a searched location, unless
+    # none of them match
+    location = form_location(form)
+    covering_units = units_covering(*location) if location else []
+    if covering_units:
+        nearby = officer_query.filter(
+            OfficerSearch.unit_id.in_(covering_units))
+        if db.session.query(nearby.exists()).scalar():
+            officer_query = nearby
+    return officer_query
+
+
+def filter_facets(form, officer_query):
+    """``officer_query`` narrowed by the race, gender and rank facets"""
+    if form['race'] in SEARCHABLE_RACES:
         officer_query = officer_query.filter(
-            cast(Assignment.star_no, db.String)
-            .like('%%{}%%'.format(form['badge']))
+            OfficerSearch.race == form['race']
         )
-    if form['rank'] == 'PO':
+    if form['gender'] in ('M', 'F'):
         officer_query = officer_query.filter(
-            db.or_(Assignment.rank.like('%%PO%%'),
-                   Assignment.rank.like('%%POLICE OFFICER%%'),
-                   Assignment.rank == None)  # noqa
+            OfficerSearch.gender == form['gender']
         )
-    if form['rank'] in ('FIELD', 'SERGEANT', 'LIEUTENANT', 'CAPTAIN',
-                        'COMMANDER', 'DEP CHIEF', 'CHIEF', 'DEPUTY SUPT',
-                        'SUPT OF POLICE'):
+    if form['rank'] == 'PO' or form['rank'] in RANK_CODES:
         officer_query = officer_query.filter(
-            db.or_(Assignment.rank.like('%%{}%%'.format(form['rank'])),
-                   Assignment.rank == None)  # noqa
+            db.or_(OfficerSearch.rank_code == form['rank'],
+                   OfficerSearch.rank_code == None)  # noqa
         )
+    return officer_query
 
-    # This handles the sorting upstream of pagination and pushes officers w/o tagged faces to the end of list
-    officer_query = officer_query.outerjoin(Face).order_by(Face.officer_id.asc()).order_by(Officer.id.desc())
+
+def filter_by_form(form, officer_query, sort=True):
+    officer_query = filter_facets(form, search_base(form, officer_query))
+
+    if sort:
+        rank = badge_rank(OfficerSearch.star_no_digits, form['badge'])
+        if rank is not None:
+            # Exact badge matches first, then badges starting with the term
+            officer_query = officer_query.order_by(rank)
+        # Officers with tagged faces first, without needing to join faces
+        officer_query = officer_query.order_by(OfficerSearch.has_face.desc(),
+                                               OfficerSearch.officer_id.desc())
     return officer_query
 
 
-def filter_roster(form, officer_query):
-    if form['name']:
+def filter_roster(form, officer_query, sort=True):
+    if form['name'] and form.get('fuzzy'):
+        officer_query = officer_query.join(
+            OfficerSearch, OfficerSearch.officer_id == Officer.id
+        ).filter(phonetic_filter(form['name']))
+    elif form['name']:
         officer_query = officer_query.filter(
-            Officer.last_name.ilike('%%{}%%'.format(form['name']))
+            name_filter(Officer.last_name, form['name'])
         )
 
-    officer_query = officer_query.join(Assignment)
-    if form['badge']:
-        officer_query = officer_query.filter(
-            cast(Assignment.star_no, db.String)
-            .like('%%{}%%'.format(form['badge']))
-        )
     if form['dept']:
         officer_query = officer_query.filter(
             Officer.department_id == form['dept'].id
         )
+    # Assignments and faces are tested with EXISTS rather than joined, so
+    # every officer is one row however many of either they have
+    if form['badge']:
+        officer_query = badge_filter(officer_query, Assignment.star_no,
+                                     Assignment.star_no_digits,
+                                     form['badge'],
+                                     match=Officer.assignments.any)
+    else:
+        officer_query = officer_query.filter(Officer.assignments.any())
 
-    officer_query = officer_query.outerjoin(Face) \
-                                 .order_by(Face.officer_id.asc()) \
-                                 .order_by(Officer.id.desc())
+    if sort:
+        rank = badge_rank(Assignment.star_no_digits, form['badge'])
+        if rank is not None:
+            # Ranked by the officer's best matching badge
+            officer_query = officer_query.order_by(
+                db.session.query(db.func.min(rank))
+                .filter(Assignment.officer_id == Officer.id)
+                .correlate(Officer).as_scalar())
+        officer_query = officer_query.order_by(officer_has_face().desc(),
+                                               Officer.id.desc())
     return officer_query
 
 
-def roster_lookup(form):
-    return filter_roster(form, Officer.query)
+def roster_lookup(form, sort=True):
+    return filter_roster(form, Officer.query, sort=sort)
+
+
+def grab_officers(form, sort=True):
+    return filter_by_form(form, Officer.query, sort=sort)
+
+
+def facet_matches(facet, selected, value):
+    """Whether an officer_search ``value`` passes the ``facet`` filter"""
+    if facet == 'race':
+        return selected not in SEARCHABLE_RACES or value == selected
+    if facet == 'gender':
+        return selected not in ('M', 'F') or value == selected
+    if selected == 'PO' or selected in RANK_CODES:
+        return value in (selected, None)
+    return True
+
+
+def facet_counts(form, options):
+    """Count the results of ``form`` for each race, gender and rank option"""
+    # Grouped from the same base query the gallery narrows by the facets
+    groups = search_base(form, Officer.query).with_entities(
+        OfficerSearch.race, OfficerSearch.gender, OfficerSearch.rank_code,
+        func.count(OfficerSearch.officer_id)
+    ).group_by(OfficerSearch.race, OfficerSearch.gender,
+               OfficerSearch.rank_code).all()
+
+    facets = ('race', 'gender', 'rank')
+    counts = dict((facet, dict((option, 0) for option in options[facet]))
+                  for facet in facets)
+    total = 0
+    for race, gender, rank_code, count in groups:
+        values = {'race': race, 'gender': gender, 'rank': rank_code}
+        matched = dict((facet, facet_matches(facet, form[facet],
+                                             values[facet]))
+                       for facet in facets)
+        if all(matched.values()):
+            total += count
+        for facet in facets:
+            others = all(matched[other] for other in facets if other != facet)
+            if not others:
+                continue
+            for option in options[facet]:
+                if facet_matches(facet, option, values[facet]):
+                    counts[facet][option] += count
+    counts['total'] = total
+    return counts
+
+
+def search_cache_key(form):
+    """Normalize the form values that decide a search's results"""
+    birth_years = (None, None)
+    if 'min_age' in form:
+        current_year = datetime.datetime.now().year
+        birth_years = (current_year - int(form['min_age']),
+                       current_year - int(form['max_age']))
+    race = form.get('race')
+    gender = form.get('gender')
+    rank = form.get('rank')
+    return (bool(form.get('fuzzy')),
+            (form.get('name') or '').strip().upper() or None,
+            (form.get('badge') or '').strip() or None,
+            race if race in SEARCHABLE_RACES else None,
+            gender if gender in ('M', 'F') else None,
+            rank if rank == 'PO' or rank in RANK_CODES else None,
+            form_location(form)) + birth_years
+
+
+def ordered_officer_ids(officer_query):
+    """IDs of the officers ``officer_query`` returns, in order, once each"""
+    seen = set()
+    officer_ids = []
+    for officer_id, in officer_query.with_entities(Officer.id):
+        if officer_id not in seen:
+            seen.add(officer_id)
+            officer_ids.append(officer_id)
+    return officer_ids
+
+
+def paginate_officer_ids(officer_ids, page, per_page):
+    """Paginate an ordered sequence of officer IDs"""
+    page = max(page, 1)
+    start = (page - 1) * per_page
+    page_ids = list(officer_ids[start:start + per_page])
+    items = []
+    if page_ids:
+        officers = dict((officer.id, officer) for officer in
+                        Officer.query.filter(Officer.id.in_(page_ids)))
+        items = [officers[officer_id] for officer_id in page_ids
+                 if officer_id in officers]
+    return Pagination(None, page, per_page, len(officer_ids), items)
+
+
+def current_assignment(assignments):
+    """Pick an officer's current assignment from all of their assignments"""
+    if not assignments:
+        return None
+    return max(assignments, key=lambda a: (a.resign_date is None,
+                                           a.star_date or datetime.datetime.min,
+                                           a.id))
+
+
+def preload_officer_details(officers):
+    """Batch load what the gallery and list templates show per officer"""
+    officers = list(officers)
+    officer_ids = [officer.id for officer in officers]
+    if not officer_ids:
+        return officers
+
+    face_stats = db.session.query(Face.officer_id, func.min(Face.id),
+                                  func.count(Face.id)) \
+                           .filter(Face.officer_id.in_(officer_ids)) \
+                           .group_by(Face.officer_id).all()
+    face_counts = dict((officer_id, count)
+                       for officer_id, _, count in face_stats)
+    primary_faces = {}
+    primary_face_ids = [face_id for _, face_id, _ in face_stats]
+    if primary_face_ids:
+        faces = Face.query.options(joinedload(Face.image)) \
+                          .filter(Face.id.in_(primary_face_ids)).all()
+        primary_faces = dict((face.officer_id, face) for face in faces)
+
+    assignments = {}
+    for assignment in Assignment.query.filter(
+            Assignment.officer_id.in_(officer_ids)):
+        assignments.setdefault(assignment.officer_id, []).append(assignment)
+
+    for officer in officers:
+        officer.primary_face = primary_faces.get(officer.id)
+        officer.face_count = face_counts.get(officer.id, 0)
+        officer.current_assignment = current_assignment(
+            assignments.get(officer.id))
+    return officers
+
+
+def officer_has_face():
+    """Correlated EXISTS that is true when an officer has a tagged face"""
+    return db.exists().where(Face.officer_id == Officer.id)
+
+
+def _cursor_serializer(salt='officer-cursor'):
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt=salt)
+
+
+def encode_cursor(flag, key, direction):
+    return _cursor_serializer().dumps([int(flag), key, direction])
+
+
+def decode_cursor(cursor):
+    """Unpack a cursor from encode_cursor, raises BadData if tampered with"""
+    flag, key, direction = _cursor_serializer().loads(cursor)
+    return bool(flag), key, direction
+
+
+class KeysetPage(object):
+    """A page of keyset (seek) pagination results"""
+
+    def __init__(self, items, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def keyset_paginate(query, flag, key, per_page, cursor=None):
+    """Page through ``query`` ordered by ``flag`` DESC, then ``key`` DESC"""
+    forward = True
+    if cursor:
+        last_flag, last_key, direction = decode_cursor(cursor)
+        forward = direction == 'next'
+        segments = [(last_flag, last_key)]
+        if forward and last_flag:
+            segments.append((False, None))
+        elif not forward and not last_flag:
+            segments.append((True, None))
+    else:
+        segments = [(True, None), (False, None)]
+
+    query = query.order_by(None).distinct()
+    rows = []
+    for flag_value, bound in segments:
+        segment = query.filter(flag if flag_value else ~flag)
+        if forward:
+            if bound is not None:
+                segment = segment.filter(key < bound)
+            segment = segment.order_by(key.desc())
+        else:
+            if bound is not None:
+                segment = segment.filter(key > bound)
+            segment = segment.order_by(key.asc())
+        limit = per_page + 1 - len(rows)
+        rows.extend((flag_value, item) for item in segment.limit(limit))
+        if len(rows) > per_page:
+            break
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+    if not rows:
+        return KeysetPage([])
+
+    key_name = key.key
+    first_flag, first_item = rows[0]
+    last_flag, last_item = rows[-1]
+    prev_cursor = next_cursor = None
+    if (cursor and forward) or (not forward and has_more):
+        prev_cursor = encode_cursor(first_flag, getattr(first_item, key_name),
+                                    'prev')
+    if (forward and has_more) or not forward:
+        next_cursor = encode_cursor(last_flag, getattr(last_item, key_name),
+                                    'next')
+    return KeysetPage([item for _, item in rows], prev_cursor, next_cursor)
+
+
+class FetchAheadPage(object):
+    """A page of results paginated without counting them"""
+
+    def __init__(self, items, page, per_page, has_next, total=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+        self.total_is_estimate = has_next
+        seen = (page - 1) * per_page + len(items)
+        if not items and page > 1:
+            total = None
+        elif not has_next:
+            total = seen
+        elif total is not None:
+            total = max(total, seen + 1)
+        self.total = total
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def pages(self):
+        if not self.total:
+            return self.page
+        return max(int(math.ceil(self.total / float(self.per_page))),
+                   self.page)
+
+
+def fetch_ahead_paginate(query, page, per_page, estimate=None):
+    """Paginate ``query`` with one LIMIT/OFFSET query and no COUNT"""
+    page = max(page, 1)
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    has_next = len(rows) > per_page
+    total = estimate() if has_next and estimate else None
+    return FetchAheadPage(rows[:per_page], page, per_page, has_next, total)
+
+
+def estimate_count(query):
+    """Row count the Postgres planner expects ``query`` to return"""
+    session = query.session
+    bind = session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return None
+    compiled = query.order_by(None).statement.compile(dialect=bind.dialect)
+    plan = session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def department_officer_count(department_id):
+    """Number of officers in a department, cached until it changes"""
+    return SearchCache().count(
+        'department_officer_count', department_id,
+        lambda: OfficerSearch.query.filter_by(
+            department_id=department_id).count())
+
+
+def encode_stream_cursor(officer_id):
+    return _cursor_serializer('officer-stream').dumps(officer_id)
+
+
+def decode_stream_cursor(cursor):
+    """Unpack a cursor from encode_stream_cursor, raises BadData if invalid"""
+    officer_id = _cursor_serializer('officer-stream').loads(cursor)
+    if not isinstance(officer_id, (int, long)):
+        raise BadData('Malformed cursor')
+    return officer_id
 
 
-def grab_officers(form):
-    return filter_by_form(form, Officer.query)
+def officer_stream_query(form, after_id=None):
+    """Search results as plain rows in officer ID order, for streaming"""
+    query = grab_officers(form, sort=False).with_entities(
+        Officer.id, Officer.first_name, Officer.middle_initial,
+        Officer.last_name, Officer.race, Officer.gender, Officer.birth_year,
+        Officer.department_id, OfficerSearch.star_no,
+        OfficerSearch.rank_code, OfficerSearch.has_face)
+    if after_id is not None:
+        query = query.filter(Officer.id > after_id)
+    return query.order_by(Officer.id).execution_options(stream_results=True)
 
 
 def compute_leaderboard_stats(select_top=25):
     top_sorters = db.session.query(User, func.count(Image.user_id)) \
-                            .select_from(Image).join(User) \
+                            .select_from(Image) \
+                            .join(User, Image.user_id == User.id) \
                             .group_by(User) \
                             .order_by(func.count(Image.user_id).desc()) \
                             .limit(select_top).all()
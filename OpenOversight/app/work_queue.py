@@ -0,0 +1,227 @@
+"""Queues of images waiting for volunteers to sort or tag them"""
+import datetime
+import math
+
+from flask import current_app, has_app_context, session
+from sqlalchemy import event
+
+from .models import Department, Image, db
+from .upload_queue import AVAILABLE
+from .utils import get_random_images
+
+SORT = 'sort'
+TAG = 'tag'
+
+# Claims to try before giving up when other volunteers keep winning the
+# race for the images picked
+CLAIM_ATTEMPTS = 5
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def queue_filter(queue):
+    """Criterion for images waiting in the ``queue``, once uploaded"""
+    if queue == SORT:
+        return db.and_(Image.contains_cops == None,  # noqa
+                       Image.upload_state == AVAILABLE)
+    return db.and_(Image.contains_cops == True,  # noqa
+                   Image.is_tagged == False,  # noqa
+                   Image.upload_state == AVAILABLE)
+
+
+def waiting_images(queue, department_id=None):
+    query = Image.query.filter(queue_filter(queue))
+    if department_id:
+        query = query.filter(Image.department_id == department_id)
+    return query
+
+
+def lease_available(now):
+    return db.or_(Image.lease_expires_at == None,  # noqa
+                  Image.lease_expires_at <= now)
+
+
+def image_priority(campaign_weight, inserted_at, face_score):
+    """Priority of an image in the queues, highest first"""
+    config = current_app.config
+    age = (inserted_at or datetime.datetime.utcnow()) - EPOCH
+    days = age.total_seconds() / 86400
+    return config['PRIORITY_CAMPAIGN_WEIGHT'] * \
+        math.log(max(campaign_weight or 1.0, 0.01)) + \
+        config['PRIORITY_FACE_WEIGHT'] * (face_score or 0) - \
+        config['PRIORITY_AGE_WEIGHT'] * days
+
+
+@event.listens_for(Image, 'before_insert')
+def _prioritize_image(mapper, connection, image):
+    if image.priority is not None or not has_app_context():
+        return
+    campaign_weight = connection.scalar(
+        db.select([Department.campaign_weight])
+        .where(Department.id == image.department_id)) \
+        if image.department_id else None
+    image.priority = image_priority(campaign_weight,
+                                    image.date_image_inserted,
+                                    image.face_score)
+
+
+def reprioritize_images(department_id=None, batch_size=1000):
+    """Recompute image priorities, e.g. after a campaign weight changed"""
+    images = db.session.query(Image.id, Department.campaign_weight,
+                              Image.date_image_inserted, Image.face_score) \
+                       .outerjoin(Department,
+                                  Department.id == Image.department_id) \
+                       .order_by(Image.id)
+    if department_id:
+        images = images.filter(Image.department_id == department_id)
+    rows = []
+    count = 0
+    for image_id, campaign_weight, inserted_at, face_score \
+            in images.yield_per(batch_size):
+        rows.append({'id': image_id,
+                     'priority': image_priority(campaign_weight, inserted_at,
+                                                face_score)})
+        if len(rows) == batch_size:
+            db.session.bulk_update_mappings(Image, rows)
+            count += len(rows)
+            rows = []
+    db.session.bulk_update_mappings(Image, rows)
+    count += len(rows)
+    db.session.commit()
+    return count
+
+
+def next_images(available, count):
+    """Up to ``count`` images of a query in WORK_SCHEDULER order"""
+    if current_app.config['WORK_SCHEDULER'] == 'priority':
+        # The same order as the priority indexes, so that the database
+        # reads the first ``count`` entries instead of sorting the queue
+        return available.order_by(Image.priority.desc(),
+                                  Image.id).limit(count).all()
+    return get_random_images(available, count)
+
+
+def claim_images(queue, user_id, department_id=None, count=1):
+    """Lease up to ``count`` random images waiting in ``queue`` to a user"""
+    now = datetime.datetime.utcnow()
+    expires = now + datetime.timedelta(
+        seconds=current_app.config['IMAGE_LEASE_SECONDS'])
+    waiting = waiting_images(queue, department_id)
+
+    images = waiting.filter(Image.leased_by == user_id,
+                            Image.lease_expires_at > now) \
+                    .order_by(Image.id).limit(count).all()
+    for image in images:
+        image.lease_expires_at = expires
+    db.session.commit()
+
+    available = waiting.filter(lease_available(now))
+    if db.engine.dialect.name == 'postgresql':
+        available = available.with_for_update(skip_locked=True, of=Image)
+    for _ in range(CLAIM_ATTEMPTS):
+        if len(images) >= count:
+            break
+        candidates = [image.id for image
+                      in next_images(available, count - len(images))]
+        if not candidates:
+            break
+        Image.query.filter(Image.id.in_(candidates), lease_available(now)) \
+                   .update({'leased_by': user_id,
+                            'lease_expires_at': expires,
+                            'lease_count': Image.lease_count + 1},
+                           synchronize_session=False)
+        db.session.commit()
+        leased = dict((image.id, image) for image in Image.query.filter(
+            Image.id.in_(candidates), Image.leased_by == user_id))
+        images += [leased[image_id] for image_id in candidates
+                   if image_id in leased]
+    return images
+
+
+def claim_image(queue, user_id, department_id=None):
+    """Lease one random image waiting in the ``queue``, or return None"""
+    images = claim_images(queue, user_id, department_id)
+    return images[0] if images else None
+
+
+def buffered_images(queue, user_id, department_id=None):
+    """Images leased to a user to work on now and next, in order"""
+    key = 'work_buffer_{}_{}'.format(queue, department_id or 'all')
+    buffered = session.get(key, [])
+    images = []
+    if buffered:
+        leased = waiting_images(queue, department_id).filter(
+            Image.id.in_(buffered), Image.leased_by == user_id,
+            Image.lease_expires_at > datetime.datetime.utcnow())
+        found = dict((image.id, image) for image in leased)
+        images = [found[image_id] for image_id in buffered
+                  if image_id in found]
+    # Keep both the current image and the next one on hand
+    if len(images) < 2:
+        size = current_app.config['WORK_BUFFER_SIZE']
+        images += [image for image
+                   in claim_images(queue, user_id, department_id, size)
+                   if image not in images]
+        images = images[:size]
+    session[key] = [image.id for image in images]
+    return images
+
+
+def release_image(image):
+    """End the lease on an image, e.g. once it is sorted or tagged"""
+    image.leased_by = None
+    image.lease_expires_at = None
+
+
+def release_leases(image_ids, user_id):
+    """End a user's leases on images they passed over, in one UPDATE"""
+    if not image_ids:
+        return 0
+    return Image.query.filter(Image.id.in_(image_ids),
+                              Image.leased_by == user_id) \
+                      .update({'leased_by': None, 'lease_expires_at': None},
+                              synchronize_session=False)
+
+
+def classify_images(classifications, user_id):
+    """Record whether images contain police officers, in one UPDATE"""
+    if not classifications:
+        return 0
+    now = datetime.datetime.utcnow()
+    contains_cops = db.case(
+        dict((image_id, bool(value))
+             for image_id, value in classifications.items()),
+        value=Image.id)
+    return Image.query.filter(
+        Image.id.in_(list(classifications)),
+        queue_filter(SORT),
+        db.or_(Image.leased_by == user_id, lease_available(now))) \
+        .update({'contains_cops': contains_cops,
+                 'user_id': user_id,
+                 'leased_by': None,
+                 'lease_expires_at': None},
+                synchronize_session=False)
+
+
+def queue_metrics():
+    """Queue depth and lease churn of every department"""
+    now = datetime.datetime.utcnow()
+
+    def total(criterion, value=1):
+        return db.func.coalesce(
+            db.func.sum(db.case([(criterion, value)], else_=0)), 0)
+
+    waiting = db.or_(queue_filter(SORT), queue_filter(TAG))
+    rows = db.session.query(
+        Image.department_id,
+        total(queue_filter(SORT)),
+        total(queue_filter(TAG)),
+        total(db.and_(waiting, Image.lease_expires_at > now)),
+        total(db.and_(waiting, Image.lease_expires_at <= now)),
+        db.func.coalesce(db.func.sum(Image.lease_count), 0),
+        total(Image.lease_count > 1, Image.lease_count - 1)) \
+        .group_by(Image.department_id)
+    fields = ('unsorted', 'untagged', 'leased', 'expired', 'claims',
+              'reclaims')
+    return dict((row[0], dict(zip(fields, [int(value) for value in row[1:]])))
+                for row in rows)
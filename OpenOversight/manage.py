@@ -90,5 +90,72 @@ def link_officers_to_department():
     db.session.commit()
 
 
+@manager.command
+def rebuild_officer_search():
+    """Rebuild the denormalized officer_search table from scratch"""
+    from app.utils import rebuild_officer_search as rebuild
+    print "Rebuilding officer search table..."
+    count = rebuild()
+    print "Indexed {} officers".format(count)
+
+
+@manager.command
+def backfill_phonetic_keys():
+    """Compute the phonetic name keys used by fuzzy officer search"""
+    from app.utils import backfill_phonetic_keys as backfill
+    print "Computing phonetic name keys..."
+    count = backfill()
+    print "Updated {} officers".format(count)
+
+
+@manager.command
+def backfill_rank_codes():
+    """Normalize every assignment's rank using rank_normalizations"""
+    from app.utils import backfill_rank_codes as backfill
+    print "Normalizing assignment ranks..."
+    count = backfill()
+    print "Updated {} assignments".format(count)
+
+
+@manager.command
+def reprioritize_images():
+    """Recompute the priority of every image in the work queues"""
+    from app.work_queue import reprioritize_images as reprioritize
+    print "Reprioritizing images..."
+    count = reprioritize()
+    print "Updated {} images".format(count)
+
+
+@manager.command
+def set_campaign_weight(department_id, weight):
+    """Favor a department's images in the work queues by ``weight``"""
+    from app.models import Department, db
+    from app.work_queue import reprioritize_images as reprioritize
+    department = Department.query.get(int(department_id))
+    department.campaign_weight = float(weight)
+    db.session.commit()
+    count = reprioritize(department.id)
+    print "Reprioritized {} images of {}".format(count, department.name)
+
+
+@manager.command
+def show_upload_queue():
+    """Count uploaded images waiting to be pushed to storage"""
+    from app.upload_queue import upload_queue_status
+    status = upload_queue_status()
+    print "Pending: {pending} ({due} due now)".format(**status)
+    print "Failed: {failed}".format(**status)
+    print "Available: {available}".format(**status)
+
+
+@manager.command
+def drain_upload_queue(retry_failed=False):
+    """Push every pending upload that is due to storage now"""
+    from app.upload_queue import drain_uploads
+    print "Pushing pending uploads..."
+    pushed, failed = drain_uploads(retry_failed)
+    print "Pushed {} images, {} failed".format(pushed, failed)
+
+
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,55 @@
+"""Add raw_images.random_key for constant-time random image picks
+
+Revision ID: 2c8e5a93d716
+Revises: 9f1c2d7e84b6
+Create Date: 2018-06-25 19:44:08.519374
+
+"""
+import random
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8e5a93d716'
+down_revision = '9f1c2d7e84b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('raw_images',
+                  sa.Column('random_key', sa.Float(), nullable=True))
+
+    table = sa.table('raw_images', sa.column('id'), sa.column('random_key'))
+    connection = op.get_bind()
+    updates = [{'image_id': image_id, 'key': random.random()}
+               for image_id, in connection.execute(sa.select([table.c.id]))]
+    if updates:
+        connection.execute(
+            table.update()
+            .where(table.c.id == sa.bindparam('image_id'))
+            .values(random_key=sa.bindparam('key')),
+            updates)
+
+    op.create_index('ix_raw_images_unsorted_random_key', 'raw_images',
+                    ['department_id', 'random_key'], unique=False,
+                    postgresql_where=sa.text('contains_cops IS NULL'))
+    op.create_index('ix_raw_images_department_untagged_random_key',
+                    'raw_images',
+                    ['department_id', 'contains_cops', 'is_tagged',
+                     'random_key'], unique=False)
+    op.create_index('ix_raw_images_untagged_random_key', 'raw_images',
+                    ['random_key'], unique=False,
+                    postgresql_where=sa.text('contains_cops AND NOT is_tagged'))
+
+
+def downgrade():
+    op.drop_index('ix_raw_images_untagged_random_key',
+                  table_name='raw_images')
+    op.drop_index('ix_raw_images_department_untagged_random_key',
+                  table_name='raw_images')
+    op.drop_index('ix_raw_images_unsorted_random_key',
+                  table_name='raw_images')
+    op.drop_column('raw_images', 'random_key')
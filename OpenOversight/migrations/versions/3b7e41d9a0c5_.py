@@ -0,0 +1,73 @@
+"""Add digits-only badge numbers for indexed badge search
+
+Revision ID: 3b7e41d9a0c5
+Revises: 8d2a64c0f7b1
+Create Date: 2018-05-24 19:02:11.417380
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e41d9a0c5'
+down_revision = '8d2a64c0f7b1'
+branch_labels = None
+depends_on = None
+
+
+def backfill(table_name, key):
+    table = sa.table(table_name, sa.column(key), sa.column('star_no'),
+                     sa.column('star_no_digits'))
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([table.c[key], table.c.star_no])
+        .where(table.c.star_no != None)).fetchall()  # noqa
+    updates = [{'row_id': row_id,
+                'digits': re.sub(r'\D', '', u'{}'.format(star_no)) or None}
+               for row_id, star_no in rows]
+    if updates:
+        connection.execute(
+            table.update()
+            .where(table.c[key] == sa.bindparam('row_id'))
+            .values(star_no_digits=sa.bindparam('digits')),
+            updates)
+
+
+def upgrade():
+    op.add_column('assignments',
+                  sa.Column('star_no_digits', sa.String(length=120),
+                            nullable=True))
+    op.add_column('officer_search',
+                  sa.Column('star_no_digits', sa.String(length=120),
+                            nullable=True))
+    backfill('assignments', 'id')
+    backfill('officer_search', 'officer_id')
+
+    op.create_index('ix_assignments_star_no_digits', 'assignments',
+                    ['star_no_digits'], unique=False,
+                    postgresql_ops={'star_no_digits': 'varchar_pattern_ops'})
+    op.create_index('ix_assignments_star_no_digits_trgm', 'assignments',
+                    ['star_no_digits'], unique=False, postgresql_using='gin',
+                    postgresql_ops={'star_no_digits': 'gin_trgm_ops'})
+    op.create_index('ix_officer_search_department_star_no_digits',
+                    'officer_search', ['department_id', 'star_no_digits'],
+                    unique=False,
+                    postgresql_ops={'star_no_digits': 'varchar_pattern_ops'})
+    op.create_index('ix_officer_search_star_no_digits_trgm', 'officer_search',
+                    ['star_no_digits'], unique=False, postgresql_using='gin',
+                    postgresql_ops={'star_no_digits': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_officer_search_star_no_digits_trgm',
+                  table_name='officer_search')
+    op.drop_index('ix_officer_search_department_star_no_digits',
+                  table_name='officer_search')
+    op.drop_index('ix_assignments_star_no_digits_trgm',
+                  table_name='assignments')
+    op.drop_index('ix_assignments_star_no_digits', table_name='assignments')
+    op.drop_column('officer_search', 'star_no_digits')
+    op.drop_column('assignments', 'star_no_digits')
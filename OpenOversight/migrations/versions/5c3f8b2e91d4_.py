@@ -0,0 +1,26 @@
+"""Add a trigram index for officer name search
+
+Revision ID: 5c3f8b2e91d4
+Revises: e14a1aa4b58f
+Create Date: 2018-05-14 19:02:11.418270
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3f8b2e91d4'
+down_revision = 'e14a1aa4b58f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_officers_last_name_trgm', 'officers', ['last_name'],
+                    unique=False, postgresql_using='gin',
+                    postgresql_ops={'last_name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_officers_last_name_trgm', table_name='officers')
@@ -0,0 +1,39 @@
+"""Add leases on raw_images for the sorting and tagging queues
+
+Revision ID: 6d4a0b2f9e53
+Revises: 2c8e5a93d716
+Create Date: 2018-07-02 20:15:37.908162
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d4a0b2f9e53'
+down_revision = '2c8e5a93d716'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('raw_images',
+                  sa.Column('leased_by', sa.Integer(), nullable=True))
+    op.add_column('raw_images',
+                  sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+    op.add_column('raw_images',
+                  sa.Column('lease_count', sa.Integer(), server_default='0',
+                            nullable=False))
+    op.create_foreign_key('raw_images_leased_by_fkey', 'raw_images', 'users',
+                          ['leased_by'], ['id'])
+    op.create_index(op.f('ix_raw_images_leased_by'), 'raw_images',
+                    ['leased_by'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_raw_images_leased_by'), table_name='raw_images')
+    op.drop_constraint('raw_images_leased_by_fkey', 'raw_images',
+                       type_='foreignkey')
+    op.drop_column('raw_images', 'lease_count')
+    op.drop_column('raw_images', 'lease_expires_at')
+    op.drop_column('raw_images', 'leased_by')
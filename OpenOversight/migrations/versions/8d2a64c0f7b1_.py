@@ -0,0 +1,156 @@
+"""Add denormalized officer_search table
+
+The table is filled from officers, assignments and faces in the same
+INSERT ... SELECT that ``python manage.py rebuild_officer_search`` mirrors.
+
+Revision ID: 8d2a64c0f7b1
+Revises: 5c3f8b2e91d4
+Create Date: 2018-05-21 20:14:36.902114
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2a64c0f7b1'
+down_revision = '5c3f8b2e91d4'
+branch_labels = None
+depends_on = None
+
+# app.utils.RANK_CODES as of this revision, most specific first
+RANK_CODES = ('SUPT OF POLICE', 'DEPUTY SUPT', 'DEP CHIEF', 'CHIEF',
+              'COMMANDER', 'CAPTAIN', 'LIEUTENANT', 'SERGEANT', 'FIELD')
+
+
+def normalize_name(name):
+    """app.utils.normalize_name()"""
+    if not name:
+        return name
+    return re.sub(r'[^\w ]', u'', name.upper(), flags=re.UNICODE).strip()
+
+
+def normalized_name(column, dialect):
+    """SQL for normalize_name(), or just the name where the database has
+    no regular expressions to do it with"""
+    if dialect == 'postgresql':
+        return sa.func.btrim(sa.func.regexp_replace(
+            sa.func.upper(column), r'[^\w ]', '', 'g'))
+    return column
+
+
+def rank_code(column):
+    """SQL for app.utils.normalize_rank()"""
+    rank = sa.func.upper(sa.func.trim(column))
+    whens = [(rank == '', None)]
+    whens += [(rank.like('%{}%'.format(code)), code) for code in RANK_CODES]
+    whens.append((rank.like('%PO%'), 'PO'))
+    return sa.case(whens, else_=rank)
+
+
+def backfill():
+    officers = sa.table('officers', sa.column('id'),
+                        sa.column('department_id'), sa.column('last_name'),
+                        sa.column('first_name'), sa.column('race'),
+                        sa.column('gender'), sa.column('birth_year'))
+    assignments = sa.table('assignments', sa.column('id'),
+                           sa.column('officer_id'), sa.column('star_no'),
+                           sa.column('rank'), sa.column('star_date'),
+                           sa.column('resign_date'))
+    faces = sa.table('faces', sa.column('officer_id'))
+    officer_search = sa.table(
+        'officer_search', sa.column('officer_id'),
+        sa.column('department_id'), sa.column('last_name'),
+        sa.column('first_name'), sa.column('race'), sa.column('gender'),
+        sa.column('birth_year'), sa.column('rank_code'),
+        sa.column('star_no'), sa.column('has_face'))
+    dialect = op.get_bind().dialect.name
+
+    # Same pick as app.utils.current_assignment(): open assignments first,
+    # then the latest started, then the latest recorded
+    current = sa.select([assignments.c.id]) \
+        .where(assignments.c.officer_id == officers.c.id) \
+        .order_by(sa.case([(assignments.c.resign_date == None, 0)],  # noqa
+                          else_=1),
+                  sa.case([(assignments.c.star_date == None, 1)],  # noqa
+                          else_=0),
+                  assignments.c.star_date.desc(),
+                  assignments.c.id.desc()) \
+        .limit(1).correlate(officers).as_scalar()
+    rows = sa.select([
+        officers.c.id, officers.c.department_id,
+        normalized_name(officers.c.last_name, dialect),
+        normalized_name(officers.c.first_name, dialect),
+        officers.c.race, officers.c.gender, officers.c.birth_year,
+        rank_code(assignments.c.rank), assignments.c.star_no,
+        sa.exists().where(faces.c.officer_id == officers.c.id)
+    ]).select_from(officers.outerjoin(assignments,
+                                      assignments.c.id == current))
+    op.execute(officer_search.insert().from_select(
+        ['officer_id', 'department_id', 'last_name', 'first_name', 'race',
+         'gender', 'birth_year', 'rank_code', 'star_no', 'has_face'],
+        rows))
+
+    if dialect != 'postgresql':
+        connection = op.get_bind()
+        names = connection.execute(sa.select([
+            officer_search.c.officer_id, officer_search.c.last_name,
+            officer_search.c.first_name])).fetchall()
+        updates = [{'row_id': officer_id,
+                    'last': normalize_name(last_name),
+                    'first': normalize_name(first_name)}
+                   for officer_id, last_name, first_name in names]
+        if updates:
+            connection.execute(
+                officer_search.update()
+                .where(officer_search.c.officer_id == sa.bindparam('row_id'))
+                .values(last_name=sa.bindparam('last'),
+                        first_name=sa.bindparam('first')),
+                updates)
+
+
+def upgrade():
+    op.create_table(
+        'officer_search',
+        sa.Column('officer_id', sa.Integer(), nullable=False),
+        sa.Column('department_id', sa.Integer(), nullable=True),
+        sa.Column('last_name', sa.String(length=120), nullable=True),
+        sa.Column('first_name', sa.String(length=120), nullable=True),
+        sa.Column('race', sa.String(length=120), nullable=True),
+        sa.Column('gender', sa.String(length=120), nullable=True),
+        sa.Column('birth_year', sa.Integer(), nullable=True),
+        sa.Column('rank_code', sa.String(length=120), nullable=True),
+        sa.Column('star_no', sa.String(length=120), nullable=True),
+        sa.Column('has_face', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['department_id'], ['departments.id'], ),
+        sa.ForeignKeyConstraint(['officer_id'], ['officers.id'], ),
+        sa.PrimaryKeyConstraint('officer_id')
+    )
+    backfill()
+    op.create_index('ix_officer_search_department_order', 'officer_search',
+                    ['department_id', 'has_face', 'officer_id'], unique=False)
+    op.create_index('ix_officer_search_department_demographics',
+                    'officer_search',
+                    ['department_id', 'race', 'gender', 'rank_code'],
+                    unique=False)
+    op.create_index('ix_officer_search_birth_year', 'officer_search',
+                    ['birth_year'], unique=False)
+    op.create_index('ix_officer_search_star_no', 'officer_search',
+                    ['star_no'], unique=False)
+    op.create_index('ix_officer_search_last_name_trgm', 'officer_search',
+                    ['last_name'], unique=False, postgresql_using='gin',
+                    postgresql_ops={'last_name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_officer_search_last_name_trgm',
+                  table_name='officer_search')
+    op.drop_index('ix_officer_search_star_no', table_name='officer_search')
+    op.drop_index('ix_officer_search_birth_year', table_name='officer_search')
+    op.drop_index('ix_officer_search_department_demographics',
+                  table_name='officer_search')
+    op.drop_index('ix_officer_search_department_order',
+                  table_name='officer_search')
+    op.drop_table('officer_search')
@@ -0,0 +1,42 @@
+"""Add officer_search.change_seq for incremental snapshot refreshes
+
+Existing rows are all marked as changed at upgrade time, so the next
+snapshot refresh picks every one of them up.
+
+Revision ID: 9f1c2d7e84b6
+Revises: e5b0f72c4a19
+Create Date: 2018-06-18 21:12:45.203917
+
+"""
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f1c2d7e84b6'
+down_revision = 'e5b0f72c4a19'
+branch_labels = None
+depends_on = None
+
+
+def backfill():
+    officer_search = sa.table('officer_search', sa.column('change_seq'))
+    # app.utils.next_change_seq()
+    op.execute(officer_search.update().values(
+        change_seq=int(time.time() * 1000000)))
+
+
+def upgrade():
+    op.add_column('officer_search',
+                  sa.Column('change_seq', sa.BigInteger(), nullable=True))
+    backfill()
+    op.create_index('ix_officer_search_change_seq', 'officer_search',
+                    ['change_seq'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_officer_search_change_seq',
+                  table_name='officer_search')
+    op.drop_column('officer_search', 'change_seq')
@@ -0,0 +1,84 @@
+"""Add phonetic last name keys to officer_search and fuzzystrmatch
+
+The keys are computed for every existing row as part of the upgrade, the
+way ``python manage.py backfill_phonetic_keys`` does.
+
+Revision ID: a41c6e0f93d2
+Revises: 3b7e41d9a0c5
+Create Date: 2018-05-29 21:37:50.118264
+
+"""
+import re
+
+from alembic import op
+from metaphone import doublemetaphone
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c6e0f93d2'
+down_revision = '3b7e41d9a0c5'
+branch_labels = None
+depends_on = None
+
+
+def phonetic_keys(name):
+    """app.utils.phonetic_keys()"""
+    if name:
+        name = re.sub(r'[^\w ]', u'', name.upper(), flags=re.UNICODE).strip()
+    if not name:
+        return None, None
+    primary, alternate = doublemetaphone(name)
+    return primary or None, alternate or None
+
+
+def backfill():
+    officers = sa.table('officers', sa.column('id'), sa.column('last_name'))
+    officer_search = sa.table('officer_search', sa.column('officer_id'),
+                              sa.column('last_name_metaphone'),
+                              sa.column('last_name_metaphone_alt'))
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([officer_search.c.officer_id, officers.c.last_name])
+        .select_from(officer_search.join(
+            officers, officers.c.id == officer_search.c.officer_id))
+    ).fetchall()
+    updates = []
+    for officer_id, last_name in rows:
+        metaphone, metaphone_alt = phonetic_keys(last_name)
+        updates.append({'row_id': officer_id, 'metaphone': metaphone,
+                        'metaphone_alt': metaphone_alt})
+    if updates:
+        connection.execute(
+            officer_search.update()
+            .where(officer_search.c.officer_id == sa.bindparam('row_id'))
+            .values(last_name_metaphone=sa.bindparam('metaphone'),
+                    last_name_metaphone_alt=sa.bindparam('metaphone_alt')),
+            updates)
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS fuzzystrmatch')
+    op.add_column('officer_search',
+                  sa.Column('last_name_metaphone', sa.String(length=16),
+                            nullable=True))
+    op.add_column('officer_search',
+                  sa.Column('last_name_metaphone_alt', sa.String(length=16),
+                            nullable=True))
+    backfill()
+    op.create_index('ix_officer_search_department_metaphone',
+                    'officer_search', ['department_id', 'last_name_metaphone'],
+                    unique=False)
+    op.create_index('ix_officer_search_department_metaphone_alt',
+                    'officer_search',
+                    ['department_id', 'last_name_metaphone_alt'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_officer_search_department_metaphone_alt',
+                  table_name='officer_search')
+    op.drop_index('ix_officer_search_department_metaphone',
+                  table_name='officer_search')
+    op.drop_column('officer_search', 'last_name_metaphone_alt')
+    op.drop_column('officer_search', 'last_name_metaphone')
@@ -0,0 +1,38 @@
+"""Track background pushes of uploaded images to storage
+
+Revision ID: a4c7e2d91f35
+Revises: d7f2a6c3e918
+Create Date: 2018-07-23 19:41:06.352810
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e2d91f35'
+down_revision = 'd7f2a6c3e918'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('raw_images',
+                  sa.Column('upload_state', sa.String(length=16),
+                            server_default='available', nullable=False))
+    op.add_column('raw_images',
+                  sa.Column('upload_attempts', sa.Integer(),
+                            server_default='0', nullable=False))
+    op.add_column('raw_images',
+                  sa.Column('upload_retry_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_raw_images_pending_upload_retry_at', 'raw_images',
+                    ['upload_retry_at'], unique=False,
+                    postgresql_where=sa.text("upload_state = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_raw_images_pending_upload_retry_at',
+                  table_name='raw_images')
+    op.drop_column('raw_images', 'upload_retry_at')
+    op.drop_column('raw_images', 'upload_attempts')
+    op.drop_column('raw_images', 'upload_state')
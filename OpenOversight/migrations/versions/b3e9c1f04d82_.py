@@ -0,0 +1,85 @@
+"""Add image priorities and department campaign weights
+
+Every department starts with a campaign weight of 1 and no image has a
+face score yet, so existing images are prioritized by age alone, as
+``python manage.py reprioritize_images`` would.
+
+Revision ID: b3e9c1f04d82
+Revises: 6d4a0b2f9e53
+Create Date: 2018-07-09 18:52:21.640275
+
+"""
+import datetime
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e9c1f04d82'
+down_revision = '6d4a0b2f9e53'
+branch_labels = None
+depends_on = None
+
+
+# app.work_queue.EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def backfill():
+    """app.work_queue.image_priority() with neutral campaign weights and no
+    face scores"""
+    age_weight = current_app.config.get('PRIORITY_AGE_WEIGHT', 1)
+    raw_images = sa.table('raw_images', sa.column('id'),
+                          sa.column('date_image_inserted'),
+                          sa.column('priority'))
+    connection = op.get_bind()
+    now = datetime.datetime.utcnow()
+    rows = connection.execute(
+        sa.select([raw_images.c.id, raw_images.c.date_image_inserted])
+    ).fetchall()
+    updates = [{'row_id': image_id,
+                'priority': -age_weight * (
+                    (inserted_at or now) - EPOCH).total_seconds() / 86400}
+               for image_id, inserted_at in rows]
+    if updates:
+        connection.execute(
+            raw_images.update()
+            .where(raw_images.c.id == sa.bindparam('row_id'))
+            .values(priority=sa.bindparam('priority')),
+            updates)
+
+
+def upgrade():
+    op.add_column('departments',
+                  sa.Column('campaign_weight', sa.Float(), server_default='1',
+                            nullable=False))
+    op.add_column('raw_images',
+                  sa.Column('face_score', sa.Float(), nullable=True))
+    op.add_column('raw_images',
+                  sa.Column('priority', sa.Float(), server_default='-1e300',
+                            nullable=False))
+    backfill()
+    # In the order next_images() reads them, so that it can walk the index
+    priority_order = sa.text('priority DESC')
+    op.create_index('ix_raw_images_unsorted_priority', 'raw_images',
+                    ['department_id', priority_order, 'id'], unique=False,
+                    postgresql_where=sa.text('contains_cops IS NULL'))
+    op.create_index('ix_raw_images_department_untagged_priority',
+                    'raw_images',
+                    ['department_id', 'contains_cops', 'is_tagged',
+                     priority_order, 'id'], unique=False)
+    op.create_index('ix_raw_images_untagged_priority', 'raw_images',
+                    [priority_order, 'id'], unique=False,
+                    postgresql_where=sa.text('contains_cops AND NOT is_tagged'))
+
+
+def downgrade():
+    op.drop_index('ix_raw_images_untagged_priority', table_name='raw_images')
+    op.drop_index('ix_raw_images_department_untagged_priority',
+                  table_name='raw_images')
+    op.drop_index('ix_raw_images_unsorted_priority', table_name='raw_images')
+    op.drop_column('raw_images', 'priority')
+    op.drop_column('raw_images', 'face_score')
+    op.drop_column('departments', 'campaign_weight')
@@ -0,0 +1,71 @@
+"""Add rank_normalizations and assignments.rank_code
+
+Existing assignments get the codes ``python manage.py backfill_rank_codes``
+would give them with no rank_normalizations yet.
+
+Revision ID: c7d93e5a1b28
+Revises: a41c6e0f93d2
+Create Date: 2018-06-04 18:51:27.630518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d93e5a1b28'
+down_revision = 'a41c6e0f93d2'
+branch_labels = None
+depends_on = None
+
+# app.utils.RANK_CODES as of this revision, most specific first
+RANK_CODES = ('SUPT OF POLICE', 'DEPUTY SUPT', 'DEP CHIEF', 'CHIEF',
+              'COMMANDER', 'CAPTAIN', 'LIEUTENANT', 'SERGEANT', 'FIELD')
+
+
+def rank_code(column):
+    """SQL for app.utils.normalize_rank()"""
+    rank = sa.func.upper(sa.func.trim(column))
+    whens = [(rank == '', None)]
+    whens += [(rank.like('%{}%'.format(code)), code) for code in RANK_CODES]
+    whens.append((rank.like('%PO%'), 'PO'))
+    return sa.case(whens, else_=rank)
+
+
+def backfill():
+    assignments = sa.table('assignments', sa.column('rank'),
+                           sa.column('rank_code'))
+    op.execute(assignments.update().values(
+        rank_code=rank_code(assignments.c.rank)))
+
+
+def upgrade():
+    op.create_table(
+        'rank_normalizations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('department_id', sa.Integer(), nullable=True),
+        sa.Column('raw_rank', sa.String(length=120), nullable=False),
+        sa.Column('rank_code', sa.String(length=120), nullable=False),
+        sa.ForeignKeyConstraint(['department_id'], ['departments.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('department_id', 'raw_rank',
+                            name='unique_rank_normalizations')
+    )
+    op.create_index('unique_rank_normalizations_default',
+                    'rank_normalizations', ['raw_rank'], unique=True,
+                    postgresql_where=sa.text('department_id IS NULL'),
+                    sqlite_where=sa.text('department_id IS NULL'))
+    op.add_column('assignments',
+                  sa.Column('rank_code', sa.String(length=120),
+                            nullable=True))
+    backfill()
+    op.create_index(op.f('ix_assignments_rank_code'), 'assignments',
+                    ['rank_code'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_assignments_rank_code'), table_name='assignments')
+    op.drop_column('assignments', 'rank_code')
+    op.drop_index('unique_rank_normalizations_default',
+                  table_name='rank_normalizations')
+    op.drop_table('rank_normalizations')
@@ -0,0 +1,37 @@
+"""Add a unique index on raw_images.hash_img
+
+Images already uploaded more than once keep the hash on their first
+copy only, so that the index can be created.
+
+Revision ID: d7f2a6c3e918
+Revises: b3e9c1f04d82
+Create Date: 2018-07-16 20:07:49.118536
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f2a6c3e918'
+down_revision = 'b3e9c1f04d82'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    images = sa.table('raw_images', sa.column('id'), sa.column('hash_img'))
+    first_copies = sa.select([sa.func.min(images.c.id)]) \
+        .where(images.c.hash_img != None) \
+        .group_by(images.c.hash_img)  # noqa
+    op.get_bind().execute(
+        images.update()
+        .where(images.c.hash_img != None)  # noqa
+        .where(~images.c.id.in_(first_copies))
+        .values(hash_img=None))
+    op.create_index(op.f('ix_raw_images_hash_img'), 'raw_images',
+                    ['hash_img'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_raw_images_hash_img'), table_name='raw_images')
@@ -0,0 +1,92 @@
+"""Add unit boundaries and officer_search.unit_id
+
+officer_search.unit_id is filled from each officer's current assignment,
+as ``python manage.py rebuild_officer_search`` does. Where PostGIS is
+installed unit boundaries also get a GiST index for location searches.
+
+Revision ID: e5b0f72c4a19
+Revises: c7d93e5a1b28
+Create Date: 2018-06-11 20:26:03.774125
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b0f72c4a19'
+down_revision = 'c7d93e5a1b28'
+branch_labels = None
+depends_on = None
+
+
+def has_postgis():
+    connection = op.get_bind()
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'postgis'"
+    ).scalar() is not None
+
+
+def backfill():
+    assignments = sa.table('assignments', sa.column('id'),
+                           sa.column('officer_id'), sa.column('unit'),
+                           sa.column('star_date'), sa.column('resign_date'))
+    officer_search = sa.table('officer_search', sa.column('officer_id'),
+                              sa.column('unit_id'))
+    # Same pick as app.utils.current_assignment(): open assignments first,
+    # then the latest started, then the latest recorded
+    current_unit = sa.select([assignments.c.unit]) \
+        .where(assignments.c.officer_id == officer_search.c.officer_id) \
+        .order_by(sa.case([(assignments.c.resign_date == None, 0)],  # noqa
+                          else_=1),
+                  sa.case([(assignments.c.star_date == None, 1)],  # noqa
+                          else_=0),
+                  assignments.c.star_date.desc(),
+                  assignments.c.id.desc()) \
+        .limit(1).correlate(officer_search).as_scalar()
+    op.execute(officer_search.update().values(unit_id=current_unit))
+
+
+def upgrade():
+    op.add_column('unit_types', sa.Column('boundary', sa.Text(),
+                                          nullable=True))
+    op.add_column('unit_types', sa.Column('min_latitude', sa.Float(),
+                                          nullable=True))
+    op.add_column('unit_types', sa.Column('min_longitude', sa.Float(),
+                                          nullable=True))
+    op.add_column('unit_types', sa.Column('max_latitude', sa.Float(),
+                                          nullable=True))
+    op.add_column('unit_types', sa.Column('max_longitude', sa.Float(),
+                                          nullable=True))
+    op.create_index('ix_unit_types_bounding_box', 'unit_types',
+                    ['min_latitude', 'max_latitude',
+                     'min_longitude', 'max_longitude'], unique=False)
+    if has_postgis():
+        op.execute('CREATE INDEX ix_unit_types_boundary_gist ON unit_types '
+                   'USING gist (ST_SetSRID(ST_GeomFromGeoJSON(boundary), '
+                   '4326))')
+
+    op.add_column('officer_search', sa.Column('unit_id', sa.Integer(),
+                                              nullable=True))
+    backfill()
+    op.create_foreign_key('officer_search_unit_id_fkey', 'officer_search',
+                          'unit_types', ['unit_id'], ['id'])
+    op.create_index('ix_officer_search_department_unit', 'officer_search',
+                    ['department_id', 'unit_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_officer_search_department_unit',
+                  table_name='officer_search')
+    op.drop_constraint('officer_search_unit_id_fkey', 'officer_search',
+                       type_='foreignkey')
+    op.drop_column('officer_search', 'unit_id')
+    op.execute('DROP INDEX IF EXISTS ix_unit_types_boundary_gist')
+    op.drop_index('ix_unit_types_bounding_box', table_name='unit_types')
+    op.drop_column('unit_types', 'max_longitude')
+    op.drop_column('unit_types', 'max_latitude')
+    op.drop_column('unit_types', 'min_longitude')
+    op.drop_column('unit_types', 'min_latitude')
+    op.drop_column('unit_types', 'boundary')
@@ -10,6 +10,8 @@ from xvfbwrapper import Xvfb
 from OpenOversight.app import create_app
 from OpenOversight.app import models
 from OpenOversight.app.models import db as _db
+from OpenOversight.app.storage import s3_clients
+from OpenOversight.app.utils import rebuild_officer_search
 
 
 OFFICERS = [('IVANA', '', 'TINKLE'),
@@ -107,6 +109,12 @@ def app(request):
     return app
 
 
+@pytest.fixture(autouse=True)
+def fresh_s3_client(app):
+    """New S3 client for every test, so tests can patch boto3.client"""
+    s3_clients.reset()
+
+
 @pytest.fixture(scope='session')
 def db(app, request):
     """Session-wide test database."""
@@ -185,6 +193,8 @@ def mockdata(session, request):
     session.add_all(assignments)
     session.add_all(faces1)
     session.add_all(faces2)
+    session.commit()
+    rebuild_officer_search()
 
     test_user = models.User(email='jen@example.org',
                             username='test_user',
@@ -222,10 +232,12 @@ def mockdata(session, request):
     def teardown():
         # Cleanup tables
         models.User.query.delete()
+        models.OfficerSearch.query.delete()
         models.Officer.query.delete()
         models.Image.query.delete()
         models.Face.query.delete()
         models.Unit.query.delete()
+        models.RankNormalization.query.delete()
         models.Department.query.delete()
         session.commit()
         session.flush()
@@ -0,0 +1,212 @@
+# Regression benchmarks for the officer search queries and the image work
+# queues; run with ``pytest -s tests/test_benchmarks.py`` to see the timings
+import datetime
+import random
+import time
+
+from flask import current_app
+
+from OpenOversight.app import work_queue
+from OpenOversight.app.models import (Assignment, Department, Face, Image,
+                                      Officer, User, db)
+from OpenOversight.app.utils import (filter_by_form, roster_lookup,
+                                     update_officer_search)
+
+FACES_PER_OFFICER = 40
+EXTRA_ASSIGNMENTS = 2
+TAGGED_OFFICERS = 10
+RUNS = 5
+BACKLOG_PER_DEPARTMENT = 150
+BACKLOG_DAYS = 30
+CAMPAIGN_WEIGHT = 4.0
+
+
+def joined_roster_query(form):
+    """The roster search as it was when it joined every assignment and face"""
+    return Officer.query.join(Assignment) \
+                        .filter(Officer.department_id == form['dept'].id) \
+                        .outerjoin(Face) \
+                        .order_by(Face.officer_id.asc()) \
+                        .order_by(Officer.id.desc())
+
+
+def joined_gallery_query(form):
+    """The gallery search as it was when it joined every assignment and face"""
+    return Officer.query.filter(Officer.department_id == form['dept'].id) \
+                        .join(Assignment) \
+                        .outerjoin(Face) \
+                        .order_by(Face.officer_id.asc()) \
+                        .order_by(Officer.id.desc())
+
+
+def fetch_rows(query):
+    """Run ``query`` and return the raw rows, as the database sends them"""
+    return db.session.execute(query.statement).fetchall()
+
+
+def best_time(query):
+    timings = []
+    for _ in range(RUNS):
+        start = time.time()
+        fetch_rows(query)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def tag_many_faces(department):
+    """Give a few officers many faces and assignments; returns what to
+    delete afterwards"""
+    officers = Officer.query.filter(Officer.department_id == department.id,
+                                    Officer.assignments.any()) \
+                            .limit(TAGGED_OFFICERS).all()
+    images = [Image(filepath='/static/images/test_cop{}.png'.format(i),
+                    department_id=department.id)
+              for i in range(FACES_PER_OFFICER)]
+    db.session.add_all(images)
+    db.session.flush()
+    added = [Face(officer_id=officer.id, img_id=image.id)
+             for officer in officers for image in images]
+    added += [Assignment(officer_id=officer.id, star_no=str(officer.id))
+              for officer in officers
+              for _ in range(EXTRA_ASSIGNMENTS)]
+    db.session.add_all(added)
+    db.session.commit()
+    for officer in officers:
+        update_officer_search(officer)
+    db.session.commit()
+    return added + images
+
+
+def delete_all(rows):
+    for row in rows:
+        db.session.delete(row)
+    db.session.commit()
+
+
+def check_one_row_per_officer(joined, current, expected_count):
+    joined_rows = len(fetch_rows(joined))
+    current_ids = [row[0] for row in fetch_rows(current)]
+    assert len(current_ids) == len(set(current_ids))
+    assert len(current_ids) == expected_count
+    assert joined_rows >= len(current_ids) + \
+        TAGGED_OFFICERS * (FACES_PER_OFFICER * (EXTRA_ASSIGNMENTS + 1) - 1)
+    # Tagged officers still sort first
+    tagged = set(officer_id for officer_id,
+                 in db.session.query(Face.officer_id))
+    has_face = [officer_id in tagged for officer_id in current_ids]
+    assert has_face == sorted(has_face, reverse=True)
+    return joined_rows, len(current_ids)
+
+
+def test_roster_search_rows_do_not_multiply_with_faces(mockdata):
+    department = Department.query.first()
+    added = tag_many_faces(department)
+    try:
+        form = {'dept': department, 'name': '', 'badge': ''}
+        joined = joined_roster_query(form)
+        current = roster_lookup(form)
+        joined_rows, rows = check_one_row_per_officer(
+            joined, current, Officer.query.filter(
+                Officer.department_id == department.id,
+                Officer.assignments.any()).count())
+
+        print('\nroster search: {} joined rows in {:.4f}s, '
+              '{} rows in {:.4f}s'.format(joined_rows, best_time(joined),
+                                          rows, best_time(current)))
+    finally:
+        delete_all(added)
+
+
+def test_gallery_search_rows_do_not_multiply_with_faces(mockdata):
+    department = Department.query.first()
+    added = tag_many_faces(department)
+    try:
+        form = {'dept': department, 'name': '', 'badge': '',
+                'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+                'min_age': 0, 'max_age': 200}
+        joined = joined_gallery_query(form)
+        current = filter_by_form(form, Officer.query)
+        joined_rows, rows = check_one_row_per_officer(
+            joined, current, Officer.query.filter(
+                Officer.department_id == department.id).count())
+
+        print('\ngallery search: {} joined rows in {:.4f}s, '
+              '{} rows in {:.4f}s'.format(joined_rows, best_time(joined),
+                                          rows, best_time(current)))
+    finally:
+        delete_all(added)
+
+
+def simulate_sorting(users, campaign):
+    """Have volunteers take turns sorting until the queue is empty.
+
+    Returns how many images were sorted before the ``campaign``
+    department's backlog was done, and the images sorted per second.
+    """
+    sorted_images = 0
+    campaign_done = None
+    start = time.time()
+    while True:
+        progress = False
+        for user in users:
+            image = work_queue.claim_image(work_queue.SORT, user.id)
+            if image is None:
+                continue
+            work_queue.classify_images({image.id: False}, user.id)
+            db.session.commit()
+            sorted_images += 1
+            progress = True
+            if campaign_done is None and not work_queue.waiting_images(
+                    work_queue.SORT, campaign.id).count():
+                campaign_done = sorted_images
+        if not progress:
+            return campaign_done, sorted_images / (time.time() - start)
+
+
+def test_priority_scheduler_clears_campaign_backlog_first(mockdata):
+    rng = random.Random(current_app.config['SEED'])
+    now = datetime.datetime.utcnow()
+    departments = Department.query.order_by(Department.id).all()
+    campaign = departments[-1]
+    images = [Image(filepath='/static/images/test_cop{}.png'.format(i % 5),
+                    department_id=department.id,
+                    date_image_inserted=now - datetime.timedelta(
+                        days=rng.uniform(0, BACKLOG_DAYS)),
+                    face_score=rng.choice([None, 0, 1, 2]))
+              for department in departments
+              for i in range(BACKLOG_PER_DEPARTMENT)]
+    db.session.add_all(images)
+    campaign.campaign_weight = CAMPAIGN_WEIGHT
+    db.session.commit()
+    work_queue.reprioritize_images()
+    users = User.query.all()
+    campaign_backlog = work_queue.waiting_images(work_queue.SORT,
+                                                 campaign.id).count()
+
+    results = {}
+    try:
+        for scheduler in ('random', 'priority'):
+            Image.query.update({'contains_cops': None, 'leased_by': None,
+                                'lease_expires_at': None, 'lease_count': 0},
+                               synchronize_session=False)
+            db.session.commit()
+            current_app.config['WORK_SCHEDULER'] = scheduler
+            results[scheduler] = simulate_sorting(users, campaign)
+    finally:
+        current_app.config['WORK_SCHEDULER'] = 'random'
+        for image in images:
+            db.session.delete(image)
+        campaign.campaign_weight = 1.0
+        db.session.commit()
+        Image.query.update({'contains_cops': None, 'leased_by': None,
+                            'lease_expires_at': None, 'lease_count': 0},
+                           synchronize_session=False)
+        db.session.commit()
+
+    # The campaign outweighs any difference in age, so it goes first
+    assert results['priority'][0] == campaign_backlog
+    assert results['random'][0] > campaign_backlog
+    for scheduler, (campaign_done, throughput) in sorted(results.items()):
+        print('\n{} scheduler: campaign backlog of {} done after {} images, '
+              '{:.1f} images sorted per second'.format(
+                  scheduler, campaign_backlog, campaign_done, throughput))
@@ -1,11 +1,20 @@
 # Routing and view tests
+import datetime
+from io import BytesIO
+import json
+import os
+import re
 import pytest
 import random
 from flask import url_for, current_app
 from urlparse import urlparse
 from .conftest import AC_DEPT
-from ..app.utils import dept_choices
+from mock import patch, Mock
+from ..app.utils import (compute_hash, dept_choices, serve_image,
+                         update_officer_search)
 from ..app.main.choices import RACE_CHOICES, GENDER_CHOICES
+from ..app import uploaded_hashes
+from ..app.upload_queue import upload_queue
 
 from OpenOversight.app.main.forms import (FindOfficerIDForm, AssignmentForm,
                                           FaceTag, DepartmentForm,
@@ -16,7 +25,7 @@ from OpenOversight.app.auth.forms import (LoginForm, RegistrationForm,
                                           PasswordResetRequestForm,
                                           ChangeEmailForm, ChangeDefaultDepartmentForm, EditUserForm)
 from OpenOversight.app.models import (User, Face, Department, Unit, Officer,
-                                      Image)
+                                      Image, OfficerSearch)
 
 
 @pytest.mark.parametrize("route", [
@@ -132,6 +141,136 @@ def test_tagger_gallery_bad_form(client, session):
         assert urlparse(rv.location).path == '/tagger_find'
 
 
+def test_gallery_offset_pagination(mockdata, client, session):
+    with current_app.test_request_context():
+        data = {'dept': 1, 'name': '', 'badge': '', 'rank': 'Not Sure',
+                'race': 'Not Sure', 'gender': 'Not Sure',
+                'min_age': 16, 'max_age': 85}
+        rv = client.post(url_for('main.get_gallery'), data=data)
+        assert rv.status_code == 200
+        assert 'Gallery 1 of' in rv.data
+
+
+def test_gallery_serves_locally_stored_faces(mockdata, client, session):
+    with current_app.test_request_context():
+        for image in Image.query:
+            image.filepath = 'local:ab/cdef{}.png'.format(image.id)
+        session.commit()
+        data = {'dept': 1, 'name': '', 'badge': '', 'rank': 'Not Sure',
+                'race': 'Not Sure', 'gender': 'Not Sure',
+                'min_age': 16, 'max_age': 85}
+        rv = client.post(url_for('main.get_gallery'), data=data)
+        assert rv.status_code == 200
+        assert 'local:' not in rv.data
+        served = re.findall(r'src="(/images/ab/cdef\d+\.png)"', rv.data)
+        assert served
+
+
+def test_gallery_shows_placeholders_for_unstored_faces(mockdata, client,
+                                                       session):
+    with current_app.test_request_context():
+        for image in Image.query:
+            image.filepath = 'staged:ab/cdef{}.png'.format(image.id)
+            image.upload_state = 'pending'
+        session.commit()
+        data = {'dept': 1, 'name': '', 'badge': '', 'rank': 'Not Sure',
+                'race': 'Not Sure', 'gender': 'Not Sure',
+                'min_age': 16, 'max_age': 85}
+        rv = client.post(url_for('main.get_gallery'), data=data)
+        assert rv.status_code == 200
+        assert 'staged:' not in rv.data
+        assert 'src="None"' not in rv.data
+        assert 'src="/static/images/placeholder.png"' in rv.data
+
+
+def test_complaint_without_a_face_shows_the_placeholder(client, session):
+    with current_app.test_request_context():
+        rv = client.get(url_for('main.submit_complaint',
+                                officer_first_name='HUGH',
+                                officer_last_name='BUTZ'))
+        assert rv.status_code == 200
+        assert 'src="/static/images/placeholder.png"' in rv.data
+
+
+def test_gallery_keyset_pagination(mockdata, client, session):
+    with current_app.test_request_context():
+        current_app.config['GALLERY_PAGINATION'] = 'keyset'
+        try:
+            data = {'dept': 1, 'name': '', 'badge': '', 'rank': 'Not Sure',
+                    'race': 'Not Sure', 'gender': 'Not Sure',
+                    'min_age': 16, 'max_age': 85}
+            rv = client.post(url_for('main.get_gallery'), data=data)
+            assert rv.status_code == 200
+            assert 'cursor=' in rv.data
+            assert 'Gallery 1 of' not in rv.data
+
+            rv = client.post(url_for('main.get_gallery', cursor='tampered'),
+                             data=data)
+            assert rv.status_code == 400
+        finally:
+            current_app.config['GALLERY_PAGINATION'] = 'offset'
+
+
+def test_gallery_fuzzy_name_search(mockdata, client, session):
+    with current_app.test_request_context():
+        officer = Officer.query.filter_by(department_id=1).first()
+        officer.last_name = 'Smyth'
+        update_officer_search(officer)
+        session.commit()
+        data = {'dept': 1, 'name': 'Smith', 'fuzzy': 'y', 'badge': '',
+                'rank': 'Not Sure', 'race': 'Not Sure',
+                'gender': 'Not Sure', 'min_age': 16, 'max_age': 85}
+        rv = client.post(url_for('main.get_gallery'), data=data)
+        assert rv.status_code == 200
+        assert 'Smyth' in rv.data
+
+
+def test_officer_search_stream_continues_from_cursor(mockdata, client, session):
+    with current_app.test_request_context():
+        rv = client.get(url_for('main.stream_officers', dept=1, limit=5))
+        assert rv.status_code == 200
+        assert rv.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in rv.data.splitlines()]
+        assert len(lines) == 6
+        officer_ids = [line['id'] for line in lines[:5]]
+        assert officer_ids == sorted(officer_ids)
+        assert all(line['department_id'] == 1 for line in lines[:5])
+
+        rv = client.get(url_for('main.stream_officers', dept=1, limit=5,
+                                cursor=lines[-1]['next_cursor']))
+        next_ids = [json.loads(line)['id'] for line in rv.data.splitlines()
+                    if 'id' in json.loads(line)]
+        assert next_ids[0] > officer_ids[-1]
+
+        rv = client.get(url_for('main.stream_officers', dept=1))
+        lines = rv.data.splitlines()
+        assert len(lines) == Officer.query.filter_by(department_id=1).count()
+
+
+def test_officer_search_stream_rejects_bad_parameters(mockdata, client,
+                                                      session):
+    with current_app.test_request_context():
+        rv = client.get(url_for('main.stream_officers'))
+        assert rv.status_code == 400
+        rv = client.get(url_for('main.stream_officers', dept=1,
+                                cursor='tampered'))
+        assert rv.status_code == 400
+
+
+def test_search_facets_returns_counts_per_option(mockdata, client, session):
+    with current_app.test_request_context():
+        rv = client.get(url_for('main.search_facets', dept=1, gender='F'))
+        assert rv.status_code == 200
+        counts = json.loads(rv.data)
+        assert counts['gender']['Not Sure'] == \
+            Officer.query.filter_by(department_id=1).count()
+        assert counts['total'] == counts['gender']['F']
+        assert set(counts) == set(['race', 'gender', 'rank', 'total'])
+
+        rv = client.get(url_for('main.search_facets'))
+        assert rv.status_code == 400
+
+
 def login_user(client):
     form = LoginForm(email='jen@example.org',
                      password='dog',
@@ -209,6 +348,249 @@ def test_logged_in_user_can_access_sort_form(mockdata, client, session):
         assert 'Do you see police officers in the photo' in rv.data
 
 
+def test_admin_can_see_work_queue_metrics(mockdata, client, session):
+    with current_app.test_request_context():
+        login_user(client)
+        rv = client.get(url_for('main.work_queue_metrics'))
+        assert rv.status_code == 403
+
+        login_admin(client)
+        rv = client.get(url_for('main.work_queue_metrics'))
+        departments = json.loads(rv.data)['departments']
+        assert [department['department_id']
+                for department in departments] == [1, 2]
+        assert departments[0]['unsorted'] == 5
+
+
+def test_user_can_sort_images_in_batches(mockdata, client, session):
+    with current_app.test_request_context():
+        login_user(client)
+        rv = client.get(url_for('main.sort_batch', department_id=1, count=3))
+        images = json.loads(rv.data)['images']
+        assert len(images) == 3
+        assert all(Image.query.get(image['id']).department_id == 1
+                   for image in images)
+
+        body = {'classifications': {str(images[0]['id']): True,
+                                    str(images[1]['id']): False},
+                'skipped': [images[2]['id']]}
+        rv = client.post(url_for('main.classify_batch'),
+                         data=json.dumps(body),
+                         content_type='application/json')
+        assert json.loads(rv.data) == {'classified': 2}
+        assert Image.query.get(images[0]['id']).contains_cops is True
+        assert Image.query.get(images[1]['id']).contains_cops is False
+        skipped = Image.query.get(images[2]['id'])
+        assert skipped.contains_cops is None and skipped.leased_by is None
+
+
+def test_batch_classification_rejects_bad_answers(mockdata, client, session):
+    with current_app.test_request_context():
+        login_user(client)
+        for body in ({'classifications': {'1': 'yes'}},
+                     {'classifications': {'one': True}},
+                     {'classifications': [1]},
+                     {'classifications': {}, 'skipped': ['x']}):
+            rv = client.post(url_for('main.classify_batch'),
+                             data=json.dumps(body),
+                             content_type='application/json')
+            assert rv.status_code == 400
+        rv = client.get(url_for('main.sort_batch', department_id=1, count=0))
+        assert rv.status_code == 400
+
+
+def test_sort_page_preloads_the_next_buffered_image(mockdata, client, session):
+    with current_app.test_request_context():
+        login_user(client)
+
+        def sort_page():
+            rv = client.get(url_for('main.sort_images', department_id=1))
+            current = re.search(r'data-image-id="(\d+)"', rv.data).group(1)
+            following = re.search(r'data-next-image-id="(\d+)"', rv.data)
+            return rv.data, int(current), int(following.group(1))
+
+        data, current, following = sort_page()
+        assert '<link rel="preload" as="image"' in data
+        assert sort_page()[1:] == (current, following)
+
+        client.post(url_for('main.classify_submission', image_id=current,
+                            contains_cops=0),
+                    headers={'Referer': url_for('main.sort_images',
+                                                department_id=1)})
+        assert sort_page()[1] == following
+
+
+def test_upload_streams_image_to_s3(mockdata, client, session):
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(test_dir, '../app/static/images/test_cop1.png'),
+              'rb') as f:
+        data = f.read()
+    # Bigger than the in-memory part of the spooled upload
+    data += '\0' * current_app.config['UPLOAD_SPOOL_SIZE']
+    hash_img = compute_hash(data)
+    with current_app.test_request_context():
+        mocked_connection = Mock()
+        with patch('boto3.client', Mock(return_value=mocked_connection)):
+            rv = client.post(
+                url_for('main.upload', department_id=1),
+                data={'file': (BytesIO(data), 'test_cop1.png')})
+            assert rv.status_code == 200
+            assert 'store;dur=' in rv.headers['Server-Timing']
+            rv = client.post(
+                url_for('main.upload', department_id=1),
+                data={'file': (BytesIO(data), 'test_cop1.png')})
+            assert rv.status_code == 400
+
+        uploaded, bucket, s3_path = \
+            mocked_connection.upload_fileobj.call_args[0]
+        assert s3_path == '{}/{}.png'.format(hash_img[:2], hash_img[2:])
+        assert uploaded.closed
+        image = Image.query.filter_by(hash_img=hash_img).one()
+        assert image.department_id == 1
+        session.delete(image)
+        session.commit()
+
+
+def test_upload_race_is_settled_by_unique_hash(mockdata, client, session):
+    data = 'GIF89a' + '\0' * 100
+    hash_img = compute_hash(data)
+    with current_app.test_request_context():
+        # Bloom filter warmed by an earlier request of this app
+        client.get(url_for('main.index'))
+        # Inserted by another process, so this one's filter misses it
+        session.add(Image(filepath='elsewhere', hash_img=hash_img,
+                          department_id=1))
+        session.commit()
+        assert current_app.extensions['uploaded_hashes'] is not None
+        assert hash_img not in current_app.extensions['uploaded_hashes']
+
+        with patch('boto3.client') as s3_client:
+            rv = client.post(url_for('main.upload', department_id=1),
+                             data={'file': (BytesIO(data), 'dup.gif')})
+        assert rv.status_code == 400
+        assert 'already uploaded' in rv.data
+        assert hash_img in current_app.extensions['uploaded_hashes']
+        # Turned away before anything was pushed
+        assert not s3_client.return_value.upload_fileobj.called
+
+
+def test_failed_upload_gives_its_hash_back(mockdata, client, session):
+    data = 'GIF89a' + 'unreachable'
+    hash_img = compute_hash(data)
+    with current_app.test_request_context():
+        s3 = Mock()
+        s3.upload_fileobj.side_effect = IOError('S3 is down')
+        with patch('boto3.client', Mock(return_value=s3)):
+            rv = client.post(url_for('main.upload', department_id=1),
+                             data={'file': (BytesIO(data), 'down.gif')})
+        assert rv.status_code == 500
+        assert s3.upload_fileobj.called
+        assert Image.query.filter_by(hash_img=hash_img).count() == 0
+
+
+def test_upload_failing_to_record_its_file_gives_its_hash_back(
+        mockdata, client, session):
+    data = 'GIF89a' + 'lost commit'
+    hash_img = compute_hash(data)
+    with current_app.test_request_context():
+        # The claim commits, then recording the stored file fails
+        commit = session.commit
+        failures = [None, IOError('database went away')]
+
+        def flaky_commit():
+            if failures:
+                failure = failures.pop(0)
+                if failure is not None:
+                    raise failure
+            commit()
+
+        with patch('boto3.client'), \
+                patch.object(session, 'commit', side_effect=flaky_commit):
+            rv = client.post(url_for('main.upload', department_id=1),
+                             data={'file': (BytesIO(data), 'lost.gif')})
+        assert rv.status_code == 500
+        assert Image.query.filter_by(hash_img=hash_img).count() == 0
+
+
+def test_upload_takes_over_an_abandoned_claim(mockdata, client, session):
+    data = 'GIF89a' + 'abandoned'
+    hash_img = compute_hash(data)
+    now = datetime.datetime.utcnow()
+    with current_app.test_request_context():
+        # Claimed by an upload that died before storing the file
+        claim = Image(hash_img=hash_img, department_id=1,
+                      upload_state='pending',
+                      upload_retry_at=now + datetime.timedelta(minutes=5))
+        session.add(claim)
+        session.commit()
+        uploaded_hashes.add(hash_img)
+        with patch('boto3.client'):
+            rv = client.post(url_for('main.upload', department_id=1),
+                             data={'file': (BytesIO(data), 'abandoned.gif')})
+            # Still within its lease, so maybe only slow
+            assert rv.status_code == 400
+
+            claim.upload_retry_at = now - datetime.timedelta(minutes=5)
+            session.commit()
+            rv = client.post(url_for('main.upload', department_id=1),
+                             data={'file': (BytesIO(data), 'abandoned.gif')})
+            assert rv.status_code == 200
+        image = Image.query.filter_by(hash_img=hash_img).one()
+        assert image.upload_state == 'available'
+        assert image.filepath is not None
+        session.delete(image)
+        session.commit()
+
+
+def test_upload_to_local_storage_is_served_back(mockdata, client, session,
+                                                tmpdir):
+    data = 'GIF89a' + 'local storage'
+    hash_img = compute_hash(data)
+    config = current_app.config
+    with current_app.test_request_context():
+        backend = config['IMAGE_STORAGE'], config['IMAGE_STORAGE_PATH']
+        config['IMAGE_STORAGE'] = 'local'
+        config['IMAGE_STORAGE_PATH'] = str(tmpdir)
+        try:
+            with patch('boto3.client') as s3_client:
+                rv = client.post(url_for('main.upload', department_id=1),
+                                 data={'file': (BytesIO(data), 'local.gif')})
+            assert rv.status_code == 200
+            assert not s3_client.called
+            image = Image.query.filter_by(hash_img=hash_img).one()
+            assert image.filepath == 'local:{}/{}.gif'.format(
+                hash_img[:2], hash_img[2:])
+
+            rv = client.get(serve_image(image.filepath))
+            assert rv.status_code == 200
+            assert rv.data == data
+            session.delete(image)
+            session.commit()
+        finally:
+            config['IMAGE_STORAGE'], config['IMAGE_STORAGE_PATH'] = backend
+
+
+def test_upload_is_staged_for_the_upload_workers(mockdata, client, session,
+                                                 tmpdir):
+    data = 'GIF89a' + 'background'
+    hash_img = compute_hash(data)
+    with current_app.test_request_context(), \
+            patch.dict(current_app.config, {'UPLOAD_WORKERS': 1,
+                                            'UPLOAD_STAGING_PATH': str(tmpdir)}), \
+            patch.object(upload_queue, 'notify') as notify, \
+            patch('boto3.client') as s3_client:
+        rv = client.post(url_for('main.upload', department_id=1),
+                         data={'file': (BytesIO(data), 'queued.gif')})
+        assert rv.status_code == 200
+        assert notify.called
+        assert not s3_client.called
+        image = Image.query.filter_by(hash_img=hash_img).one()
+        assert image.upload_state == 'pending'
+        assert tmpdir.join(hash_img[:2], hash_img[2:] + '.gif').read() == data
+        session.delete(image)
+        session.commit()
+
+
 def test_user_can_access_profile(mockdata, client, session):
     with current_app.test_request_context():
         login_user(client)
@@ -257,6 +639,15 @@ def test_user_can_access_officer_list(mockdata, client, session):
         assert 'Officers' in rv.data
 
 
+def test_officer_list_shows_approximate_page_count(mockdata, client, session):
+    with current_app.test_request_context():
+        rv = client.get(
+            url_for('main.list_officer', department_id=1)
+        )
+
+        assert 'Page 1 of about' in rv.data
+
+
 def test_ac_can_access_admin_on_dept_officer_profile(mockdata, client, session):
     with current_app.test_request_context():
         login_ac(client)
@@ -547,6 +938,34 @@ def test_user_can_add_tag(mockdata, client, session):
         assert 'Tag added to database' in rv.data
 
 
+def test_user_can_tag_several_faces_at_once(mockdata, client, session):
+    with current_app.test_request_context():
+        login_user(client)
+        tag = Face.query.first()
+        untagged = Officer.query.filter(~Officer.face.any()).limit(2).all()
+        box = {'x': 10, 'y': 20, 'width': 30, 'height': 40}
+        faces = [dict(box, officer_id=officer_id) for officer_id in
+                 [untagged[0].id, tag.officer_id, 999999, untagged[1].id,
+                  untagged[0].id]]
+
+        rv = client.post(url_for('main.tag_faces', image_id=tag.img_id),
+                         data=json.dumps({'faces': faces}),
+                         content_type='application/json')
+        statuses = [face['status'] for face in json.loads(rv.data)['faces']]
+        assert statuses == ['created', 'exists', 'invalid_officer',
+                            'created', 'exists']
+        for officer in untagged:
+            face = Face.query.filter_by(officer_id=officer.id,
+                                        img_id=tag.img_id).one()
+            assert face.face_width == 30
+            assert OfficerSearch.query.get(officer.id).has_face
+
+        rv = client.post(url_for('main.tag_faces', image_id=tag.img_id),
+                         data=json.dumps({'faces': [{'officer_id': 1}]}),
+                         content_type='application/json')
+        assert rv.status_code == 400
+
+
 def test_user_is_redirected_to_correct_department_after_tagging(mockdata, client, session):
     with current_app.test_request_context():
         login_user(client)
@@ -999,6 +1418,61 @@ def test_admin_can_add_new_officer(mockdata, client, session):
         assert officer.gender == 'M'
 
 
+def test_adding_officer_updates_search_table(mockdata, client, session):
+    with current_app.test_request_context():
+        login_admin(client)
+        form = AddOfficerForm(first_name='Test',
+                              last_name="O'Searchable",
+                              race='WHITE',
+                              gender='F',
+                              star_no=4321,
+                              rank='SERGEANT',
+                              department=AC_DEPT,
+                              birth_year=1980)
+
+        client.post(url_for('main.add_officer'), data=form.data,
+                    follow_redirects=True)
+
+        officer = Officer.query.filter_by(last_name="O'Searchable").one()
+        entry = OfficerSearch.query.get(officer.id)
+        assert entry.last_name == 'OSEARCHABLE'
+        assert entry.department_id == AC_DEPT
+        assert entry.rank_code == 'SERGEANT'
+        assert entry.star_no == '4321'
+        assert entry.has_face is False
+
+
+def test_adding_assignment_updates_search_table(mockdata, client, session):
+    with current_app.test_request_context():
+        login_admin(client)
+        form = AssignmentForm(star_no='98765', rank='LIEUTENANT')
+
+        client.post(url_for('main.add_assignment', officer_id=3),
+                    data=form.data, follow_redirects=True)
+
+        entry = OfficerSearch.query.get(3)
+        assert entry.star_no == '98765'
+        assert entry.rank_code == 'LIEUTENANT'
+
+
+def test_tagging_updates_search_table(mockdata, client, session):
+    with current_app.test_request_context():
+        login_admin(client)
+        officer = Officer.query.filter(~Officer.face.any()).first()
+        image = Image.query.first()
+        form = FaceTag(officer_id=officer.id, image_id=image.id, dataX=34,
+                       dataY=32, dataWidth=3, dataHeight=33)
+
+        client.post(url_for('main.label_data', image_id=image.id),
+                    data=form.data, follow_redirects=True)
+        assert OfficerSearch.query.get(officer.id).has_face is True
+
+        tag = Face.query.filter_by(officer_id=officer.id).one()
+        client.post(url_for('main.delete_tag', tag_id=tag.id),
+                    follow_redirects=True)
+        assert OfficerSearch.query.get(officer.id).has_face is False
+
+
 def test_ac_can_add_new_officer_in_their_dept(mockdata, client, session):
     with current_app.test_request_context():
         login_ac(client)
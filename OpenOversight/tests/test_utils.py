@@ -1,6 +1,22 @@
+import datetime
+from io import BytesIO
+import json
+import pytest
+import random
+import re
+from flask import current_app
 from mock import patch, Mock
 import os
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 import OpenOversight
+from OpenOversight.app import cache as search_cache
+from OpenOversight.app import geo
+from OpenOversight.app import storage
+from OpenOversight.app import upload_queue
+from OpenOversight.app import uploads
+from OpenOversight.app import work_queue
+from OpenOversight.app.snapshot import Snapshot, numpy
 
 
 # Utils tests
@@ -72,6 +88,45 @@ def test_filter_by_name(mockdata):
         assert 'J' in element.last_name
 
 
+def test_filter_by_name_matches_substring(mockdata):
+    department = OpenOversight.app.models.Department.query.first()
+    results = OpenOversight.app.utils.grab_officers(
+        {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+         'min_age': 16, 'max_age': 85, 'name': 'nkl', 'badge': '',
+         'dept': department}
+    ).all()
+    assert len(results) > 0
+    for element in results:
+        assert element.last_name == 'TINKLE'
+
+
+def test_filter_by_short_name_matches_substring(mockdata):
+    department = OpenOversight.app.models.Department.query.first()
+    results = OpenOversight.app.utils.grab_officers(
+        {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+         'min_age': 16, 'max_age': 85, 'name': 'kl', 'badge': '',
+         'dept': department}
+    ).all()
+    # Too short for the trigram index, but still matched anywhere
+    assert len(results) > 0
+    for element in results:
+        assert element.last_name == 'TINKLE'
+
+
+def test_filter_by_name_escapes_wildcards(mockdata):
+    department = OpenOversight.app.models.Department.query.first()
+    results = OpenOversight.app.utils.grab_officers(
+        {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+         'min_age': 16, 'max_age': 85, 'name': '%%%', 'badge': '',
+         'dept': department}
+    ).all()
+    assert results == []
+    results = OpenOversight.app.utils.roster_lookup(
+        {'name': '%%%', 'badge': '', 'dept': department}
+    ).all()
+    assert results == []
+
+
 def test_filter_by_badge_no(mockdata):
     department = OpenOversight.app.models.Department.query.first()
     results = OpenOversight.app.utils.grab_officers(
@@ -84,12 +139,716 @@ def test_filter_by_badge_no(mockdata):
         assert '12' in str(assignment.star_no)
 
 
+def test_phonetic_keys_and_edit_distance():
+    utils = OpenOversight.app.utils
+    assert utils.phonetic_keys('Schmidt') == ('XMT', 'SMT')
+    assert utils.phonetic_keys('') == (None, None)
+    assert utils.edit_distance('SMITH', 'SMYTH') == 1
+    assert utils.edit_distance('KITTEN', 'SITTING') == 3
+    assert utils.edit_distance('', 'ABC') == 3
+
+
+def test_fuzzy_name_search_ranks_by_spelling(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    department = models.Department.query.first()
+    schmidt, smyth = models.Officer.query.filter_by(
+        department_id=department.id).limit(2).all()
+    schmidt.last_name = 'Schmidt'
+    smyth.last_name = 'Smyth'
+    utils.update_officer_search(schmidt)
+    utils.update_officer_search(smyth)
+    models.db.session.commit()
+
+    form = {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+            'min_age': 16, 'max_age': 85, 'name': 'Smith', 'badge': '',
+            'dept': department}
+    assert utils.grab_officers(form).all() == []
+    form['fuzzy'] = True
+    for lookup in (utils.grab_officers, utils.roster_lookup):
+        officer_ids = utils.fuzzy_officer_ids(lookup(form, sort=False),
+                                              form['name'])
+        assert officer_ids == [smyth.id, schmidt.id]
+    # Without levenshtein() in the database only so many are ranked
+    with patch.object(utils, 'FUZZY_CANDIDATE_LIMIT', 1):
+        assert len(utils.fuzzy_officer_ids(
+            utils.grab_officers(form, sort=False), form['name'])) == 1
+
+
+def test_backfill_phonetic_keys(mockdata):
+    models = OpenOversight.app.models
+    models.OfficerSearch.query.update({'last_name_metaphone': None})
+    models.db.session.commit()
+    count = OpenOversight.app.utils.backfill_phonetic_keys(batch_size=50)
+    assert count == models.OfficerSearch.query.count()
+    assert models.OfficerSearch.query.filter_by(
+        last_name_metaphone=None).count() == 0
+
+
+def test_badge_digits_strips_punctuation():
+    badge_digits = OpenOversight.app.models.badge_digits
+    assert badge_digits('#04-17') == '0417'
+    assert badge_digits(1234) == '1234'
+    assert badge_digits('ABC') is None
+    assert badge_digits(None) is None
+
+
+def test_filter_by_badge_ranks_exact_then_prefix_matches(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    department = models.Department.query.first()
+    officers = models.Officer.query.filter_by(
+        department_id=department.id).limit(3).all()
+    for officer, star_no in zip(officers, ['#88888-1', '8888812', '9888881']):
+        models.db.session.add(models.Assignment(officer_id=officer.id,
+                                                star_no=star_no,
+                                                star_date=datetime.datetime.now()))
+        models.db.session.flush()
+        utils.update_officer_search(officer)
+    models.db.session.commit()
+
+    form = {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+            'min_age': 16, 'max_age': 85, 'name': '', 'dept': department}
+    for lookup in (utils.grab_officers, utils.roster_lookup):
+        form['badge'] = '888881'
+        assert lookup(form).all() == officers
+        form['badge'] = '88888'
+        results = lookup(form).all()
+        assert set(results[:2]) == set(officers[:2])
+        # Badges merely containing the term still match, ranked last
+        assert results[2:] == [officers[2]]
+
+
+def test_keyset_pagination_visits_each_officer_once_in_order(mockdata):
+    department = OpenOversight.app.models.Department.query.first()
+    form = {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+            'min_age': 16, 'max_age': 85, 'name': '', 'badge': '',
+            'dept': department}
+    query = OpenOversight.app.utils.grab_officers(form, sort=False)
+    expected = sorted(query.all(), reverse=True,
+                      key=lambda officer: (officer.face.count() > 0, officer.id))
+
+    seen = []
+    cursor = None
+    while True:
+        page = OpenOversight.app.utils.keyset_paginate(
+            query, OpenOversight.app.utils.officer_has_face(),
+            OpenOversight.app.models.Officer.id, 7, cursor)
+        assert len(page.items) <= 7
+        seen.extend(page.items)
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+
+    assert [officer.id for officer in seen] == [officer.id for officer in expected]
+
+
+def test_keyset_pagination_prev_cursor_returns_previous_page(mockdata):
+    query = OpenOversight.app.models.Officer.query
+    has_face = OpenOversight.app.utils.officer_has_face()
+    officer_id = OpenOversight.app.models.Officer.id
+
+    first = OpenOversight.app.utils.keyset_paginate(query, has_face, officer_id, 5)
+    second = OpenOversight.app.utils.keyset_paginate(query, has_face, officer_id, 5,
+                                                     first.next_cursor)
+    back = OpenOversight.app.utils.keyset_paginate(query, has_face, officer_id, 5,
+                                                   second.prev_cursor)
+
+    assert not first.has_prev
+    assert second.has_prev
+    assert [o.id for o in back.items] == [o.id for o in first.items]
+    assert not back.has_prev
+    assert back.next_cursor is not None
+
+
+def test_facet_counts_match_gallery_searches(mockdata):
+    utils = OpenOversight.app.utils
+    choices = OpenOversight.app.main.choices
+    department = OpenOversight.app.models.Department.query.first()
+    form = {'race': 'Not Sure', 'gender': 'M', 'rank': 'Not Sure',
+            'min_age': 16, 'max_age': 85, 'name': '', 'badge': '',
+            'dept': department}
+    options = {'race': [value for value, _ in choices.RACE_CHOICES],
+               'gender': [value for value, _ in choices.GENDER_CHOICES],
+               'rank': [value for value, _ in choices.RANK_CHOICES]}
+    for badge in ('', '1', '12', '#1'):
+        form['badge'] = badge
+        counts = utils.facet_counts(form, options)
+
+        assert counts['total'] == utils.grab_officers(form).count()
+        for facet in ('race', 'gender', 'rank'):
+            for option in options[facet]:
+                search = dict(form)
+                search[facet] = option
+                assert counts[facet][option] == \
+                    utils.grab_officers(search).count()
+
+
+def test_fetch_ahead_paginate_detects_next_page_without_count(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    query = models.Officer.query.order_by(models.Officer.id)
+    total = query.count()
+    statements = []
+
+    def record_statement(*args):
+        statements.append(args[2])
+
+    engine = models.db.engine
+    event.listen(engine, 'before_cursor_execute', record_statement)
+    try:
+        first = utils.fetch_ahead_paginate(query, 1, 10, lambda: 1)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record_statement)
+
+    assert len(statements) == 1
+    assert 'count' not in statements[0].lower()
+    assert first.items == query.limit(10).all()
+    assert first.has_next and not first.has_prev
+    assert first.total_is_estimate
+    # An estimate can't be lower than what has already been seen
+    assert first.total == 11
+
+    last_page = (total + 9) // 10
+    last = utils.fetch_ahead_paginate(query, last_page, 10)
+    assert not last.has_next
+    assert not last.total_is_estimate
+    assert last.total == total
+    assert last.pages == last_page
+
+    past_end = utils.fetch_ahead_paginate(query, last_page + 5, 10)
+    assert past_end.items == []
+    assert past_end.total is None
+
+
+def test_count_estimates_on_sqlite(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    assert utils.estimate_count(models.Officer.query) is None
+    assert utils.department_officer_count(1) == \
+        models.Officer.query.filter_by(department_id=1).count()
+
+
+def test_department_officer_counts_are_cached_per_department(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    extensions = current_app.extensions
+    extensions['search_cache'] = search_cache.MemoryBackend(10, 60)
+    try:
+        for department in models.Department.query.all():
+            assert utils.department_officer_count(department.id) == \
+                models.Officer.query.filter_by(
+                    department_id=department.id).count()
+    finally:
+        extensions['search_cache'] = None
+
+
+def test_preload_officer_details_uses_constant_queries(mockdata):
+    officers = OpenOversight.app.models.Officer.query.limit(20).all()
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    engine = OpenOversight.app.models.db.engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        OpenOversight.app.utils.preload_officer_details(officers)
+        for officer in officers:
+            if officer.primary_face:
+                officer.primary_face.image.filepath
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    assert len(statements) <= 3
+    for officer in officers:
+        assert officer.face_count == officer.face.count()
+        first_face = officer.face.order_by(OpenOversight.app.models.Face.id).first()
+        assert officer.primary_face == first_face
+        assert officer.current_assignment in officer.assignments.all()
+
+
+def test_rebuild_officer_search_covers_every_officer(mockdata):
+    models = OpenOversight.app.models
+    count = OpenOversight.app.utils.rebuild_officer_search(batch_size=50)
+    assert count == models.Officer.query.count()
+    assert models.OfficerSearch.query.count() == count
+
+    for officer in models.Officer.query.limit(10):
+        entry = officer.search
+        assert entry.department_id == officer.department_id
+        assert entry.has_face == (officer.face.count() > 0)
+        assert entry.star_no == officer.assignments.first().star_no
+
+
+def test_normalize_rank_maps_onto_rank_codes():
+    normalize_rank = OpenOversight.app.utils.normalize_rank
+    assert normalize_rank('PO') == 'PO'
+    assert normalize_rank('Police Officer') == 'PO'
+    assert normalize_rank('DEP CHIEF') == 'DEP CHIEF'
+    assert normalize_rank('SUPT OF POLICE') == 'SUPT OF POLICE'
+    assert normalize_rank('Detective') == 'DETECTIVE'
+    assert normalize_rank(None) is None
+
+
+def test_lru_cache_evicts_least_recently_used_and_expired():
+    cache = search_cache.LRUCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    cache.ttl = -1
+    cache.set('d', 4)
+    assert cache.get('d') is None
+
+
+def test_search_cache_reuses_results_until_department_changes(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    extensions = current_app.extensions
+    extensions['search_cache'] = search_cache.MemoryBackend(10, 60)
+    try:
+        cache = search_cache.SearchCache()
+        department = models.Department.query.first()
+        form = {'dept': department, 'name': '', 'badge': ''}
+        computed = []
+
+        def compute():
+            computed.append(1)
+            return utils.ordered_officer_ids(utils.roster_lookup(form))
+
+        first = cache.officer_ids('roster', department.id,
+                                  utils.search_cache_key(form), compute)
+        second = cache.officer_ids('roster', department.id,
+                                   utils.search_cache_key(form), compute)
+        assert len(computed) == 1
+        assert list(first) == list(second)
+        page = utils.paginate_officer_ids(first, 2, 5)
+        assert [officer.id for officer in page.items] == list(first[5:10])
+        assert page.total == len(first)
+
+        officer = models.Officer.query.filter_by(
+            department_id=department.id).first()
+        officer.last_name = 'Renamed'
+        utils.update_officer_search(officer)
+        models.db.session.commit()
+
+        cache.officer_ids('roster', department.id,
+                          utils.search_cache_key(form), compute)
+        assert len(computed) == 2
+    finally:
+        extensions['search_cache'] = None
+
+
+def test_search_cache_keeps_departments_apart(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    extensions = current_app.extensions
+    extensions['search_cache'] = search_cache.MemoryBackend(10, 60)
+    try:
+        cache = search_cache.SearchCache()
+        for department in models.Department.query.all():
+            form = {'dept': department, 'name': '', 'badge': ''}
+            expected = utils.ordered_officer_ids(utils.roster_lookup(form))
+            officer_ids = cache.officer_ids(
+                'roster', department.id, utils.search_cache_key(form),
+                lambda: utils.ordered_officer_ids(utils.roster_lookup(form)))
+            assert list(officer_ids) == expected
+    finally:
+        extensions['search_cache'] = None
+
+
+def test_rank_normalizations_prefer_department_mappings(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    department, other_department = models.Department.query.limit(2).all()
+    models.db.session.add_all([
+        models.RankNormalization(raw_rank='SGT', rank_code='SERGEANT'),
+        models.RankNormalization(department_id=department.id,
+                                 raw_rank='P.O. II', rank_code='PO'),
+        models.RankNormalization(department_id=department.id,
+                                 raw_rank='SGT', rank_code='FIELD'),
+    ])
+    models.db.session.commit()
+    try:
+        assert utils.rank_code_for(' p.o. ii ', department.id) == 'PO'
+        assert utils.rank_code_for('SGT', department.id) == 'FIELD'
+        assert utils.rank_code_for('SGT', other_department.id) == 'SERGEANT'
+        assert utils.rank_code_for('Captain', other_department.id) == \
+            'CAPTAIN'
+        assert utils.rank_code_for('', department.id) is None
+
+        officer = models.Officer.query.filter_by(
+            department_id=department.id).first()
+        assignment = models.Assignment(officer_id=officer.id, rank='SGT',
+                                       star_date=datetime.datetime.now())
+        models.db.session.add(assignment)
+        models.db.session.commit()
+        count = utils.backfill_rank_codes(batch_size=50)
+        assert count == models.Assignment.query.count()
+        assert assignment.rank_code == 'FIELD'
+        assert officer.search.rank_code == 'FIELD'
+        assert models.Assignment.query.filter(
+            models.Assignment.rank != None,  # noqa
+            models.Assignment.rank_code == None).count() == 0  # noqa
+    finally:
+        models.RankNormalization.query.delete()
+        models.db.session.commit()
+
+
+def test_default_rank_normalizations_are_unique(session):
+    models = OpenOversight.app.models
+    department = models.Department(name='Springfield Police Department',
+                                   short_name='SPD')
+    session.add(department)
+    session.flush()
+    session.add_all([
+        models.RankNormalization(raw_rank='SGT', rank_code='SERGEANT'),
+        models.RankNormalization(department_id=department.id,
+                                 raw_rank='SGT', rank_code='FIELD'),
+    ])
+    session.flush()
+    session.add(models.RankNormalization(raw_rank='SGT', rank_code='FIELD'))
+    with pytest.raises(IntegrityError):
+        session.flush()
+    session.rollback()
+
+
+SQUARE = {'type': 'Polygon',
+          'coordinates': [[[-87.7, 41.8], [-87.6, 41.8], [-87.6, 41.9],
+                           [-87.7, 41.9], [-87.7, 41.8]],
+                          [[-87.66, 41.84], [-87.64, 41.84],
+                           [-87.64, 41.86], [-87.66, 41.86],
+                           [-87.66, 41.84]]]}
+
+
+def test_geometry_contains_respects_holes():
+    polygons = geo.parse_geometry(json.dumps(SQUARE))
+    assert geo.bounding_box(polygons) == (41.8, -87.7, 41.9, -87.6)
+    assert geo.contains(polygons, 41.81, -87.69)
+    assert not geo.contains(polygons, 41.85, -87.65)
+    assert not geo.contains(polygons, 42.0, -87.65)
+    with pytest.raises(ValueError):
+        geo.parse_geometry('{"type": "Point", "coordinates": [0, 0]}')
+
+
+def test_rtree_search_matches_brute_force():
+    rng = random.Random(7)
+    boxes = []
+    for key in range(500):
+        lat, lng = rng.uniform(-80, 80), rng.uniform(-170, 170)
+        boxes.append((key, (lat, lng, lat + rng.uniform(0, 5),
+                            lng + rng.uniform(0, 5))))
+    tree = geo.RTree(boxes, node_size=8)
+    for _ in range(100):
+        lat, lng = rng.uniform(-80, 85), rng.uniform(-170, 175)
+        expected = set(key for key, box in boxes
+                       if box[0] <= lat <= box[2] and box[1] <= lng <= box[3])
+        assert set(tree.search(lat, lng)) == expected
+    assert geo.RTree([]).search(0, 0) == []
+
+
+def test_location_search_narrows_to_covering_units(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    department = models.Department.query.first()
+    unit = models.Unit(descrip='District 1', department_id=department.id,
+                       boundary=json.dumps(SQUARE))
+    models.db.session.add(unit)
+    models.db.session.commit()
+    assert unit.min_latitude == 41.8 and unit.max_longitude == -87.6
+
+    officer = models.Officer.query.filter_by(
+        department_id=department.id).order_by(models.Officer.id).first()
+    models.db.session.add(models.Assignment(
+        officer_id=officer.id, unit=unit.id,
+        star_date=datetime.datetime.now()))
+    models.db.session.flush()
+    utils.update_officer_search(officer)
+    models.db.session.commit()
+
+    assert utils.units_covering(41.81, -87.69) == [unit.id]
+    assert utils.units_covering(41.85, -87.65) == []
+    form = {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+            'min_age': 16, 'max_age': 85, 'name': '', 'badge': '',
+            'dept': department, 'latitude': 41.81, 'longitude': -87.69}
+    nowhere = dict(form, latitude=None, longitude=None)
+    other = models.Officer.query.filter(
+        models.Officer.department_id == department.id,
+        models.Officer.last_name != officer.last_name).first()
+    searches = [
+        # Only the officer assigned to the covering unit
+        (form, [officer.id]),
+        # No unit covers the point, so the location narrows nothing
+        (dict(form, latitude=45.0),
+         utils.ordered_officer_ids(utils.grab_officers(nowhere))),
+        # Nobody nearby matches, so the rest of the search is kept
+        (dict(form, name=other.last_name),
+         utils.ordered_officer_ids(utils.grab_officers(
+             dict(nowhere, name=other.last_name)))),
+    ]
+    snapshot = Snapshot() if numpy is not None else None
+    if snapshot is not None:
+        snapshot.rebuild()
+    for search, expected in searches:
+        assert expected
+        assert utils.ordered_officer_ids(utils.grab_officers(search)) == \
+            expected
+        if snapshot is not None:
+            assert snapshot.search(search) == expected
+
+
+def snapshot_forms(department):
+    base = {'race': 'Not Sure', 'gender': 'Not Sure', 'rank': 'Not Sure',
+            'min_age': 16, 'max_age': 85, 'name': '', 'badge': '',
+            'dept': department}
+    variants = [{}, {'race': 'WHITE'}, {'gender': 'F'}, {'rank': 'COMMANDER'},
+                {'rank': 'PO'}, {'min_age': 30, 'max_age': 50},
+                {'name': 'J'}, {'name': 'son'}, {'name': '%%%'}, {'badge': '1'},
+                {'badge': '12'}, {'badge': 'X'}]
+    forms = []
+    for variant in variants:
+        form = dict(base)
+        form.update(variant)
+        forms.append(form)
+    return forms
+
+
+def test_snapshot_search_matches_database_search(mockdata):
+    pytest.importorskip('numpy')
+    utils = OpenOversight.app.utils
+    snapshot = Snapshot()
+    snapshot.rebuild()
+    for department in OpenOversight.app.models.Department.query.all():
+        for form in snapshot_forms(department):
+            assert snapshot.search(form) == \
+                utils.ordered_officer_ids(utils.grab_officers(form))
+
+
+def test_snapshot_refresh_picks_up_changed_officers(mockdata):
+    pytest.importorskip('numpy')
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    snapshot = Snapshot()
+    snapshot.rebuild()
+    departments = models.Department.query.all()
+    officer = models.Officer.query.filter_by(
+        department_id=departments[0].id).first()
+    officer.last_name = u'Zzyzx'
+    officer.department_id = departments[1].id
+    utils.update_officer_search(officer)
+    models.db.session.commit()
+
+    snapshot.refresh()
+    for department in departments[:2]:
+        form = snapshot_forms(department)[0]
+        form['name'] = 'ZZYZX'
+        assert snapshot.search(form) == \
+            utils.ordered_officer_ids(utils.grab_officers(form))
+    assert officer.id in snapshot.search(form)
+
+
+def test_snapshot_refresh_patches_rows_without_touching_old_state(mockdata):
+    pytest.importorskip('numpy')
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    snapshot = Snapshot()
+    snapshot.rebuild()
+    before = snapshot.state
+    department = models.Department.query.first()
+    officer = models.Officer.query.filter_by(
+        department_id=department.id).first()
+    officer.last_name = u'Wolfeschlegelsteinhausenbergerdorff'
+    utils.update_officer_search(officer)
+    recruit = models.Officer(last_name=u'Newcomb', first_name=u'Ann',
+                             department_id=department.id)
+    models.db.session.add(recruit)
+    models.db.session.flush()
+    utils.update_officer_search(recruit)
+    models.db.session.commit()
+    old_names = before.departments[department.id].last_name.copy()
+
+    snapshot.refresh()
+    assert snapshot.state is not before
+    assert (before.departments[department.id].last_name == old_names).all()
+    for form in snapshot_forms(department):
+        assert snapshot.search(form) == \
+            utils.ordered_officer_ids(utils.grab_officers(form))
+    form = snapshot_forms(department)[0]
+    form['name'] = 'WOLFESCHLEGELSTEINHAUSENBERGERDORFF'
+    assert snapshot.search(form) == [officer.id]
+    form['name'] = 'NEWCOMB'
+    assert recruit.id in snapshot.search(form)
+
+
+def test_get_random_image_picks_from_query_without_counting(mockdata):
+    models = OpenOversight.app.models
+    utils = OpenOversight.app.utils
+    image_query = models.Image.query.filter_by(department_id=1)
+    expected = set(image.id for image in image_query)
+    picked = set()
+    with patch.object(image_query.__class__, 'count',
+                      side_effect=AssertionError('counted images')):
+        for _ in range(100):
+            picked.add(utils.get_random_image(image_query).id)
+    assert picked <= expected
+    assert len(picked) > 1
+    assert utils.get_random_image(image_query.filter_by(id=-1)) is None
+
+
+def test_work_queue_leases_each_image_to_one_user(mockdata):
+    users = OpenOversight.app.models.User.query.limit(2).all()
+    first = work_queue.claim_image(work_queue.SORT, users[0].id, 1)
+    second = work_queue.claim_image(work_queue.SORT, users[1].id, 1)
+    assert first.department_id == second.department_id == 1
+    assert first.id != second.id
+    assert first.leased_by == users[0].id
+    # A user keeps getting the image they hold until they finish it
+    assert work_queue.claim_image(work_queue.SORT, users[0].id, 1) == first
+    first.contains_cops = False
+    work_queue.release_image(first)
+    OpenOversight.app.models.db.session.commit()
+    assert work_queue.claim_image(work_queue.SORT, users[0].id, 1) != first
+
+
+def test_work_queue_runs_dry_and_reclaims_expired_leases(mockdata):
+    models = OpenOversight.app.models
+    users = models.User.query.limit(2).all()
+    waiting = work_queue.waiting_images(work_queue.SORT, 1).count()
+    claimed = set()
+    for _ in range(waiting):
+        claimed.add(work_queue.claim_image(work_queue.SORT, users[0].id, 1)
+                    .id)
+        models.db.session.query(models.Image).filter(
+            models.Image.leased_by == users[0].id).update(
+            {'leased_by': users[1].id}, synchronize_session=False)
+        models.db.session.commit()
+    assert len(claimed) == waiting
+    assert work_queue.claim_image(work_queue.SORT, users[0].id, 1) is None
+
+    stale = models.Image.query.get(claimed.pop())
+    stale.lease_expires_at = datetime.datetime.utcnow() - \
+        datetime.timedelta(seconds=1)
+    models.db.session.commit()
+    metrics = work_queue.queue_metrics()[1]
+    assert metrics['unsorted'] == waiting
+    assert metrics['leased'] == waiting - 1
+    assert metrics['expired'] == 1
+    assert metrics['reclaims'] == 0
+
+    reclaimed = work_queue.claim_image(work_queue.SORT, users[0].id, 1)
+    assert reclaimed == stale
+    assert reclaimed.lease_count == 2
+    metrics = work_queue.queue_metrics()[1]
+    assert metrics['claims'] == waiting + 1
+    assert metrics['reclaims'] == 1
+
+
+def test_get_random_images_wraps_around_without_repeats(mockdata):
+    models = OpenOversight.app.models
+    image_query = models.Image.query.filter_by(department_id=1)
+    for _ in range(20):
+        images = OpenOversight.app.utils.get_random_images(image_query, 4)
+        assert len(images) == len(set(images)) == 4
+    assert len(OpenOversight.app.utils.get_random_images(image_query, 50)) \
+        == image_query.count()
+
+
+def test_classify_images_skips_images_leased_to_others(mockdata):
+    models = OpenOversight.app.models
+    users = models.User.query.limit(2).all()
+    mine = work_queue.claim_images(work_queue.SORT, users[0].id, 1, 2)
+    theirs = work_queue.claim_image(work_queue.SORT, users[1].id, 1)
+    answers = {mine[0].id: True, mine[1].id: False, theirs.id: True}
+    assert work_queue.classify_images(answers, users[0].id) == 2
+    models.db.session.commit()
+    for image in mine + [theirs]:
+        models.db.session.refresh(image)
+    assert (mine[0].contains_cops, mine[1].contains_cops) == (True, False)
+    assert mine[0].leased_by is None and mine[0].user_id == users[0].id
+    assert theirs.contains_cops is None and theirs.leased_by == users[1].id
+    # Already sorted images keep their first answer
+    assert work_queue.classify_images({mine[0].id: False}, users[0].id) == 0
+
+
+def test_priority_scheduler_favors_campaigns_then_older_images(mockdata):
+    models = OpenOversight.app.models
+    user = models.User.query.first()
+    now = datetime.datetime.utcnow()
+    images = models.Image.query.order_by(models.Image.id).all()
+    # Department 2's images are the newest, but it is running a campaign
+    for age, image in enumerate(reversed(images)):
+        image.date_image_inserted = now - datetime.timedelta(days=age)
+    models.Department.query.get(2).campaign_weight = 3.0
+    models.db.session.commit()
+    assert work_queue.reprioritize_images() == len(images)
+
+    current_app.config['WORK_SCHEDULER'] = 'priority'
+    try:
+        claimed = work_queue.claim_images(work_queue.SORT, user.id,
+                                          count=len(images))
+    finally:
+        current_app.config['WORK_SCHEDULER'] = 'random'
+    department2 = sorted([image for image in images
+                          if image.department_id == 2],
+                         key=lambda image: image.date_image_inserted)
+    assert claimed[:len(department2)] == department2
+    assert set(claimed) == set(images)
+
+
+def test_priority_order_is_read_from_an_index(session):
+    # SQLite ignores the partial indexes' WHERE clauses, but the plans show
+    # the ORDER BY of next_images() being served by an index, not a sort.
+    # No mockdata, as pysqlite commits before running EXPLAIN
+    models = OpenOversight.app.models
+    for queue, department_id in ((work_queue.TAG, None), (work_queue.SORT, 1),
+                                 (work_queue.TAG, 1)):
+        query = work_queue.waiting_images(queue, department_id).order_by(
+            models.Image.priority.desc(), models.Image.id).limit(10)
+        sql = query.statement.compile(dialect=models.db.engine.dialect,
+                                      compile_kwargs={'literal_binds': True})
+        plan = models.db.session.execute(
+            'EXPLAIN QUERY PLAN %s' % sql).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        assert '_priority' in details
+        assert 'TEMP B-TREE' not in details
+
+
 def test_compute_hash(mockdata):
     hash_result = OpenOversight.app.utils.compute_hash('bacon')
     expected_hash = '9cca0703342e24806a9f64e08c053dca7f2cd90f10529af8ea872afb0a0c77d4'
     assert hash_result == expected_hash
 
 
+def test_spooled_upload_hashes_while_written(mockdata):
+    data = ''.join(chr(random.randint(0, 255)) for _ in range(5000))
+    spooled = uploads.HashingSpooledFile(max_size=1024)
+    for start in range(0, len(data), 700):
+        spooled.write(data[start:start + 700])
+    # Past max_size the upload lives on disk rather than in memory
+    assert spooled._rolled
+    expected = OpenOversight.app.utils.compute_hash(data)
+    assert uploads.file_hash(spooled) == expected
+    assert spooled.read() == data
+    assert uploads.file_hash(BytesIO(data), chunk_size=100) == expected
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = uploads.BloomFilter(1000, error_rate=0.01)
+    members = [OpenOversight.app.utils.compute_hash(str(i))
+               for i in range(1000)]
+    for member in members:
+        bloom.add(member)
+    assert all(member in bloom for member in members)
+    others = [OpenOversight.app.utils.compute_hash('other{}'.format(i))
+              for i in range(10000)]
+    assert sum(other in bloom for other in others) < 300
+
+
 def test_s3_upload_png(mockdata):
     test_dir = os.path.dirname(os.path.realpath(__file__))
     local_path = os.path.join(test_dir, '../app/static/images/test_cop1.png')
@@ -117,6 +876,177 @@ def test_s3_upload_jpeg(mockdata):
     assert mocked_connection.method_calls[0][2]['ExtraArgs']['ContentType'] == 'image/jpeg'
 
 
+def test_local_storage_is_content_addressed(tmpdir):
+    local = storage.LocalStorage(str(tmpdir))
+    filepath = local.save(BytesIO(b'image bytes'), 'abcdef.png')
+    assert filepath == 'local:ab/cdef.png'
+    assert tmpdir.join('ab', 'cdef.png').read() == 'image bytes'
+    # Saving the same content again leaves the stored file alone
+    assert local.save(BytesIO(b'ignored'), 'abcdef.png') == filepath
+    assert tmpdir.join('ab').listdir() == [tmpdir.join('ab', 'cdef.png')]
+    local.remove(filepath)
+    assert not tmpdir.join('ab', 'cdef.png').exists()
+    # Removing what is already gone is fine
+    local.remove(filepath)
+
+
+def test_serve_image_follows_the_storage_of_each_image(app):
+    with app.test_request_context():
+        assert OpenOversight.app.utils.serve_image(
+            'https://s3-us-west-2.amazonaws.com/b/ab/cd.png') == \
+            'https://s3-us-west-2.amazonaws.com/b/ab/cd.png'
+        assert OpenOversight.app.utils.serve_image('local:ab/cd.png') == \
+            '/images/ab/cd.png'
+        assert OpenOversight.app.utils.serve_image(
+            '/static/images/test_cop1.png').startswith('/static/')
+        for filepath in ('staged:ab/cd.png', None):
+            assert OpenOversight.app.utils.serve_image(filepath) == \
+                '/static/images/placeholder.png'
+
+
+def stage_test_upload(data, filename):
+    filepath = upload_queue.stage_upload(BytesIO(data), filename)
+    image = OpenOversight.app.models.Image(
+        filepath=filepath, hash_img=filename.split('.')[0], department_id=1,
+        upload_state=upload_queue.PENDING)
+    OpenOversight.app.models.db.session.add(image)
+    OpenOversight.app.models.db.session.commit()
+    return image
+
+
+def test_upload_queue_pushes_staged_images(mockdata, tmpdir):
+    with patch.dict(current_app.config,
+                    {'IMAGE_STORAGE': 'local',
+                     'IMAGE_STORAGE_PATH': str(tmpdir.join('store')),
+                     'UPLOAD_STAGING_PATH': str(tmpdir.join('staging'))}):
+        image = stage_test_upload(b'GIF89a staged', 'abcdef.gif')
+        assert image.filepath == 'staged:ab/cdef.gif'
+        assert image not in work_queue.waiting_images(work_queue.SORT)
+
+        assert upload_queue.claim_upload() == image
+        # Leased to whoever claimed it first
+        assert upload_queue.claim_upload() is None
+        assert upload_queue.push_upload(image)
+        assert image.filepath == 'local:ab/cdef.gif'
+        assert image.upload_state == upload_queue.AVAILABLE
+        assert tmpdir.join('store', 'ab', 'cdef.gif').read() == 'GIF89a staged'
+        assert not tmpdir.join('staging', 'ab', 'cdef.gif').exists()
+        assert image in work_queue.waiting_images(work_queue.SORT)
+        OpenOversight.app.models.db.session.delete(image)
+        OpenOversight.app.models.db.session.commit()
+
+
+def test_upload_workers_need_a_staging_path():
+    app = Mock(config={'UPLOAD_WORKERS': 2, 'UPLOAD_STAGING_PATH': None})
+    with pytest.raises(RuntimeError):
+        upload_queue.UploadQueue(app)
+    assert not app.before_first_request.called
+
+
+def test_upload_queue_retries_failed_pushes_with_backoff(mockdata, tmpdir):
+    s3_client = Mock()
+    s3_client.upload_fileobj.side_effect = IOError('S3 is down')
+    with patch.dict(current_app.config,
+                    {'IMAGE_STORAGE': 's3', 'UPLOAD_MAX_ATTEMPTS': 3,
+                     'UPLOAD_STAGING_PATH': str(tmpdir)}), \
+            patch('boto3.client', Mock(return_value=s3_client)):
+        image = stage_test_upload(b'GIF89a retried', 'fedcba.gif')
+        start = datetime.datetime.utcnow()
+        assert not upload_queue.push_upload(upload_queue.claim_upload())
+        assert image.upload_attempts == 1
+        assert image.upload_retry_at >= start + datetime.timedelta(
+            seconds=current_app.config['UPLOAD_RETRY_SECONDS'])
+        assert upload_queue.claim_upload() is None
+        assert upload_queue.upload_queue_status()['due'] == 0
+        assert upload_queue.drain_uploads() == (0, 0)
+
+        # Once the retry is due
+        image.upload_retry_at = start
+        OpenOversight.app.models.db.session.commit()
+        assert upload_queue.drain_uploads() == (0, 1)
+        assert image.upload_retry_at >= start + datetime.timedelta(
+            seconds=2 * current_app.config['UPLOAD_RETRY_SECONDS'])
+        image.upload_retry_at = start
+        OpenOversight.app.models.db.session.commit()
+        assert upload_queue.drain_uploads() == (0, 1)
+        assert image.upload_state == upload_queue.FAILED
+        # The upload is kept until it can be pushed
+        assert tmpdir.join('fe', 'dcba.gif').exists()
+
+        s3_client.upload_fileobj.side_effect = None
+        assert upload_queue.drain_uploads() == (0, 0)
+        assert upload_queue.drain_uploads(retry_failed=True) == (1, 0)
+        assert image.upload_state == upload_queue.AVAILABLE
+        assert image.filepath.endswith('/fe/dcba.gif')
+        OpenOversight.app.models.db.session.delete(image)
+        OpenOversight.app.models.db.session.commit()
+
+
+def test_upload_queue_skips_claims_without_a_staged_file(mockdata, tmpdir):
+    models = OpenOversight.app.models
+    now = datetime.datetime.utcnow()
+    with patch.dict(current_app.config,
+                    {'IMAGE_STORAGE': 'local',
+                     'IMAGE_STORAGE_PATH': str(tmpdir.join('store')),
+                     'UPLOAD_STAGING_PATH': str(tmpdir.join('staging'))}):
+        # Claimed by uploads still storing their file, or that died first
+        storing = models.Image(hash_img='storing', department_id=1,
+                               upload_state=upload_queue.PENDING,
+                               upload_retry_at=now + datetime.timedelta(
+                                   seconds=upload_queue.PUSH_LEASE_SECONDS))
+        died = models.Image(hash_img='died', department_id=1,
+                            upload_state=upload_queue.PENDING,
+                            upload_retry_at=now)
+        models.db.session.add_all([storing, died])
+        models.db.session.commit()
+        storing_id, died_id = storing.id, died.id
+        assert upload_queue.claim_upload() is None
+        assert upload_queue.upload_queue_status()['due'] == 0
+
+        assert upload_queue.drain_uploads() == (0, 0)
+        assert models.Image.query.get(storing_id).upload_retry_at > now
+        assert models.Image.query.get(died_id) is None
+
+        # Staged, but the file is gone
+        image = stage_test_upload(b'GIF89a lost', '123456.gif')
+        tmpdir.join('staging', '12', '3456.gif').remove()
+        assert not upload_queue.push_upload(upload_queue.claim_upload())
+        assert image.upload_attempts == 1
+        models.db.session.delete(image)
+        models.db.session.delete(models.Image.query.get(storing_id))
+        models.db.session.commit()
+
+
+def test_s3_client_is_shared_between_uploads(mockdata):
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    local_path = os.path.join(test_dir, '../app/static/images/test_cop1.png')
+
+    mocked_connection = Mock()
+    make_client = Mock(return_value=mocked_connection)
+    with patch('boto3.client', make_client):
+        for dest_filename in ('test_cop1.png', 'test_cop2.png'):
+            OpenOversight.app.utils.upload_file(local_path,
+                                                'doesntmatter.png',
+                                                dest_filename)
+    assert make_client.call_count == 1
+    assert make_client.call_args[1]['config'].max_pool_connections == \
+        current_app.config['S3_MAX_POOL_CONNECTIONS']
+    assert mocked_connection.upload_fileobj.call_count == 2
+    transfer_config = mocked_connection.upload_fileobj.call_args[1]['Config']
+    assert transfer_config.multipart_threshold == \
+        current_app.config['S3_MULTIPART_THRESHOLD']
+    assert transfer_config.max_concurrency == \
+        current_app.config['S3_MAX_CONCURRENCY']
+
+
+def test_stopwatch_reports_server_timing():
+    stopwatch = OpenOversight.app.utils.Stopwatch()
+    stopwatch.lap('store')
+    stopwatch.lap('db')
+    assert re.match(r'^store;dur=\d+\.\d, db;dur=\d+\.\d$',
+                    stopwatch.server_timing())
+
+
 def test_user_can_submit_allowed_file(mockdata):
     for file_to_submit in ['valid_photo.png', 'valid_photo.jpg', 'valid.photo.jpg', 'valid_photo.PNG', 'valid_photo.JPG']:
         assert OpenOversight.app.utils.allowed_file(file_to_submit) is True
@@ -7,6 +7,7 @@ import random
 
 from OpenOversight.app import create_app, models
 from OpenOversight.app.models import db
+from OpenOversight.app.utils import rebuild_officer_search
 
 app = create_app('development')
 db.app = app
@@ -135,6 +136,8 @@ def populate():
     db.session.add_all(faces)
     db.session.commit()
 
+    rebuild_officer_search()
+
     test_user = models.User(email='test@example.org',
                             username='test_user',
                             password='testtest',
@@ -156,6 +159,9 @@ def cleanup():
     for face in faces:
         db.session.delete(face)
 
+    models.OfficerSearch.query.delete()
+    models.RankNormalization.query.delete()
+
     departments = models.Department.query.all()
     for dept in departments:
         db.session.delete(dept)